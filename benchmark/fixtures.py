@@ -0,0 +1,183 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+"""Synthetic repositories for the benchmarks.
+
+Histories are generated with ``git fast-import``, which is orders of
+magnitude faster than committing through the porcelain.
+"""
+
+import os
+import socket
+import subprocess
+import time
+
+import sh
+
+COMMITTER = "gilt <gilt@example.com>"
+
+
+def make_repo(path, files=10, commits=1, tags=0, file_size=64):
+    """Create a bare repository and return its path.
+
+    The first commit adds `files` files spread over nested directories,
+    every further commit modifies one of them.  The last `tags` commits are
+    tagged ``v<n>``.
+
+    :param path: A string containing the path of the bare repository.
+    :param files: An int containing the number of files in the tree.
+    :param commits: An int containing the length of the history.
+    :param tags: An int containing the number of tags.
+    :param file_size: An int containing the size of each file in bytes.
+    :return: str
+    """
+    sh.git("init", "--bare", "--quiet", path)
+    stream = _fast_import_stream(files, commits, tags, file_size)
+    sh.git("fast-import", "--quiet", _cwd=path, _in=stream)
+    sh.git("symbolic-ref", "HEAD", "refs/heads/master", _cwd=path)
+
+    return path
+
+
+def advance(path, filename="advanced", count=1):
+    """Advance ``master`` of a bare repository and return None.
+
+    :param path: A string containing the path of the bare repository.
+    :param filename: A string containing the file each commit modifies.
+    :param count: An int containing the number of commits to add.
+    :return: None
+    """
+    tip = str(sh.git("rev-parse", "master", _cwd=path)).strip()
+    chunks = []
+    for n in range(count):
+        chunks.append(
+            _commit(
+                "refs/heads/master",
+                None,
+                "advance {}".format(n),
+                [(filename, "{} {}\n".format(filename, time.time()))],
+                parent=tip if n == 0 else None,
+            )
+        )
+    sh.git("fast-import", "--quiet", _cwd=path, _in="".join(chunks))
+
+
+def _fast_import_stream(files, commits, tags, file_size):
+    chunks = []
+    content = "x" * (file_size - 1) + "\n"
+    paths = [_path(n) for n in range(files)]
+    chunks.append(
+        _commit(
+            "refs/heads/master",
+            1,
+            "initial",
+            [(p, "{}\n{}".format(p, content)) for p in paths],
+        )
+    )
+    for n in range(2, commits + 1):
+        p = paths[n % len(paths)]
+        chunks.append(
+            _commit(
+                "refs/heads/master",
+                n,
+                "commit {}".format(n),
+                [(p, "{} {}\n{}".format(p, n, content))],
+            )
+        )
+    for n in range(max(commits - tags, 0) + 1, commits + 1):
+        chunks.append("reset refs/tags/v{}\nfrom :{}\n\n".format(n, n))
+
+    return "".join(chunks)
+
+
+def _commit(ref, mark, message, changes, parent=None):
+    lines = ["commit {}".format(ref)]
+    if mark is not None:
+        lines.append("mark :{}".format(mark))
+    lines.append("committer {} {} +0000".format(COMMITTER, int(time.time())))
+    lines.append(_data(message))
+    if parent:
+        lines.append("from {}".format(parent))
+    for path, data in changes:
+        lines.append("M 100644 inline {}".format(path))
+        lines.append(_data(data))
+
+    return "\n".join(lines) + "\n\n"
+
+
+def _data(data):
+    return "data {}\n{}".format(len(data.encode("utf-8")), data)
+
+
+def _path(n):
+    return "dir{}/sub{}/file{}.txt".format(n % 10, n % 7, n)
+
+
+class Daemon(object):
+    """A ``git daemon`` exporting every repository below a directory, as a
+    stand-in for a remote git server. """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.port = _free_port()
+        self._proc = None
+
+    def __enter__(self):
+        self._proc = subprocess.Popen(
+            [
+                "git",
+                "daemon",
+                "--reuseaddr",
+                "--export-all",
+                "--listen=127.0.0.1",
+                "--port={}".format(self.port),
+                "--base-path={}".format(self.base_path),
+                self.base_path,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.__exit__()
+        raise RuntimeError("git daemon did not start")
+
+    def __exit__(self, *exc):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+
+    def url(self, path):
+        relpath = os.path.relpath(path, self.base_path)
+        return "git://127.0.0.1:{}/{}".format(self.port, relpath)
+
+
+def _free_port():
+    s = socket.socket()
+    try:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
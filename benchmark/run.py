@@ -0,0 +1,363 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+"""Time ``gilt overlay`` against local fixture repositories.
+
+Every scenario is timed `--repeat` times and the fastest run is compared to
+the stored baseline.  A scenario regresses when it is slower than its
+baseline by more than `--tolerance`, and by more than `--min-delta`
+seconds so that noise on tiny timings doesn't fail the run.  Scenarios with
+a budget also fail whenever they take longer than it, whatever the baseline.
+"""
+
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import yaml
+
+import fixtures
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+SCENARIOS = collections.OrderedDict()
+# Seconds a scenario may never exceed.
+BUDGETS = {}
+
+
+def scenario(func=None, budget=None):
+    if func is None:
+        return lambda func: scenario(func, budget)
+    SCENARIOS[func.__name__] = func
+    if budget is not None:
+        BUDGETS[func.__name__] = budget
+    return func
+
+
+class Workspace(object):
+    """Fixture repositories, a gilt cache and a project directory. """
+
+    def __init__(self, root, scale):
+        self.root = root
+        self.scale = scale
+        self.repos_dir = os.path.join(root, "repos")
+        self.cache_dir = os.path.join(root, "cache")
+        self.project_dir = os.path.join(root, "project")
+        self._repos = {}
+        self.cleanups = []
+
+    def repo(self, name, **kwargs):
+        """Create the named fixture repository once and return its path. """
+        if name not in self._repos:
+            path = os.path.join(self.repos_dir, "bench", name + ".git")
+            self._repos[name] = fixtures.make_repo(path, **kwargs)
+        return self._repos[name]
+
+    def write_config(self, entries):
+        os.makedirs(self.project_dir, exist_ok=True)
+        with open(os.path.join(self.project_dir, "gilt.yml"), "w") as f:
+            yaml.safe_dump(entries, f)
+
+    def reset(self, cache=True, state=True, project=True):
+        if cache:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+        elif state:
+            shutil.rmtree(
+                os.path.join(self.cache_dir, "state"), ignore_errors=True
+            )
+        if project:
+            for name in os.listdir(self.project_dir):
+                if name != "gilt.yml":
+                    path = os.path.join(self.project_dir, name)
+                    shutil.rmtree(path, ignore_errors=True)
+
+    def gilt(self, *args):
+        # Benchmark the checkout, not whichever gilt happens to be installed.
+        path = os.pathsep.join(filter(None, [ROOT, os.getenv("PYTHONPATH")]))
+        env = dict(
+            os.environ, GILT_CACHE_DIRECTORY=self.cache_dir, PYTHONPATH=path
+        )
+        # Never hand the invocations over to a daemon.
+        env.pop("GILT_DAEMON_SOCKET", None)
+        cmd = [
+            sys.executable,
+            "-c",
+            "import sys; from gilt.client import main; sys.exit(main())",
+        ]
+        subprocess.run(
+            cmd + list(args),
+            cwd=self.project_dir,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+
+def _roles(ws, url=None, **kwargs):
+    url = url or (lambda path: "file://" + path)
+    return [
+        {
+            "git": url(ws.repo("role{}".format(n), **kwargs)),
+            "version": "master",
+            "dst": "roles/role{}/".format(n),
+        }
+        for n in range(20 * ws.scale)
+    ]
+
+
+@scenario
+def cold_clone(ws):
+    """Clone and extract many small repositories into an empty cache. """
+    ws.write_config(_roles(ws, files=200, commits=50))
+
+    def setup():
+        ws.reset()
+
+    return setup, lambda: ws.gilt("overlay", "--jobs", "8")
+
+
+@scenario
+def cold_clone_daemon(ws):
+    """Like `cold_clone`, over the git protocol from a local daemon. """
+    _roles(ws, files=200, commits=50)
+    daemon = fixtures.Daemon(ws.repos_dir).__enter__()
+    ws.cleanups.append(daemon.__exit__)
+    ws.write_config(_roles(ws, url=daemon.url))
+
+    def setup():
+        ws.reset()
+
+    return setup, lambda: ws.gilt("overlay", "--jobs", "8")
+
+
+@scenario
+def warm_noop(ws):
+    """Overlay again when nothing changed upstream. """
+    ws.write_config(_roles(ws, files=200, commits=50))
+    ws.reset()
+    ws.gilt("overlay", "--jobs", "8")
+
+    return lambda: None, lambda: ws.gilt("overlay", "--jobs", "8")
+
+
+@scenario
+def branch_advance(ws):
+    """Overlay after every upstream branch moved forward by a commit. """
+    entries = _roles(ws, files=2000, commits=50)
+    ws.write_config(entries)
+    ws.reset()
+    ws.gilt("overlay", "--jobs", "8")
+
+    def setup():
+        for e in entries:
+            fixtures.advance(e["git"][len("file://") :])
+
+    return setup, lambda: ws.gilt("overlay", "--jobs", "8")
+
+
+@scenario
+def deep_history_tags(ws):
+    """Clone a repository with a deep history and pin many of its tags. """
+    path = ws.repo("history", files=500, commits=2000, tags=500)
+    ws.write_config(
+        [
+            {
+                "git": "file://" + path,
+                "version": "v{}".format(2000 - n),
+                "dst": "roles/history{}/".format(n),
+            }
+            for n in range(10 * ws.scale)
+        ]
+    )
+
+    def setup():
+        ws.reset()
+
+    return setup, lambda: ws.gilt("overlay")
+
+
+@scenario
+def glob_files(ws):
+    """Overlay many wildcard `files` entries out of a large tree. """
+    path = ws.repo("large", files=5000 * ws.scale, commits=1)
+    ws.write_config(
+        [
+            {
+                "git": "file://" + path,
+                "version": "master",
+                "files": [
+                    {
+                        "src": "dir{}/sub{}/file*.txt".format(d, s),
+                        "dst": "files/{}/{}/".format(d, s),
+                    }
+                    for d in range(10)
+                    for s in range(7)
+                ],
+            }
+        ]
+    )
+    ws.reset()
+    ws.gilt("overlay")
+
+    def setup():
+        ws.reset(cache=False)
+
+    return setup, lambda: ws.gilt("overlay")
+
+
+@scenario
+def post_commands(ws):
+    """Run many post commands of otherwise up to date entries. """
+    entries = _roles(ws, files=10, commits=1)
+    for e in entries:
+        e["post_commands"] = ["true"] * 5
+    ws.write_config(entries)
+    ws.reset()
+    ws.gilt("overlay", "--jobs", "8")
+
+    return lambda: None, lambda: ws.gilt("overlay", "--jobs", "8")
+
+
+@scenario(budget=0.3)
+def startup_version(ws):
+    """Start gilt to print its version. """
+    ws.write_config([])
+
+    return lambda: None, lambda: ws.gilt("--version")
+
+
+@scenario(budget=0.3)
+def startup_help(ws):
+    """Start gilt to print the help of a command. """
+    ws.write_config([])
+
+    return lambda: None, lambda: ws.gilt("overlay", "--help")
+
+
+def _time(ws, name, repeat):
+    setup, func = SCENARIOS[name](ws)
+    timings = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def _load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+@click.command()
+@click.option(
+    "--scenario",
+    "-s",
+    "names",
+    multiple=True,
+    type=click.Choice(list(SCENARIOS)),
+    help="Scenario to run, may be repeated.  Default is all of them.",
+)
+@click.option("--repeat", default=3, help="Runs per scenario.  Default 3")
+@click.option("--scale", default=1, help="Size multiplier.  Default 1")
+@click.option(
+    "--tolerance",
+    default=0.25,
+    help="Allowed slowdown over the baseline.  Default 0.25",
+)
+@click.option(
+    "--min-delta",
+    default=0.2,
+    help="Slowdown in seconds always allowed.  Default 0.2",
+)
+@click.option(
+    "--baseline",
+    default=BASELINE,
+    help="Path of the baseline file.  Default benchmark/baseline.json",
+)
+@click.option(
+    "--update-baseline",
+    is_flag=True,
+    help="Record the timings as the new baseline.",
+)
+def main(
+    names, repeat, scale, tolerance, min_delta, baseline, update_baseline
+):
+    """Benchmark gilt overlay and compare against the baseline. """
+    names = names or list(SCENARIOS)
+    baselines = _load_baseline(baseline)
+    key = "scale={}".format(scale)
+    recorded = baselines.setdefault(key, {})
+    regressions = []
+
+    click.echo("{:<20} {:>10} {:>10} {:>8}".format("", "time", "baseline", ""))
+    for name in names:
+        root = tempfile.mkdtemp(prefix="gilt-bench-")
+        ws = Workspace(root, scale)
+        try:
+            elapsed = _time(ws, name, repeat)
+        finally:
+            for cleanup in ws.cleanups:
+                cleanup()
+            shutil.rmtree(root, ignore_errors=True)
+
+        expected = recorded.get(name)
+        status = ""
+        if expected is not None:
+            slower = elapsed - expected
+            if slower > expected * tolerance and slower > min_delta:
+                status = "REGRESSED"
+                regressions.append(name)
+        if name in BUDGETS and elapsed > BUDGETS[name]:
+            status = "OVER BUDGET"
+            regressions.append(name)
+        click.echo(
+            "{:<20} {:>9.3f}s {:>10} {:>8}".format(
+                name,
+                elapsed,
+                "-" if expected is None else "{:.3f}s".format(expected),
+                status,
+            )
+        )
+        if update_baseline:
+            recorded[name] = round(elapsed, 3)
+
+    if update_baseline:
+        with open(baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if regressions:
+        click.echo("Regressed: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,9 +18,36 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-try:
-    import pkg_resources
+import sys
 
-    __version__ = pkg_resources.get_distribution("gilt").version
-except Exception:  # pragma: no cover
-    __version__ = "unknown"
+
+def _get_version():
+    """Look up the version of the installed distribution and return a str.
+
+    :return: str
+    """
+    try:
+        try:
+            from importlib import metadata
+        except ImportError:  # pragma: no cover
+            import pkg_resources
+
+            return pkg_resources.get_distribution("gilt").version
+        return metadata.version("gilt")
+    except Exception:  # pragma: no cover
+        return "unknown"
+
+
+def __getattr__(name):
+    # Looking up the version is slow, so it is only done when asked for.
+    if name == "__version__":
+        globals()["__version__"] = _get_version()
+        return globals()["__version__"]
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name)
+    )
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # Modules can't compute their attributes lazily before Python 3.7.
+    __version__ = _get_version()
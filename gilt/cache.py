@@ -0,0 +1,294 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import collections
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import fasteners
+
+from gilt import config
+from gilt import git
+from gilt import remote
+from gilt import util
+
+# `last_used` is the time the clone was last overlaid from, as recorded by
+# `touch` on its lock file.
+Entry = collections.namedtuple(
+    "Entry", ["path", "lock_file", "size", "last_used"]
+)
+
+# Seconds a parsed config, or the record of a destination or of the tips of
+# a remote, may go unused when no `max_age` is given.
+RECORD_MAX_AGE = 30 * 86400
+
+_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+_SECONDS = {"s": 1, "m": 60, "h": 3600, "": 86400, "d": 86400, "w": 604800}
+
+
+def touch(lock_file):
+    """Record the clone of the lock file as used now and return None.
+
+    :param lock_file: A string containing the path of the clone's lock file.
+    :return: None
+    """
+    try:
+        os.utime(lock_file)
+    except OSError:
+        pass
+
+
+def entries():
+    """List the clones in gilt's cache and return a list of `Entry` objects,
+    least recently used first.
+
+    :return: list
+    """
+    clone_dir = config._get_clone_dir()
+    lock_dir = config._get_lock_dir()
+    result = []
+    for host in _listdir(clone_dir):
+        for name in _listdir(os.path.join(clone_dir, host)):
+            path = os.path.join(clone_dir, host, name)
+            if not os.path.isdir(path) or os.path.islink(path):
+                continue
+            lock_file = os.path.join(lock_dir, host, name)
+            entry = Entry(path, lock_file, _get_size(path), _last_used(path))
+            result.append(entry)
+
+    return sorted(result, key=lambda e: e.last_used)
+
+
+def prune(max_size=None, max_age=None, keep=(), now=None, debug=False):
+    """Evict the least recently used clones from gilt's cache and return a
+    list of the evicted `Entry` objects.
+
+    Clones unused for longer than `max_age` are evicted, then the least
+    recently used ones until the cache fits in `max_size`.  The shared
+    object store counts toward `max_size` but is never evicted, since
+    clones borrow objects from it.  A clone is only evicted under its lock,
+    taken without waiting, so a clone another process is using, or used
+    since it was listed, is kept.  Lock files are kept too: removing one
+    another process has opened would let two processes hold the same lock.
+    Parsed configs, and the records of destinations and of remotes, unused
+    for longer than `max_age`, or `RECORD_MAX_AGE`, are removed as well.
+
+    :param max_size: An optional int containing the bytes the clones and
+     the shared object store may take on disk.
+    :param max_age: An optional float containing the seconds a clone may go
+     unused.
+    :param keep: An optional collection of paths of clones never evicted.
+    :param now: An optional float containing the current time.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    now = time.time() if now is None else now
+    _empty_trash()
+    for directory in (
+        config._get_parse_dir(),
+        config._get_state_dir(),
+        config._get_remote_dir(),
+    ):
+        _expire(directory, RECORD_MAX_AGE if max_age is None else max_age, now)
+    listed = entries()
+    total = sum(e.size for e in listed)
+    if max_size is not None:
+        total += shared_objects_size()
+    evicted = []
+    for e in listed:
+        too_old = max_age is not None and now - e.last_used > max_age
+        too_big = max_size is not None and total > max_size
+        if not (too_old or too_big) or e.path in keep:
+            continue
+        if _evict(e, debug):
+            evicted.append(e)
+            total -= e.size
+
+    return evicted
+
+
+def shared_objects_size():
+    """Return the bytes gilt's shared object store takes on disk.
+
+    :return: int
+    """
+    return _get_size(config._get_objects_dir())
+
+
+def parse_size(value):
+    """Parse a size such as ``500M`` or ``10G`` and return an int of bytes.
+
+    :param value: A string containing a number of bytes, optionally
+     suffixed with K, M, G or T (powers of 1024).
+    :return: int
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", value, re.I)
+    if not match:
+        raise ValueError("Invalid size {}".format(value))
+
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def parse_age(value):
+    """Parse an age such as ``30d`` or ``12h`` and return a float of seconds.
+
+    :param value: A string containing a number of days, or of seconds,
+     minutes, hours, days or weeks suffixed with s, m, h, d or w.
+    :return: float
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$", value, re.I)
+    if not match:
+        raise ValueError("Invalid age {}".format(value))
+
+    return float(match.group(1)) * _SECONDS[match.group(2).lower()]
+
+
+def format_size(size):
+    """Format a number of bytes for humans and return a str.
+
+    :param size: An int containing a number of bytes.
+    :return: str
+    """
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "T"
+
+    return "{:.1f}{}".format(size, unit) if unit != "B" else "{}B".format(size)
+
+
+def _evict(e, debug=False):
+    """Remove a clone under its lock and return whether it was removed.
+
+    The clone is moved out of the way before it is removed, so nothing ever
+    sees it half deleted.
+
+    :param e: An `Entry` object.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    # Taking the lock creates a missing lock file, which isn't a use.
+    existed = os.path.exists(e.lock_file)
+    lock = fasteners.InterProcessReaderWriterLock(e.lock_file)
+    if not lock.acquire_write_lock(blocking=False):
+        if debug:
+            util.print_info("  - keeping {}, in use".format(e.path))
+        return False
+    try:
+        if existed and _last_used(e.path) != e.last_used:
+            return False
+        trash_dir = config._get_trash_dir()
+        os.makedirs(trash_dir, exist_ok=True)
+        trash = tempfile.mkdtemp(dir=trash_dir)
+        os.rename(e.path, os.path.join(trash, "clone"))
+        git.forget_fetches(e.path)
+        git._invalidate_refs(e.path)
+        try:
+            os.unlink(remote._get_remote_file(e.path))
+        except FileNotFoundError:
+            pass
+    finally:
+        lock.release_write_lock()
+    shutil.rmtree(trash, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(e.path))
+    except OSError:
+        pass
+
+    return True
+
+
+def _empty_trash():
+    """Remove what an interrupted eviction left in the trash and return
+    None."""
+    trash_dir = config._get_trash_dir()
+    for name in _listdir(trash_dir):
+        shutil.rmtree(os.path.join(trash_dir, name), ignore_errors=True)
+
+
+def _expire(directory, max_age, now):
+    """Remove the records unused for longer than `max_age` and return None.
+
+    Records are files sharded by the first two digits of their digest, and
+    touched whenever they're used.
+
+    :param directory: A string containing the path of the records.
+    :param max_age: A float containing the seconds a record may go unused.
+    :param now: A float containing the current time.
+    :return: None
+    """
+    for prefix in _listdir(directory):
+        for name in _listdir(os.path.join(directory, prefix)):
+            path = os.path.join(directory, prefix, name)
+            try:
+                if now - os.stat(path).st_mtime > max_age:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+def _last_used(path):
+    """Return the time the clone was last used.
+
+    :param path: A string containing the path of the clone.
+    :return: float
+    """
+    relpath = os.path.relpath(path, config._get_clone_dir())
+    for candidate in (os.path.join(config._get_lock_dir(), relpath), path):
+        try:
+            return os.stat(candidate).st_mtime
+        except OSError:
+            continue
+
+    return 0.0
+
+
+def _get_size(path):
+    """Return the bytes a directory takes on disk, counting each inode once.
+
+    :param path: A string containing the path of the directory.
+    :return: int
+    """
+    seen = set()
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_blocks * 512
+
+    return size
+
+
+def _listdir(path):
+    try:
+        return sorted(os.listdir(path))
+    except OSError:
+        return []
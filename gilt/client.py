@@ -0,0 +1,92 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+# The client is what the ``gilt`` command starts with, so it only imports
+# the standard library, the rest of gilt is imported only when no daemon
+# serves the invocation.
+import json
+import os
+import socket
+import sys
+
+
+def main():
+    """Run gilt through the daemon when one is listening, or else in this
+    process, and exit."""
+    argv = sys.argv[1:]
+    # The daemon serves neither itself nor shell completion.
+    if "daemon" not in argv and not os.environ.get("_GILT_COMPLETE"):
+        code = run(argv)
+        if code is not None:
+            sys.exit(code)
+
+    from gilt import shell
+
+    shell.main()
+
+
+def run(argv, socket_file=None):
+    """Have the daemon run gilt with the given arguments and return its exit
+    code.
+
+    :param argv: A list of strings containing the arguments.
+    :param socket_file: An optional string containing the path of the
+     daemon's socket.
+    :return: int, or None when no daemon is listening.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect(socket_file or get_socket_file())
+        except OSError:
+            return None
+        request = {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+            "tty": sys.stdout.isatty(),
+        }
+        s.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with s.makefile("rb") as stream:
+            for line in stream:
+                message = json.loads(line.decode("utf-8"))
+                if "exit" in message:
+                    return message["exit"]
+                if "out" in message:
+                    sys.stdout.write(message["out"])
+                    sys.stdout.flush()
+                if "err" in message:
+                    sys.stderr.write(message["err"])
+                    sys.stderr.flush()
+    finally:
+        s.close()
+
+    # The daemon went away before the invocation completed.
+    return 1
+
+
+def get_socket_file():
+    """Return the path of the daemon's socket, like
+    `config._get_socket_file` without importing it."""
+    if os.environ.get("GILT_DAEMON_SOCKET"):
+        return os.environ["GILT_DAEMON_SOCKET"]
+    base_dir = os.environ.get("GILT_CACHE_DIRECTORY", "~/.gilt")
+
+    return os.path.join(os.path.expanduser(base_dir), "daemon.sock")
@@ -20,7 +20,12 @@
 
 import collections
 import errno
+import functools
+import hashlib
+import json
 import os
+import re
+import threading
 import urllib.parse
 
 import yaml
@@ -36,40 +41,113 @@ class ParseError(Exception):
 
 BASE_WORKING_DIR = os.environ.get("GILT_CACHE_DIRECTORY", "~/.gilt")
 
-
-def config(filename):
+# Bumped whenever the layout of the parse cache changes.
+PARSE_CACHE_VERSION = 4
+# Set by `_get_config` to the git URL of an entry before interpolation.
+RAW_GIT_KEY = "__raw_git__"
+
+Config = collections.namedtuple(
+    "Config",
+    [
+        "git",
+        "raw_git",
+        "lock_file",
+        "version",
+        "name",
+        "src",
+        "dst",
+        "files",
+        "post_commands",
+        "depth",
+        "filter",
+        "sha",
+    ],
+)
+FilesConfig = collections.namedtuple(
+    "FilesConfig", ["src", "dst", "post_commands"]
+)
+ParsedRepo = collections.namedtuple(
+    "ParsedRepo", ["hostname", "owner", "name"]
+)
+
+# Tags of the plain scalars which are read as text when given as a version.
+_TEXT_TAGS = {
+    "tag:yaml.org,2002:bool",
+    "tag:yaml.org,2002:float",
+    "tag:yaml.org,2002:int",
+    "tag:yaml.org,2002:timestamp",
+}
+
+
+class _Loader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+    """A YAML loader which keeps versions as written, so an unquoted
+    ``version: 1.10`` is the tag 1.10 rather than the float 1.1."""
+
+    def construct_mapping(self, node, deep=False):
+        mapping = super().construct_mapping(node, deep)
+        for key_node, value_node in node.value:
+            if key_node.value != "version":
+                continue
+            if getattr(value_node, "tag", None) in _TEXT_TAGS:
+                mapping["version"] = value_node.value
+
+        return mapping
+
+
+# Parsed configs of this process, keyed like the parse cache.
+_parsed = {}
+
+
+def config(filename, wd=None):
     """Construct `Config` object and return a list.
 
     :parse filename: A string containing the path to YAML file.
+    :param wd: An optional string containing the directory destinations are
+     relative to, defaults to the current one.
     :return: list
     """
-    Config = collections.namedtuple(
-        "Config",
-        [
-            "git",
-            "lock_file",
-            "version",
-            "name",
-            "src",
-            "dst",
-            "files",
-            "post_commands",
-        ],
-    )
+    return [Config(**d) for d in _get_config_generator(filename, wd)]
+
 
-    return [Config(**d) for d in _get_config_generator(filename)]
+def merge(configs):
+    """Combine the `Config` objects of several configs into a single plan
+    and return a list.
 
+    An entry found in more than one config is kept once, where it first
+    appears.  Entries of the same repository share its lock file, so a plan
+    fetches each repository, and resolves each version, once.
 
+    :param configs: A list of lists of `Config` objects.
+    :return: list
+    :raises: ParseError when two entries extract different commits, or
+     repositories, to the same destination.
+    """
+    merged = []
+    seen = set()
+    dsts = {}
+    for entries in configs:
+        for c in entries:
+            key = repr(c)
+            if key in seen:
+                continue
+            seen.add(key)
+            if c.dst:
+                source = (c.git, c.version, c.sha)
+                if dsts.setdefault(c.dst, source) != source:
+                    msg = "Conflicting entries extract to {}".format(c.dst)
+                    raise ParseError(msg)
+            merged.append(c)
+
+    return merged
+
+
+@functools.lru_cache(maxsize=None)
 def _parse_repo_uri(uri, scm="git"):
     """Construct and return a `ParsedRepo` object.
 
     :param uri: A SCM repository URI.
     :return: ParsedRepo
     """
-    ParsedRepo = collections.namedtuple(
-        "ParsedRepo", ["hostname", "owner", "name"]
-    )
-
     scm_ext = "." + scm
     o = urllib.parse.urlparse(uri)
     if not o.hostname:  # scp-style "URI", so fake it
@@ -88,69 +166,110 @@ def _parse_repo_uri(uri, scm="git"):
     return ParsedRepo(o.hostname, owner, name)
 
 
-def _get_files_config(src_dir, files_list):
+def _get_files_config(src_dir, files_list, wd=None):
     """Construct `FileConfig` object and return a list.
 
     :param src_dir: A string containing the source directory.
     :param files_list: A list of dicts containing the src/dst mapping of files
      to overlay.
+    :param wd: An optional string containing the working directory, defaults
+     to the current one.
     :return: list
     """
-    FilesConfig = collections.namedtuple(
-        "FilesConfig", ["src", "dst", "post_commands"]
-    )
-
     return [
-        FilesConfig(**d) for d in _get_files_generator(src_dir, files_list)
+        FilesConfig(**d) for d in _get_files_generator(src_dir, files_list, wd)
     ]
 
 
-def _get_config_generator(filename):
+def _get_config_generator(filename, wd=None):
     """A generator which populates and return a dict.
 
     :parse filename: A string containing the path to YAML file.
+    :param wd: An optional string containing the working directory, defaults
+     to the current one.
     :return: dict
     """
+    # Deferred, mirror imports this module.
+    from gilt import mirror
+
+    wd = wd or os.getcwd()
+    clone_dir = _get_clone_dir()
+    lock_dir = _get_lock_dir()
     for d in _get_config(filename):
         repo = d["git"]
-        parsedrepo = _parse_repo_uri(repo)
+        # Keyed by the upstream URL, whether a mirror or it is given.
+        parsedrepo = _parse_repo_uri(mirror.canonical(repo))
         if parsedrepo.owner:
             name = "{}.{}".format(parsedrepo.owner, parsedrepo.name)
         else:
             name = parsedrepo.name
-        src_dir = os.path.join(_get_clone_dir(), parsedrepo.hostname, name)
+        src_dir = os.path.join(clone_dir, parsedrepo.hostname, name)
         files = d.get("files")
         post_commands = d.get("post_commands", [])
         dst_dir = None
         if not files:
-            dst_dir = _get_dst_dir(d["dst"])
+            dst_dir = _get_dst_dir(d["dst"], wd)
         yield {
             "git": repo,
-            "lock_file": os.path.join(
-                _get_lock_dir(), parsedrepo.hostname, name
-            ),
+            # The URL as written, which keys the lock file, so neither the
+            # values nor the secrets of environment variables are recorded.
+            "raw_git": d.get(RAW_GIT_KEY, repo),
+            "lock_file": os.path.join(lock_dir, parsedrepo.hostname, name),
             "version": d["version"],
             "name": name,
             "src": src_dir,
             "dst": dst_dir,
-            "files": _get_files_config(src_dir, files),
+            "files": _get_files_config(src_dir, files, wd),
             "post_commands": post_commands,
+            "depth": _get_depth(d.get("depth")),
+            "filter": d.get("filter"),
+            # Set to the commit the version is locked to, when frozen.
+            "sha": None,
         }
 
 
-def _get_files_generator(src_dir, files_list):
+def _get_depth(depth):
+    """Validate the history depth of an entry and return an int.
+
+    :param depth: The depth given in the config, or None.
+    :return: int, or None for a full history.
+    """
+    if depth is None:
+        return None
+    if isinstance(depth, bool) or not isinstance(depth, int) or depth < 1:
+        msg = "Error parsing gilt config: depth must be a positive integer"
+        raise ParseError(msg)
+
+    return depth
+
+
+def _get_files_generator(src_dir, files_list, wd=None):
     """A generator which populates and return a dict.
 
     :param src_dir: A string containing the source directory.
     :param files_list: A list of dicts containing the src/dst mapping of files
-     to overlay.
+     to overlay.  A src may be a list of patterns.
+    :param wd: An optional string containing the working directory, defaults
+     to the current one.
     :return: dict
     """
     if files_list:
+        wd = wd or os.getcwd()
         for d in files_list:
+            src = d["src"]
+            if isinstance(src, list):
+                # Patterns prefixed with a '!' exclude what they match.
+                src = tuple(
+                    "!" + os.path.join(src_dir, p[1:])
+                    if p.startswith("!")
+                    else os.path.join(src_dir, p)
+                    for p in src
+                )
+            else:
+                src = os.path.join(src_dir, src)
             yield {
-                "src": os.path.join(src_dir, d["src"]),
-                "dst": _get_dst_dir(d["dst"]),
+                "src": src,
+                "dst": _get_dst_dir(d["dst"], wd),
                 "post_commands": d.get("post_commands", []),
             }
 
@@ -158,32 +277,127 @@ def _get_files_generator(src_dir, files_list):
 def _get_config(filename):
     """Parse the provided YAML file and return a dict.
 
+    Parsed configs are cached on disk and in memory, keyed by the contents
+    of the file and the values of the environment variables it references.
+    The cache is JSON, which loading can't run code from, only readable by
+    its owner, as it holds interpolated values, and a cached config is
+    touched when read so `cache.prune` expires the unused ones.
+
     :parse filename: A string containing the path to YAML file.
     :return: dict
     """
+    with open(filename, "r") as stream:
+        content = stream.read()
+
+    cache_file = _get_parse_cache_file(content)
+    if cache_file in _parsed:
+        return _parsed[cache_file]
+    try:
+        with open(cache_file, "r") as stream:
+            result = json.load(stream)
+        os.utime(cache_file)
+        _parsed[cache_file] = result
+        return result
+    except (OSError, ValueError):
+        pass
+
     i = interpolation.Interpolator(
         interpolation.TemplateWithDefaults, os.environ
     )
+    try:
+        interpolated_config = i.interpolate(content)
+        result = yaml.load(interpolated_config, Loader=_Loader)
+    except yaml.parser.ParserError as e:
+        msg = "Error parsing gilt config: {0}".format(e)
+        raise ParseError(msg)
+    _set_raw_git(result, content)
+
+    _parsed[cache_file] = result
+    try:
+        data = json.dumps(result)
+        _makedirs(cache_file)
+        tmp = _get_temp_file(cache_file)
+        # Only readable by its owner, it holds the values of variables.
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        with os.fdopen(os.open(tmp, flags, 0o600), "w") as stream:
+            stream.write(data)
+        os.replace(tmp, cache_file)
+    except (OSError, TypeError, ValueError):
+        # Configs holding values JSON can't, like dates, aren't cached.
+        pass
 
-    with open(filename, "r") as stream:
-        try:
-            interpolated_config = i.interpolate(stream.read())
-            return yaml.safe_load(interpolated_config)
-        except yaml.parser.ParserError as e:
-            msg = "Error parsing gilt config: {0}".format(e)
-            raise ParseError(msg)
+    return result
+
+
+def _set_raw_git(result, content):
+    """Record the git URL of each entry as written and return None.
+
+    Entries are left alone when the config only parses once interpolated,
+    or its shape changed, and are keyed by their interpolated URL instead.
+
+    :param result: The list of dicts parsed from the interpolated config.
+    :param content: A string containing the raw config.
+    :return: None
+    """
+    if "$" not in content:
+        return
+    try:
+        raw = yaml.load(content, Loader=_Loader)
+    except yaml.YAMLError:
+        return
+    if not isinstance(result, list) or not isinstance(raw, list):
+        return
+    if len(raw) != len(result):
+        return
+    for d, r in zip(result, raw):
+        if isinstance(d, dict) and isinstance(r, dict) and "git" in r:
+            d[RAW_GIT_KEY] = r["git"]
+
+
+def _get_parse_cache_file(content):
+    """Construct the parse cache path of a config's content and return a str.
+
+    :param content: A string containing the raw config.
+    :return: str
+    """
+    h = hashlib.sha256()
+    h.update(str(PARSE_CACHE_VERSION).encode("utf-8"))
+    h.update(content.encode("utf-8"))
+    for name in sorted(_get_variables(content)):
+        value = os.environ.get(name)
+        h.update(repr((name, value)).encode("utf-8"))
+    digest = h.hexdigest()
 
+    return os.path.join(_get_parse_dir(), digest[:2], digest[2:])
 
-def _get_dst_dir(dst_dir):
+
+def _get_variables(content):
+    """Find the environment variables a config references and return a set.
+
+    :param content: A string containing the raw config.
+    :return: set
+    """
+    names = set()
+    pattern = interpolation.TemplateWithDefaults.pattern
+    for mo in pattern.finditer(content):
+        named = mo.group("named") or mo.group("braced")
+        if named:
+            names.add(re.split(r":?-", named, 1)[0])
+
+    return names
+
+
+def _get_dst_dir(dst_dir, wd=None):
     """Prefix the provided string with working directory and return a str.
 
+    The directory isn't created, that is left to whatever writes to it.
+
     :param dst_dir: A string to be prefixed with the working dir.
+    :param wd: An optional string containing the working directory, defaults
+     to the current one.
     :return: str
     """
-    wd = os.getcwd()
-    _makedirs(dst_dir)
-
-    return os.path.join(wd, dst_dir)
+    return os.path.join(wd or os.getcwd(), dst_dir)
 
 
 def _get_base_dir():
@@ -207,6 +421,86 @@ def _get_clone_dir():
     return os.path.join(_get_base_dir(), "clone",)
 
 
+def _get_objects_dir():
+    """Construct gilt's shared object store directory and return a str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "objects",)
+
+
+def _get_parse_dir():
+    """Construct gilt's config parse cache directory and return a str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "parse",)
+
+
+def _get_state_dir():
+    """Construct gilt's state directory and return a str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "state",)
+
+
+def _get_socket_file():
+    """Construct the path of gilt's daemon socket and return a str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "daemon.sock")
+
+
+def _get_remote_dir():
+    """Construct gilt's remote tips directory and return a str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "remote")
+
+
+def _get_trash_dir():
+    """Construct the directory evicted clones are moved to before they are
+    removed and return a str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "trash")
+
+
+def _get_mirrors_file():
+    """Construct the path of the mirror rewrite rules and return a str.
+
+    :return: str
+    """
+    return os.environ.get("GILT_MIRRORS") or os.path.join(
+        _get_base_dir(), "mirrors.yml"
+    )
+
+
+def _get_latency_file():
+    """Construct the path recording the latencies of mirrors and return a
+    str.
+
+    :return: str
+    """
+    return os.path.join(_get_base_dir(), "latency.json")
+
+
+def _get_temp_file(filename):
+    """Construct the path a file is written to before replacing the file,
+    unique to the thread, and return a str.
+
+    :param filename: A string containing the path of the file.
+    :return: str
+    """
+    return "{}.{}.{}.tmp".format(
+        filename, os.getpid(), threading.get_ident()
+    )
+
+
 def _makedirs(path):
     """Create a base directory of the provided path and return None.
 
@@ -0,0 +1,195 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+
+class DaemonError(Exception):
+    """Error raised when the daemon can't listen on its socket."""
+
+    pass
+
+
+def serve(command, socket_file):
+    """Serve invocations of the command on the socket until interrupted and
+    return None.
+
+    The process keeps what it learns in memory across invocations, such as
+    the parsed configs, the ref indexes of the clones and the tree indexes
+    of the commits.  Invocations are served one at a time, in the
+    environment and working directory of the client.
+
+    :param command: A `click.Command` object to invoke.
+    :param socket_file: A string containing the path of the socket.
+    :return: None
+    """
+    server = _make_server(command, socket_file)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_file)
+
+
+def _make_server(command, socket_file):
+    """Listen on the socket and return a `socketserver.UnixStreamServer`.
+
+    A socket left behind by a daemon which is gone is replaced, only the
+    owner may connect.
+
+    :param command: A `click.Command` object to invoke.
+    :param socket_file: A string containing the path of the socket.
+    :return: socketserver.UnixStreamServer
+    """
+    if os.path.exists(socket_file):
+        if _is_listening(socket_file):
+            msg = "A daemon is already listening on {}".format(socket_file)
+            raise DaemonError(msg)
+        os.unlink(socket_file)
+    os.makedirs(os.path.dirname(socket_file), exist_ok=True)
+
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_file, _Handler)
+    finally:
+        os.umask(umask)
+    server.command = command
+
+    return server
+
+
+def _is_listening(socket_file):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_file)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Serve a single invocation.
+
+    The client sends a JSON line with its argv, working directory,
+    environment and whether its output is a terminal.  The output is
+    streamed back as ``{"out": ...}`` and ``{"err": ...}`` JSON lines, and
+    the exit code as a final ``{"exit": ...}`` line.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        code = _invoke(self.server.command, request, self.wfile)
+        _send(self.wfile, {"exit": code})
+
+
+def _invoke(command, request, wfile):
+    """Invoke the command as requested and return its exit code.
+
+    :param command: A `click.Command` object to invoke.
+    :param request: A dict containing the argv, cwd, env and tty of the
+     client.
+    :param wfile: A binary file object the output is streamed to.
+    :return: int
+    """
+    # `click.echo` strips colors unless the client's output is a terminal.
+    tty = request.get("tty", False)
+    stdout = _Stream(wfile, "out", tty)
+    stderr = _Stream(wfile, "err", tty)
+    with _environment(request["cwd"], request["env"]):
+        with _redirected(stdout, stderr):
+            try:
+                command.main(args=request["argv"], prog_name="gilt")
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print(e.code, file=sys.stderr)
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+
+    return 0
+
+
+class _Stream(io.TextIOBase):
+    """A text stream forwarding what is written to the client."""
+
+    def __init__(self, wfile, name, tty=False):
+        self._wfile = wfile
+        self._name = name
+        self._tty = tty
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def isatty(self):
+        return self._tty
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        _send(self._wfile, {self._name: s})
+        return len(s)
+
+
+def _send(wfile, message):
+    wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+    wfile.flush()
+
+
+@contextlib.contextmanager
+def _environment(cwd, env):
+    """Context manager to run in the given working directory and
+    environment."""
+    previous_cwd = os.getcwd()
+    previous_env = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        os.chdir(cwd)
+        yield
+    finally:
+        os.chdir(previous_cwd)
+        os.environ.clear()
+        os.environ.update(previous_env)
+
+
+@contextlib.contextmanager
+def _redirected(stdout, stderr):
+    """Context manager to redirect STDOUT and STDERR."""
+    previous = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = previous
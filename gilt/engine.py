@@ -0,0 +1,602 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+
+import fasteners
+
+from gilt import cache
+from gilt import git
+from gilt import lockfile
+from gilt import trace
+from gilt import util
+
+LOCK_WAIT_REPORT = 0.1
+
+_Context = collections.namedtuple(
+    "_Context",
+    [
+        "semaphore",
+        "failed",
+        "locks",
+        "errors",
+        "buffered",
+        "shared",
+        "lock_timeout",
+        "post_semaphore",
+        "post_timeout",
+        "chains",
+        "lanes",
+        "offline",
+        "remote_ttl",
+        "pins",
+        "debug",
+    ],
+)
+
+CommandResult = collections.namedtuple(
+    "CommandResult",
+    ["command", "cwd", "returncode", "stdout", "stderr", "duration"],
+)
+
+
+class CommandError(Exception):
+    """Error raised when a post command exits non-zero."""
+
+    pass
+
+
+class LockTimeoutError(Exception):
+    """Error raised when a repository's lock isn't acquired in time."""
+
+    pass
+
+
+def run(
+    entries,
+    jobs=1,
+    shared=False,
+    lock_timeout=None,
+    post_jobs=None,
+    post_timeout=None,
+    offline=False,
+    remote_ttl=0,
+    pins=None,
+    debug=False,
+):
+    """Run `overlay` on a new event loop and return its result.
+
+    :param entries: A list of `Config` objects.
+    :param jobs: An optional int containing the number of repositories to
+     overlay concurrently.
+    :param shared: An optional bool to clone through the shared object store.
+    :param lock_timeout: An optional float containing the seconds to wait
+     for a repository's lock, waits forever when None.
+    :param post_jobs: An optional int containing the number of post
+     commands to run concurrently, the number of CPUs when None.
+    :param post_timeout: An optional float containing the seconds a post
+     command may run, unlimited when None.
+    :param offline: An optional bool to never reach the origins, every
+     repository and version must then be available locally.
+    :param remote_ttl: An optional float containing the seconds the tips
+     advertised by an origin are trusted for, once listed.
+    :param pins: An optional dict which is filled with a `lockfile.Pin` of
+     the commit each entry was materialized at, keyed by its git and
+     version.
+    :param debug: An optional bool to toggle debug output.
+    :return: list of (name, exception) tuples of the failed entries.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            overlay(
+                entries,
+                jobs=jobs,
+                shared=shared,
+                lock_timeout=lock_timeout,
+                post_jobs=post_jobs,
+                post_timeout=post_timeout,
+                offline=offline,
+                remote_ttl=remote_ttl,
+                pins=pins,
+                debug=debug,
+            )
+        )
+    finally:
+        loop.close()
+
+
+async def overlay(
+    entries,
+    jobs=1,
+    shared=False,
+    lock_timeout=None,
+    post_jobs=None,
+    post_timeout=None,
+    offline=False,
+    remote_ttl=0,
+    pins=None,
+    debug=False,
+):
+    """Overlay the given entries concurrently and return a list of failures.
+
+    Entries sharing a repository are grouped and overlaid one after the
+    other, so the repository is fetched once and each version is
+    materialized from that fetch.  At most `jobs` repositories and
+    `post_jobs` post commands are in flight at once.  No new entry is
+    started once one has failed; entries which are already running are
+    allowed to finish.  When the coroutine itself is cancelled, every entry
+    is cancelled, their post commands are killed, and the coroutine returns
+    only once each git step in progress has completed.
+
+    :param entries: A list of `Config` objects.
+    :param jobs: An optional int containing the number of repositories to
+     overlay concurrently.
+    :param shared: An optional bool to clone through the shared object store.
+    :param lock_timeout: An optional float containing the seconds to wait
+     for a repository's lock, waits forever when None.
+    :param post_jobs: An optional int containing the number of post
+     commands to run concurrently, the number of CPUs when None.
+    :param post_timeout: An optional float containing the seconds a post
+     command may run, unlimited when None.
+    :param offline: An optional bool to never reach the origins, every
+     repository and version must then be available locally.
+    :param remote_ttl: An optional float containing the seconds the tips
+     advertised by an origin are trusted for, once listed.
+    :param pins: An optional dict which is filled with a `lockfile.Pin` of
+     the commit each entry was materialized at, keyed by its git and
+     version.
+    :param debug: An optional bool to toggle debug output.
+    :return: list of (name, exception) tuples of the failed entries.
+    """
+    git.forget_fetches()
+    ctx = _Context(
+        semaphore=asyncio.Semaphore(jobs),
+        failed=asyncio.Event(),
+        locks={},
+        errors=[],
+        buffered=jobs > 1,
+        shared=shared,
+        lock_timeout=lock_timeout,
+        post_semaphore=asyncio.Semaphore(post_jobs or os.cpu_count() or 1),
+        post_timeout=post_timeout,
+        chains={},
+        lanes={
+            id(c): "{}. {}".format(i, c.name)
+            for i, c in enumerate(entries, 1)
+        },
+        offline=offline,
+        remote_ttl=remote_ttl,
+        pins=pins,
+        debug=debug,
+    )
+    groups = collections.OrderedDict()
+    for c in entries:
+        groups.setdefault(c.lock_file, []).append(c)
+    tasks = [
+        asyncio.ensure_future(_overlay_group(group, ctx))
+        for group in groups.values()
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    failures = dict(ctx.errors)
+
+    return [(c.name, failures[id(c)]) for c in entries if id(c) in failures]
+
+
+async def _overlay_group(group, ctx):
+    """Overlay the `Config` entries of a single repository and return None.
+
+    :param group: A list of `Config` objects sharing a lock file.
+    :param ctx: The `_Context` of the run.
+    :return: None
+    """
+    async with ctx.semaphore:
+        for c in group:
+            if ctx.failed.is_set():
+                return
+            try:
+                await _overlay_entry(c, ctx)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                ctx.failed.set()
+                ctx.errors.append((id(c), e))
+
+
+async def _overlay_entry(c, ctx):
+    """Overlay a single `Config` entry and return None.
+
+    The repository's lock is held while the destinations are written, and
+    released before the post commands run.
+
+    :param c: A `Config` object.
+    :param ctx: The `_Context` of the run.
+    :return: None
+    """
+    output = []
+    buffer = output if ctx.buffered else None
+    lane_name = ctx.lanes[id(c)]
+    lane = trace.lane(lane_name)
+
+    async def step(func, *args):
+        return await _run_step(buffer, trace.bind(lane, func), *args)
+
+    try:
+        with trace.span(c.name, cat="entry", lane_id=lane):
+            await step(util.print_info, "{}:".format(c.name))
+            post_commands = await _materialize_locked(c, ctx, step, lane)
+            # Run post commands if any.
+            await _run_post_commands(post_commands, ctx, buffer, lane_name)
+    finally:
+        if ctx.buffered:
+            util.print_block(output)
+
+
+async def _materialize_locked(c, ctx, step, lane=None):
+    """Materialize the entry under the repository's lock and return a dict
+    of the post commands to run in each destination.
+
+    A pinned version, a tag or commit sha the clone already has, only reads
+    the clone and is materialized under a shared lock, so overlays of other
+    processes reading the same clone don't wait for each other.  Anything
+    else may clone or fetch and takes the lock exclusively.  The time spent
+    waiting for the lock is reported when noticeable.
+
+    :param c: A `Config` object.
+    :param ctx: The `_Context` of the run.
+    :param step: A coroutine function running a blocking step.
+    :param lane: An optional int containing the id of the entry's lane in
+     the trace.
+    :return: dict
+    """
+    waited = 0.0
+    for exclusive in (False, True):
+        start = time.monotonic()
+        mode = "exclusive" if exclusive else "shared"
+        with trace.span("lock wait", lane_id=lane, mode=mode):
+            held = await _acquire(
+                ctx.locks, c.lock_file, exclusive, ctx.lock_timeout
+            )
+        waited += time.monotonic() - start
+        try:
+            if not exclusive:
+                pinned = await step(
+                    git.is_pinned, c.src, c.version, c.sha, ctx.debug
+                )
+                if not pinned:
+                    continue
+            post_commands = await step(_materialize, c, ctx)
+            break
+        finally:
+            _release(*held)
+    if ctx.debug or waited >= LOCK_WAIT_REPORT:
+        msg = "  - waited {:.2f}s for the lock".format(waited)
+        await step(util.print_info, msg)
+
+    return post_commands
+
+
+def _materialize(c, ctx):
+    """Bring the entry's clone up to date, write its destinations and return
+    a dict of the post commands to run in each of them.
+
+    :param c: A `Config` object.
+    :param ctx: The `_Context` of the run.
+    :return: dict
+    """
+    cache.touch(c.lock_file)
+    if not os.path.exists(c.src):
+        if ctx.offline:
+            msg = "Unable to clone {} to {} while offline".format(c.git, c.src)
+            raise git.OfflineError(msg)
+        git.clone(
+            c.name,
+            c.git,
+            c.src,
+            shared=ctx.shared,
+            depth=c.depth,
+            filter=c.filter,
+            debug=ctx.debug,
+        )
+    kwargs = {
+        "depth": c.depth,
+        "offline": ctx.offline,
+        "remote_ttl": ctx.remote_ttl,
+        "sha": c.sha,
+        "debug": ctx.debug,
+    }
+    if c.dst:
+        sha = git.extract(c.src, c.dst, c.version, **kwargs)
+        post_commands = {c.dst: c.post_commands}
+    else:
+        sha = git.overlay(c.src, c.files, c.version, **kwargs)
+        post_commands = {conf.dst: conf.post_commands for conf in c.files}
+    if ctx.pins is not None:
+        tree = git.get_tree(c.src, sha, ctx.debug)
+        pin = lockfile.Pin(*lockfile.key(c), sha, tree)
+        ctx.pins[lockfile.key(c)] = pin
+
+    return post_commands
+
+
+async def _run_step(output, func, *args):
+    """Run a blocking step in a worker thread and return its result.
+
+    The step's output is appended to `output`, or printed right away when it
+    is None.  A step can't be interrupted once started, so cancellation
+    waits for the step to complete before it takes effect.
+    """
+    if output is not None:
+        func = functools.partial(_captured, output, func)
+    future = asyncio.get_event_loop().run_in_executor(None, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+def _captured(output, func, *args):
+    with util.captured_output() as captured:
+        try:
+            return func(*args)
+        finally:
+            output.extend(captured)
+
+
+def _attach_child_watcher(loop):
+    """Attach the child watcher to the loop running a post command and
+    return None.
+
+    Before Python 3.8, subprocesses are reaped by a child watcher which only
+    serves the loop it is attached to, by default the main thread's default
+    loop rather than the one `run` creates.
+
+    :param loop: An `asyncio.AbstractEventLoop` object.
+    :return: None
+    """
+    if sys.version_info >= (3, 8) or sys.platform == "win32":
+        return
+    if threading.current_thread() is threading.main_thread():
+        asyncio.get_child_watcher().attach_loop(loop)
+
+
+async def _acquire(locks, lock_file, exclusive=True, timeout=None):
+    """Acquire the entry's lock and return the locks held.
+
+    Entries of this process queue on an `asyncio.Lock`, other processes are
+    kept out with a `fasteners.InterProcessReaderWriterLock` acquired off
+    the loop, exclusively or shared.
+
+    :param locks: A dict of `asyncio.Lock` objects keyed by lock file.
+    :param lock_file: A string containing the path of the lock file.
+    :param exclusive: An optional bool to take the lock exclusively rather
+     than shared.
+    :param timeout: An optional float containing the seconds to wait for the
+     lock, waits forever when None.
+    :return: tuple
+    """
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    lock = locks.setdefault(lock_file, asyncio.Lock())
+    msg = "Timed out waiting for lock {}".format(lock_file)
+    try:
+        await asyncio.wait_for(lock.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise LockTimeoutError(msg)
+    process_lock = fasteners.InterProcessReaderWriterLock(lock_file)
+    if exclusive:
+        acquire = process_lock.acquire_write_lock
+        release = process_lock.release_write_lock
+    else:
+        acquire = process_lock.acquire_read_lock
+        release = process_lock.release_read_lock
+    if timeout is not None:
+        acquire = functools.partial(
+            acquire, timeout=max(0, deadline - time.monotonic())
+        )
+    acquired = False
+
+    def acquire_process_lock():
+        nonlocal acquired
+        acquired = acquire()
+        return acquired
+
+    try:
+        # A cancelled step completes first, so `acquired` tells whether the
+        # process lock ended up held.
+        await _run_step(None, acquire_process_lock)
+        if not acquired:
+            raise LockTimeoutError(msg)
+    except BaseException:
+        try:
+            if acquired:
+                release()
+        finally:
+            lock.release()
+        raise
+
+    return lock, release
+
+
+def _release(lock, release):
+    release()
+    lock.release()
+
+
+async def _run_post_commands(post_commands, ctx, output, lane_name=""):
+    """Run the post commands of an entry and return a list of
+    `CommandResult` objects.
+
+    Commands of different destinations run concurrently, commands of the
+    same destination run one after the other, also across entries.  Every
+    destination runs to completion even when another one fails, the first
+    failure is raised afterwards.
+
+    :param post_commands: A dict of the lists of commands to run in each
+     destination.
+    :param ctx: The `_Context` of the run.
+    :param output: A list the entry's output is appended to, or None to
+     print it right away.
+    :param lane_name: An optional string containing the name of the
+     entry's lane in the trace.
+    :return: list
+    """
+    chains = [
+        _run_chain(dst, commands, ctx, output, lane_name)
+        for dst, commands in post_commands.items()
+        if commands
+    ]
+    results = []
+    failures = []
+    for result in await asyncio.gather(*chains, return_exceptions=True):
+        if isinstance(result, BaseException):
+            failures.append(result)
+        else:
+            results.extend(result)
+    if failures:
+        raise failures[0]
+
+    return results
+
+
+async def _run_chain(dst, commands, ctx, output, lane_name=""):
+    """Run the commands of a destination in order, once the commands
+    scheduled earlier for the same destination are done, and return a list
+    of `CommandResult` objects.
+
+    :param dst: A string containing the destination to run the commands in.
+    :param commands: A list of strings containing the commands.
+    :param ctx: The `_Context` of the run.
+    :param output: A list the entry's output is appended to, or None to
+     print it right away.
+    :param lane_name: An optional string containing the name of the
+     entry's lane in the trace.
+    :return: list
+    """
+    lane = trace.lane("{}: {}".format(lane_name, dst))
+    key = os.path.realpath(dst)
+    previous = ctx.chains.get(key)
+    done = asyncio.get_event_loop().create_future()
+    ctx.chains[key] = done
+    try:
+        if previous is not None:
+            with trace.span("destination wait", lane_id=lane):
+                await asyncio.wait([previous])
+        results = []
+        for command in commands:
+            async with ctx.post_semaphore:
+                msg = "  - running `{}` in {}".format(command, dst)
+                await _run_step(output, util.print_info, msg)
+                with trace.span(
+                    "post command", lane_id=lane, command=command, cwd=dst
+                ):
+                    result = await _run_command(
+                        command, dst, output, ctx.post_timeout, ctx.debug
+                    )
+            results.append(result)
+
+        return results
+    finally:
+        done.set_result(None)
+        if ctx.chains.get(key) is done:
+            del ctx.chains[key]
+
+
+async def _run_command(command, cwd, output=None, timeout=None, debug=False):
+    """Run a post command as a subprocess of the loop and return a
+    `CommandResult`.
+
+    The command is split on whitespace like `util.build_sh_cmd`, its output
+    is captured, and it is killed if the calling task is cancelled or the
+    timeout expires.
+
+    :param command: A string containing the command to run.
+    :param cwd: A string containing the working directory of the command.
+    :param output: An optional list the debug output is appended to.
+    :param timeout: An optional float containing the seconds the command
+     may run, unlimited when None.
+    :param debug: An optional bool to toggle debug output.
+    :return: CommandResult
+    """
+    args = command.split()
+    if debug:
+        for msg in ("  PWD: {}".format(cwd), "  COMMAND: {}".format(command)):
+            await _run_step(output, util.print_warn, msg)
+    _attach_child_watcher(asyncio.get_event_loop())
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        msg = "`{}` in {} timed out after {:.2f}s".format(
+            command, cwd, time.monotonic() - start
+        )
+        raise CommandError(msg)
+    result = CommandResult(
+        command=command,
+        cwd=cwd,
+        returncode=proc.returncode,
+        stdout=stdout.decode(errors="replace"),
+        stderr=stderr.decode(errors="replace"),
+        duration=time.monotonic() - start,
+    )
+    if debug:
+        msgs = ["  DURATION: {:.2f}s".format(result.duration)]
+        for name, text in (
+            ("STDOUT", result.stdout),
+            ("STDERR", result.stderr),
+        ):
+            msgs += [
+                "  {}: {}".format(name, line) for line in text.splitlines()
+            ]
+        for msg in msgs:
+            await _run_step(output, util.print_warn, msg)
+    if result.returncode != 0:
+        msg = "`{}` in {} exited {} after {:.2f}s\n{}".format(
+            command, cwd, result.returncode, result.duration, result.stderr
+        )
+        raise CommandError(msg)
+
+    return result
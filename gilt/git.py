@@ -18,33 +18,177 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 
-import glob
+import collections
+import errno
+import fnmatch
+import hashlib
 import os
 import shutil
+import tarfile
+import threading
 
 import sh
 
+from gilt import config
+from gilt import mirror
+from gilt import reader
+from gilt import remote
+from gilt import state
+from gilt import trace
 from gilt import util
 
+Ref = collections.namedtuple("Ref", ["kind", "sha"])
+TreeEntry = collections.namedtuple("TreeEntry", ["mode", "kind", "sha"])
+# `files` maps each path a destination holds to its `TreeEntry`, and `root`
+# is the directory it holds entirely, if any.
+Target = collections.namedtuple("Target", ["key", "files", "root"])
 
-def clone(name, repository, destination, debug=False):
+# Number of tree indexes kept in memory.
+TREE_CACHE_SIZE = 8
+# Blobs larger than this are streamed from git rather than read in process.
+INLINE_BLOB_SIZE = 16 * 1024 * 1024
+
+_refs = {}
+_ref_stamps = {}
+_checked = set()
+_commits = {}
+_fetched = set()
+_trees = collections.OrderedDict()
+_trees_lock = threading.Lock()
+_tree_ids = {}
+_readers = {}
+
+
+class NotFoundError(Exception):
+    """Error raised when a version can't be found in a repository."""
+
+    pass
+
+
+class OfflineError(Exception):
+    """Error raised when the network is needed while offline."""
+
+    pass
+
+
+@trace.traced("clone")
+def clone(
+    name,
+    repository,
+    destination,
+    shared=False,
+    depth=None,
+    filter=None,
+    debug=False,
+):
     """Clone the specified repository into a temporary directory and return None.
 
+    The clone is bare, gilt only ever reads from its object database.  Its
+    branches are tracked as ``refs/remotes/origin/*`` like in a regular
+    clone.  It is made through the repository's mirrors, but its origin is
+    the upstream URL.
+
     :param name: A string containing the name of the repository being cloned.
     :param repository: A string containing the repository to clone.
     :param destination: A string containing the directory to clone the
      repository into.
+    :param shared: An optional bool to borrow objects from gilt's shared
+     object store instead of keeping a full copy in the clone.
+    :param depth: An optional int to truncate the history of the clone to
+     the given number of commits.
+    :param filter: An optional string containing a partial clone filter
+     spec, such as ``blob:none`` or ``tree:0``.
     :param debug: An optional bool to toggle debug output.
     :return: None
     """
     msg = "  - cloning {} to {}".format(name, destination)
     util.print_info(msg)
-    cmd = sh.git.bake("clone", repository, destination)
-    util.run_command(cmd, debug=debug)
+    repository = mirror.canonical(repository)
+    args = []
+    if shared:
+        args += ["--reference", _update_shared_objects(repository, debug)]
+    if depth:
+        # Keep every branch reachable, not just the default one.
+        args += ["--depth", str(depth), "--no-single-branch"]
+    if filter:
+        args += ["--filter", filter]
+    args = [
+        "clone",
+        "--bare",
+        "--config",
+        "remote.origin.fetch=+refs/heads/*:refs/remotes/origin/*",
+        *args,
+        repository,
+        destination,
+    ]
+    mirror.run(repository, args, debug=debug)
+    # A fresh clone is as current as a fetch.
+    _fetched.add(destination)
+
 
+@trace.traced("shared objects")
+def _update_shared_objects(repository, debug=False):
+    """Fetch the repository into gilt's shared object store and return its
+    path.
 
-def extract(repository, destination, version, debug=False):
-    """Extract the specified repository/version into the directory and return None.
+    Clones made with ``--reference`` list the store in their
+    ``objects/info/alternates`` and don't hold a copy of these objects, so
+    the store must never lose one.  Every repository fetched into it keeps
+    its refs under its own ``refs/gilt/<digest>/`` namespace which is never
+    rewritten, so each object stays reachable, and automatic gc and pruning
+    are disabled in the store as a second line of defence.
+
+    :param repository: A string containing the repository to fetch.
+    :param debug: An optional bool to toggle debug output.
+    :return: str
+    """
+    objects_dir = config._get_objects_dir()
+    with util.lock(objects_dir + ".lock"):
+        if not os.path.isdir(objects_dir):
+            cmd = sh.git.bake("init", "--bare", "--quiet", objects_dir)
+            util.run_command(cmd, debug=debug)
+            for key, value in (
+                ("gc.auto", "0"),
+                ("gc.pruneExpire", "never"),
+                ("gc.reflogExpireUnreachable", "never"),
+                ("core.logAllRefUpdates", "false"),
+            ):
+                cmd = sh.git.bake("config", key, value, _cwd=objects_dir)
+                util.run_command(cmd, debug=debug)
+
+        repository = mirror.canonical(repository)
+        namespace = "refs/gilt/{}".format(
+            hashlib.sha1(repository.encode("utf-8")).hexdigest()
+        )
+        args = [
+            "fetch",
+            "--quiet",
+            "--no-tags",
+            repository,
+            "+refs/heads/*:{}/heads/*".format(namespace),
+            "+refs/tags/*:{}/tags/*".format(namespace),
+        ]
+        mirror.run(repository, args, objects_dir, debug)
+
+    return objects_dir
+
+
+@trace.traced("extract")
+def extract(
+    repository,
+    destination,
+    version,
+    depth=None,
+    offline=False,
+    remote_ttl=0,
+    sha=None,
+    debug=False,
+):
+    """Extract the specified repository/version into the directory and return
+    the commit sha it was extracted at.
+
+    The tree is written straight from the object database of the
+    repository, its working tree (if any) is never touched.
 
     :param repository: A string containing the path to the repository to be
      extracted.
@@ -52,133 +196,1391 @@ def extract(repository, destination, version, debug=False):
      repository into.  Relative to the directory ``gilt`` is running
      in. Must end with a '/'.
     :param version: A string containing the branch/tag/sha to be exported.
+    :param depth: An optional int containing the history depth to keep
+     when fetching into a shallow clone.
+    :param offline: An optional bool to never reach the origin.
+    :param remote_ttl: An optional float containing the seconds the tips
+     advertised by the origin are trusted for, once listed.
+    :param sha: An optional string containing the commit sha the version is
+     locked to, which is extracted without resolving the version.
     :param debug: An optional bool to toggle debug output.
-    :return: None
+    :return: str
     """
-    with util.saved_cwd():
+    ref = _get_ref(
+        repository,
+        [destination],
+        version,
+        depth,
+        offline,
+        remote_ttl,
+        sha,
+        debug,
+    )
+    if state.is_current(destination, repository, ref.sha):
+        msg = "  - skipping ({}) {}, already at {}".format(
+            version, destination, ref.sha[:7]
+        )
+        util.print_info(msg)
+        return ref.sha
+
+    previous = state.get(destination)
+    state.delete(destination)
+    files = None
+    if _is_pristine(destination, repository, previous):
+        try:
+            files = _update(repository, destination, previous, ref.sha, debug)
+            msg = "  - updating ({}) {} from {} to {}".format(
+                version, destination, previous.sha[:7], ref.sha[:7]
+            )
+        except (sh.ErrorReturnCode, ValueError):
+            files = None
+    if files is None:
         if os.path.isdir(destination):
             shutil.rmtree(destination)
-
-        os.chdir(repository)
-        _get_version(version, debug)
-        cmd = sh.git.bake(
-            "checkout-index", force=True, all=True, prefix=destination
-        )
-        util.run_command(cmd, debug=debug)
+        os.makedirs(destination)
+        files = _archive(repository, ref.sha, "", destination, debug)
         msg = "  - extracting ({}) {} to {}".format(
             version, repository, destination
         )
-        util.print_info(msg)
 
+    state.put(destination, state.State(repository, ref.sha, state.stat(files)))
+    util.print_info(msg)
+
+    return ref.sha
 
-def overlay(repository, files, version, debug=False):
-    """Overlay files from repository/version into the directory and return None.
+
+@trace.traced("overlay")
+def overlay(
+    repository,
+    files,
+    version,
+    depth=None,
+    offline=False,
+    remote_ttl=0,
+    sha=None,
+    debug=False,
+):
+    """Overlay files from repository/version into the directory and return
+    the commit sha they were copied from.
 
     :param repository: A string containing the path to the repository to be
      extracted.
     :param files: A list of `FileConfig` objects.
     :param version: A string containing the branch/tag/sha to be exported.
+    :param depth: An optional int containing the history depth to keep
+     when fetching into a shallow clone.
+    :param offline: An optional bool to never reach the origin.
+    :param remote_ttl: An optional float containing the seconds the tips
+     advertised by the origin are trusted for, once listed.
+    :param sha: An optional string containing the commit sha the version is
+     locked to, which is copied from without resolving the version.
     :param debug: An optional bool to toggle debug output.
-    :return: None
+    :return: str
     """
-    with util.saved_cwd():
-        os.chdir(repository)
-        _get_version(version, debug)
-
-        for fc in files:
-            if "*" in fc.src:
-                for filename in glob.glob(fc.src):
-                    util.copy(filename, fc.dst)
-                    msg = "  - copied ({}) {} to {}".format(
-                        version, filename, fc.dst
-                    )
-                    util.print_info(msg)
-            else:
-                if os.path.isdir(fc.dst) and os.path.isdir(fc.src):
-                    shutil.rmtree(fc.dst)
-                util.copy(fc.src, fc.dst)
-                msg = "  - copied ({}) {} to {}".format(
-                    version, fc.src, fc.dst
+    keys = [_get_key(fc) for fc in files]
+    ref = _get_ref(
+        repository, keys, version, depth, offline, remote_ttl, sha, debug
+    )
+
+    tree = None
+    for fc, key in zip(files, keys):
+        patterns = _get_patterns(fc)
+        if state.is_current(key, repository, ref.sha):
+            msg = "  - skipping ({}) {}, already at {}".format(
+                version, ", ".join(patterns), ref.sha[:7]
+            )
+            util.print_info(msg)
+            continue
+
+        if tree is None:
+            tree = _ls_tree(repository, ref.sha, debug)
+        state.delete(key)
+        config._makedirs(fc.dst)
+        if not _is_literal(patterns):
+            copied = _overlay_matches(
+                repository, tree, patterns, fc.dst, debug
+            )
+            msg = "  - copied ({}) {} files matching {} to {}".format(
+                version, len(copied), ", ".join(patterns), fc.dst
+            )
+            util.print_info(msg)
+        else:
+            path = os.path.relpath(patterns[0], repository)
+            if path not in tree:
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), patterns[0]
                 )
-                util.print_info(msg)
+            if os.path.isdir(fc.dst) and tree[path].kind == "tree":
+                shutil.rmtree(fc.dst)
+            copied = _copy(repository, ref.sha, tree, path, fc.dst, debug)
+            msg = "  - copied ({}) {} to {}".format(
+                version, patterns[0], fc.dst
+            )
+            util.print_info(msg)
+        state.put(key, state.State(repository, ref.sha, state.stat(copied)))
 
+    return ref.sha
 
-def _get_version(version, debug=False):
-    """Handle switching to the specified version and return None.
 
-    1. Fetch the origin.
-    2. Checkout the specified version.
-    3. Clean the repository before we begin.
-    4. Pull the origin when a branch; _not_ a commit id.
+def get_targets(repository, sha, c, debug=False):
+    """Map every file the entry materializes from the commit and return a
+    list of `Target` objects, one per destination of the entry.
 
-    :param version: A string containing the branch/tag/sha to be exported.
+    Follows `extract` and `overlay`, without writing anything.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id.
+    :param c: A `Config` object.
     :param debug: An optional bool to toggle debug output.
-    :return: None
+    :return: list
     """
-    if not any(
-        (
-            _has_branch(version, debug),
-            _has_tag(version, debug),
-            _has_commit(version, debug),
-        )
-    ):
-        cmd = sh.git.bake("fetch")
-        util.run_command(cmd, debug=debug)
-    cmd = sh.git.bake("checkout", version)
-    util.run_command(cmd, debug=debug)
-    cmd = sh.git.bake("clean", "-d", "-x", "-f")
-    util.run_command(cmd, debug=debug)
-    if _has_branch(version, debug):
-        cmd = sh.git.bake("pull", rebase=True, ff_only=True)
-        util.run_command(cmd, debug=debug)
+    tree = _ls_tree(repository, sha, debug)
+    if c.dst:
+        files = {
+            os.path.join(c.dst, path): entry
+            for path, entry in tree.items()
+            if entry.kind == "blob"
+        }
+        return [Target(c.dst, files, c.dst)]
+
+    targets = []
+    for fc in c.files:
+        patterns = _get_patterns(fc)
+        root = None
+        if not _is_literal(patterns):
+            relative = []
+            for pattern in patterns:
+                negated = pattern.startswith("!")
+                path = os.path.relpath(pattern.lstrip("!"), repository)
+                relative.append("!" + path if negated else path)
+            files = {
+                os.path.join(fc.dst, relpath): tree[path]
+                for relpath, path in _select(tree, relative).items()
+            }
+        else:
+            path = os.path.relpath(patterns[0], repository)
+            if path not in tree:
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), patterns[0]
+                )
+            if tree[path].kind == "tree":
+                root = fc.dst
+                files = {
+                    os.path.join(fc.dst, name[len(path) + 1 :]): entry
+                    for name, entry in tree.items()
+                    if name.startswith(path + "/") and entry.kind == "blob"
+                }
+            else:
+                target = fc.dst
+                if os.path.isdir(fc.dst):
+                    target = os.path.join(fc.dst, os.path.basename(path))
+                files = {target: tree[path]}
+        targets.append(Target(_get_key(fc), files, root))
+
+    return targets
+
+
+def _get_key(fc):
+    """Return the string identifying the state of a `FilesConfig` object.
+
+    :param fc: A `FilesConfig` object.
+    :return: str
+    """
+    return "\0".join(_get_patterns(fc) + [fc.dst])
+
+
+def _get_patterns(fc):
+    """Return a list of the source patterns of a `FilesConfig` object.
+
+    :param fc: A `FilesConfig` object.
+    :return: list
+    """
+    if isinstance(fc.src, str):
+        return [fc.src]
+
+    return list(fc.src)
 
 
-def _has_commit(version, debug=False):
-    """Determine a version is a local git commit sha or not.
+def _is_literal(patterns):
+    """Determine whether the patterns name a single path and return a bool.
 
-    :param version: A string containing the branch/tag/sha to be determined.
+    :param patterns: A list of strings containing the source patterns.
+    :return: bool
+    """
+    if len(patterns) > 1:
+        return False
+
+    return not _has_magic(patterns[0]) and not patterns[0].startswith("!")
+
+
+def _has_magic(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def _overlay_matches(repository, tree, patterns, dst, debug=False):
+    """Write the files of the tree matching the patterns below dst and
+    return a list of the files which were written.
+
+    Every matched blob is written straight from the object database, see
+    `_write_blobs`.
+
+    :param repository: A string containing the path to the repository.
+    :param tree: A dict mapping the paths of the tree to `TreeEntry` objects.
+    :param patterns: A list of strings containing the absolute patterns, in
+     the clone, which are matched, or excluded when prefixed with a '!'.
+    :param dst: A string containing the path to the destination directory.
     :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    relative = []
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        path = os.path.relpath(pattern.lstrip("!"), repository)
+        relative.append("!" + path if negated else path)
+    blobs = [
+        (os.path.join(dst, relpath), tree[path].mode, tree[path].sha)
+        for relpath, path in _select(tree, relative).items()
+    ]
+    _write_blobs(repository, blobs, debug)
+
+    return [filename for filename, _, _ in blobs]
+
+
+def _is_pristine(destination, repository, previous):
+    """Determine whether the destination holds exactly what was last
+    extracted into it or not.
+
+    Every recorded file must be unchanged, and no file may have been added.
+
+    :param destination: A string containing the extracted directory.
+    :param repository: A string containing the path to the repository.
+    :param previous: The `State` recorded for the destination, or None.
     :return: bool
     """
-    if _has_tag(version, debug) or _has_branch(version, debug):
+    if previous is None or previous.repository != repository:
         return False
-    cmd = sh.git.bake("cat-file", "-e", version)
-    try:
-        util.run_command(cmd, debug=debug)
-        return True
-    except sh.ErrorReturnCode:
+    if not state.is_unmodified(previous):
         return False
+    for root, dirs, files in os.walk(destination):
+        for name in files:
+            if os.path.join(root, name) not in previous.files:
+                return False
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path) and path not in previous.files:
+                return False
+
+    return True
+
 
+def _update(repository, destination, previous, sha, debug=False):
+    """Apply the changes between the previously extracted commit and sha to
+    the destination and return a list of the files it now holds.
 
-def _has_tag(version, debug=False):
-    """Determine a version is a local git tag name or not.
+    Renames are applied as a deletion and an addition.
 
-    :param version: A string containing the branch/tag/sha to be determined.
+    :param repository: A string containing the path to the repository.
+    :param destination: A string containing the extracted directory.
+    :param previous: The `State` recorded for the destination.
+    :param sha: A string containing the commit id to update to.
     :param debug: An optional bool to toggle debug output.
-    :return: bool
+    :return: list
+    """
+    deleted = []
+    written = []
+    changes = _diff(repository, previous.sha, sha, debug)
+    for status, mode, blob, path in changes:
+        filename = os.path.join(destination, path)
+        if status in ("D", "T") or mode == "160000":
+            deleted.append(filename)
+        if status != "D" and mode != "160000":
+            written.append((filename, mode, blob))
+
+    files = set(previous.files)
+    for filename in deleted:
+        if os.path.lexists(filename):
+            os.unlink(filename)
+            _remove_empty_dirs(os.path.dirname(filename), destination)
+        files.discard(filename)
+    _write_blobs(repository, written, debug)
+    files.update(filename for filename, _, _ in written)
+
+    return sorted(files)
+
+
+def _diff(repository, old, new, debug=False):
+    """Compare the trees of two commits and return a list of the changed
+    files as (status, new mode, new blob sha, path) tuples, like ``git
+    diff-tree -r --no-renames`` reports them.
+
+    :param repository: A string containing the path to the repository.
+    :param old: A string containing the commit id to compare from.
+    :param new: A string containing the commit id to compare to.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
     """
+    if _get_reader(repository) is not None:
+        return _diff_tree_indexes(
+            _ls_tree(repository, old, debug), _ls_tree(repository, new, debug)
+        )
+
     cmd = sh.git.bake(
-        "show-ref", "--verify", "--quiet", "refs/tags/{}".format(version)
+        "diff-tree",
+        "-r",
+        "-z",
+        "--no-renames",
+        old,
+        new,
+        _cwd=repository,
     )
+    output = str(util.run_command(cmd, debug=debug)).split("\0")
+    changes = []
+    for header, path in zip(output[0::2], output[1::2]):
+        _, mode, _, blob, status = header.split(" ")
+        changes.append((status, mode, blob, path))
+
+    return changes
+
+
+def _diff_tree_indexes(old, new):
+    """Compare two tree indexes and return a list like `_diff` does.
+
+    :param old: A dict mapping the paths of a tree to `TreeEntry` objects.
+    :param new: A dict mapping the paths of a tree to `TreeEntry` objects.
+    :return: list
+    """
+    changes = []
+    for path in sorted(set(old) | set(new)):
+        a = old.get(path)
+        b = new.get(path)
+        a = None if a is None or a.kind == "tree" else a
+        b = None if b is None or b.kind == "tree" else b
+        if a == b:
+            continue
+        if b is None:
+            changes.append(("D", "000000", "0" * 40, path))
+            continue
+        if a is None:
+            status = "A"
+        elif (a.kind, a.mode == "120000") != (b.kind, b.mode == "120000"):
+            status = "T"
+        else:
+            status = "M"
+        changes.append((status, b.mode, b.sha, path))
+
+    return changes
+
+
+@trace.traced("write blobs")
+def _write_blobs(repository, blobs, debug=False):
+    """Write the given blobs from the object database and return None.
+
+    Blobs are read in process, and those which can't be, or are too large
+    to be held in memory, are streamed from git.
+
+    :param repository: A string containing the path to the repository.
+    :param blobs: A list of (filename, mode, blob sha) tuples.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    r = _get_reader(repository)
+    remaining = []
+    for filename, mode, blob in blobs:
+        data = None
+        if r is not None:
+            try:
+                header = r.read_header(blob)
+                if header is not None and header[1] <= INLINE_BLOB_SIZE:
+                    data = r.read(blob)[1]
+            except reader.ERRORS:
+                data = None
+        if data is None:
+            remaining.append((filename, mode, blob))
+            continue
+
+        _prepare(filename)
+        if mode == "120000":
+            os.symlink(data.decode(), filename)
+        else:
+            with _create(filename, mode) as f:
+                f.write(data)
+    _cat_blobs(repository, remaining, debug)
+
+
+@trace.traced("git cat-file", cat="command")
+def _cat_blobs(repository, blobs, debug=False):
+    """Write the given blobs through git and return None.
+
+    All of them are read through a single ``git cat-file --batch``, which is
+    streamed through a pipe, so no more than a chunk of a blob is ever held
+    in memory.
+
+    :param repository: A string containing the path to the repository.
+    :param blobs: A list of (filename, mode, blob sha) tuples.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    if not blobs:
+        return
+    r, w = os.pipe()
     try:
-        util.run_command(cmd, debug=debug)
-        return True
-    except sh.ErrorReturnCode:
+        cmd = sh.git.bake(
+            "cat-file",
+            "--batch",
+            _cwd=repository,
+            _in="".join("{}\n".format(blob) for _, _, blob in blobs),
+            _out=w,
+            _bg=True,
+        )
+        p = util.run_command(cmd, debug=debug)
+    finally:
+        os.close(w)
+    with os.fdopen(r, "rb") as stream:
+        for filename, mode, blob in blobs:
+            header = stream.readline().decode().split(" ")
+            if len(header) != 3 or header[0] != blob:
+                raise ValueError("Unable to read blob {}".format(blob))
+            size = int(header[2])
+
+            _prepare(filename)
+            if mode == "120000":
+                os.symlink(stream.read(size).decode(), filename)
+            else:
+                with _create(filename, mode) as f:
+                    _copy_exactly(stream, f, size)
+            stream.read(1)
+    p.wait()
+
+
+def _prepare(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if os.path.lexists(filename):
+        os.unlink(filename)
+
+
+def _create(filename, mode):
+    perm = 0o777 if mode == "100755" else 0o666
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, perm)
+
+    return os.fdopen(fd, "wb")
+
+
+def _copy_exactly(fsrc, fdst, size):
+    while size:
+        chunk = fsrc.read(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError("Unexpected end of stream")
+        fdst.write(chunk)
+        size -= len(chunk)
+
+
+def _remove_empty_dirs(path, top):
+    """Remove path and its parents up to top while they are empty and return
+    None.
+
+    :param path: A string containing the directory to start from.
+    :param top: A string containing the directory which is never removed.
+    :return: None
+    """
+    top = os.path.normpath(top)
+    path = os.path.normpath(path)
+    while path != top and path.startswith(top + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            return
+        path = os.path.dirname(path)
+
+
+def _copy(repository, sha, tree, path, dst, debug=False):
+    """Copy path of the tree at sha to dst and return a list of the files
+    which were written.
+
+    Follows `util.copy`, a file copied to an existing directory lands inside
+    of it.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id to copy from.
+    :param tree: A dict mapping the paths of the tree to `TreeEntry` objects.
+    :param path: A string containing the path to copy, relative to the root
+     of the tree.
+    :param dst: A string containing the path to the destination.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    target = dst
+    if os.path.isdir(dst) and tree[path].kind != "tree":
+        target = os.path.join(dst, os.path.basename(path))
+
+    return _archive(repository, sha, path, target, debug)
+
+
+def _archive(repository, sha, path, target, debug=False):
+    """Write path of the tree at sha to target and return a list of the files
+    which were written.
+
+    The tree is read in process when the repository can be, or else
+    through ``git archive``.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id to write.
+    :param path: A string containing the path to write, relative to the
+     root of the tree.  An empty string writes the whole tree.
+    :param target: A string containing the path ``path`` is written to.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    if _get_reader(repository) is not None:
+        return _write_tree(repository, sha, path, target, debug)
+
+    return _git_archive(repository, sha, path, target, debug)
+
+
+def _write_tree(repository, sha, path, target, debug=False):
+    """Write path of the tree at sha to target from its tree index and
+    return a list of the files which were written.
+
+    Like ``git archive``, submodules are written as empty directories.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id to write.
+    :param path: A string containing the path to write, relative to the
+     root of the tree.  An empty string writes the whole tree.
+    :param target: A string containing the path ``path`` is written to.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    blobs = []
+    for name, entry in _ls_tree(repository, sha, debug).items():
+        if not path:
+            relpath = name
+        elif name == path:
+            relpath = ""
+        elif name.startswith(path + "/"):
+            relpath = name[len(path) + 1 :]
+        else:
+            continue
+        if os.path.isabs(relpath) or ".." in relpath.split("/"):
+            raise ValueError("Unsafe path {}".format(name))
+        filename = os.path.join(target, relpath) if relpath else target
+        if entry.kind == "blob":
+            blobs.append((filename, entry.mode, entry.sha))
+        elif entry.kind == "commit":
+            os.makedirs(filename, exist_ok=True)
+    _write_blobs(repository, blobs, debug)
+
+    return [filename for filename, _, _ in blobs]
+
+
+@trace.traced("git archive", cat="command")
+def _git_archive(repository, sha, path, target, debug=False):
+    """Write path of the tree at sha to target through ``git archive`` and
+    return a list of the files which were written.
+
+    ``git archive`` is streamed through a pipe and unpacked as it arrives,
+    so the tree is never held in memory or on disk twice.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id to write.
+    :param path: A string containing the path to write, relative to the
+     root of the tree.  An empty string writes the whole tree.
+    :param target: A string containing the path ``path`` is written to.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    args = ["--", path] if path else []
+    r, w = os.pipe()
+    try:
+        cmd = sh.git.bake(
+            "archive",
+            "--format=tar",
+            sha,
+            *args,
+            _cwd=repository,
+            _out=w,
+            _bg=True,
+        )
+        p = util.run_command(cmd, debug=debug)
+    finally:
+        os.close(w)
+    with os.fdopen(r, "rb") as stream:
+        files = _untar(stream, path, target)
+    p.wait()
+
+    return files
+
+
+def _untar(stream, path, target):
+    """Unpack the members of a tar stream below path into target and return
+    a list of the files which were written.
+
+    :param stream: A file object containing a tar stream.
+    :param path: A string containing the path of the members to unpack.
+    :param target: A string containing the path ``path`` is unpacked to.
+    :return: list
+    """
+    written = []
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            name = member.name.rstrip("/")
+            if not path:
+                relpath = name
+            elif name == path:
+                relpath = ""
+            elif name.startswith(path + "/"):
+                relpath = name[len(path) + 1 :]
+            else:
+                continue
+            if os.path.isabs(relpath) or ".." in relpath.split("/"):
+                raise tarfile.TarError("Unsafe path {}".format(name))
+            filename = os.path.join(target, relpath) if relpath else target
+            if member.isdir():
+                os.makedirs(filename, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            if os.path.lexists(filename):
+                os.unlink(filename)
+            if member.issym():
+                os.symlink(member.linkname, filename)
+            elif member.isfile():
+                mode = 0o777 if member.mode & 0o111 else 0o666
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT, mode)
+                with os.fdopen(fd, "wb") as f:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+            else:
+                continue
+            written.append(filename)
+
+    return written
+
+
+def _ls_tree(repository, sha, debug=False):
+    """Index every path of the tree at sha and return a dict.
+
+    Trees of commits never change, the most recently used indexes are kept
+    in memory and shared by every entry overlaying from the same commit, in
+    any worker thread.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id to list.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict mapping paths to `TreeEntry` objects.
+    """
+    key = (repository, sha)
+    with _trees_lock:
+        if key in _trees:
+            _trees.move_to_end(key)
+            return _trees[key]
+
+    tree = _read_tree(repository, sha)
+    if tree is None:
+        cmd = sh.git.bake(
+            "ls-tree", "-r", "-t", "-z", "--full-tree", sha, _cwd=repository
+        )
+        tree = {}
+        for line in str(util.run_command(cmd, debug=debug)).split("\0"):
+            if line:
+                info, path = line.split("\t", 1)
+                tree[path] = TreeEntry(*info.split(" "))
+    with _trees_lock:
+        _trees[key] = tree
+        while len(_trees) > TREE_CACHE_SIZE:
+            _trees.popitem(last=False)
+
+    return tree
+
+
+def _read_tree(repository, sha):
+    """Index every path of the tree at sha in process and return a dict.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit id to list.
+    :return: dict mapping paths to `TreeEntry` objects, or None when the
+     tree can't be read in process.
+    """
+    r = _get_reader(repository)
+    if r is None:
+        return None
+
+    tree = {}
+    try:
+        root = _read_tree_id(r, sha)
+        if root is None:
+            return None
+        pending = [("", root)]
+        while pending:
+            prefix, tree_sha = pending.pop()
+            obj = r.read(tree_sha)
+            if obj is None or obj[0] != "tree":
+                return None
+            for mode, name, entry_sha in reader.parse_tree(obj[1]):
+                path = prefix + name
+                if mode == "040000":
+                    kind = "tree"
+                    pending.append((path + "/", entry_sha))
+                elif mode == "160000":
+                    kind = "commit"
+                else:
+                    kind = "blob"
+                tree[path] = TreeEntry(mode, kind, entry_sha)
+    except reader.ERRORS:
+        return None
+
+    return tree
+
+
+def _read_tree_id(r, sha):
+    """Return the id of the tree a commit, or a tree, at sha points at.
+
+    :param r: A `reader.Repository` object.
+    :param sha: A string containing an object id.
+    :return: str, or None when the object isn't a commit or tree.
+    """
+    sha = r.peel(sha)
+    if sha is None:
+        return None
+    obj = r.read(sha)
+    if obj[0] == "tree":
+        return sha
+    if obj[0] == "commit":
+        return reader.get_header(obj[1], "tree")
+
+    return None
+
+
+def _get_reader(repository):
+    """Return a `reader.Repository` reading the repository in process.
+
+    Readers are kept for as long as the git directory of the repository
+    stays the same, and they notice new packs themselves.
+
+    :param repository: A string containing the path to the repository.
+    :return: reader.Repository, or None when the repository can only be
+     read by git.
+    """
+    git_dir = _get_git_dir(repository)
+    try:
+        stamp = os.stat(git_dir).st_ino
+    except OSError:
+        return None
+    cached = _readers.get(repository)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    try:
+        r = reader.Repository(git_dir)
+    except reader.ERRORS:
+        r = None
+    _readers[repository] = (stamp, r)
+
+    return r
+
+
+def _glob(tree, pattern):
+    """Match a shell-style pattern against the paths of a tree and return a
+    sorted list.
+
+    Follows `glob.glob`, wildcards don't cross directory boundaries unless a
+    whole component is ``**``, which matches any number of directories.  Dot
+    files are only matched by a component which starts with a dot, and
+    submodules are never matched.
+
+    :param tree: A dict mapping the paths of a tree to `TreeEntry` objects.
+    :param pattern: A string containing the pattern, relative to the root
+     of the tree.
+    :return: list
+    """
+    parts = tuple(pattern.split("/"))
+    prefix = _get_literal_prefix(pattern)
+    if prefix:
+        prefix += "/"
+
+    def match(path, entry):
+        if entry.kind == "commit" or not path.startswith(prefix):
+            return False
+        return _match(tuple(path.split("/")), parts)
+
+    return sorted(path for path, entry in tree.items() if match(path, entry))
+
+
+def _get_literal_prefix(pattern):
+    """Return the leading directories of the pattern without wildcards. """
+    literal = []
+    for part in pattern.split("/")[:-1]:
+        if _has_magic(part):
+            break
+        literal.append(part)
+
+    return "/".join(literal)
+
+
+def _match(names, parts):
+    """Determine whether the components of a path match those of a pattern
+    or not. """
+    if not parts:
+        return not names
+    part = parts[0]
+    if part == "**":
+        if _match(names, parts[1:]):
+            return True
+        if not names or names[0].startswith("."):
+            return False
+        return _match(names[1:], parts)
+    if not names:
+        return False
+    if names[0].startswith(".") and not part.startswith("."):
+        return False
+
+    return fnmatch.fnmatchcase(names[0], part) and _match(names[1:], parts[1:])
+
+
+def _select(tree, patterns):
+    """Select the blobs of a tree matching the patterns and return a dict.
+
+    Patterns apply in order, a pattern prefixed with a '!' removes what it
+    matches from the blobs selected so far, like in a ``.gitignore``.  A
+    matched directory stands for every blob below it.  Each blob is mapped
+    to its path relative to the deepest directory shared by the patterns
+    before their wildcards start, so a single pattern whose wildcards are
+    in its last component selects the matches by their names.
+
+    :param tree: A dict mapping the paths of a tree to `TreeEntry` objects.
+    :param patterns: A list of strings containing the patterns, relative to
+     the root of the tree.
+    :return: dict mapping relative paths to the paths of the tree, sorted.
+    """
+    prefixes = [
+        _get_literal_prefix(pattern).split("/")
+        for pattern in patterns
+        if not pattern.startswith("!")
+    ]
+    base = []
+    for parts in zip(*prefixes):
+        if len(set(parts)) > 1:
+            break
+        base.append(parts[0])
+    base = "/".join(base)
+
+    selected = set()
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        paths = _walk(tree, _glob(tree, pattern.lstrip("!")))
+        if negated:
+            selected.difference_update(paths)
+        else:
+            selected.update(paths)
+
+    return collections.OrderedDict(
+        sorted(
+            (path[len(base) + 1 :] if base else path, path)
+            for path in selected
+        )
+    )
+
+
+def _walk(tree, paths):
+    """Return a list of the blobs of the tree at or below the paths. """
+    blobs = [path for path in paths if tree[path].kind == "blob"]
+    dirs = {path for path in paths if tree[path].kind == "tree"}
+    if dirs:
+        blobs.extend(
+            path
+            for path, entry in tree.items()
+            if entry.kind == "blob" and _is_below(path, dirs)
+        )
+
+    return blobs
+
+
+def _is_below(path, dirs):
+    while "/" in path:
+        path = path.rsplit("/", 1)[0]
+        if path in dirs:
+            return True
+
+    return False
+
+
+def _is_current(key, repository, ref):
+    """Determine whether the key is known to be at a pinned ref or not.
+
+    Branches always need to be brought up to date before they can be
+    compared, tags and commits can be trusted as resolved locally.
+
+    :param key: A string identifying what was materialized.
+    :param repository: A string containing the path to the repository.
+    :param ref: A `Ref` object, or None.
+    :return: bool
+    """
+    if ref is None or ref.kind == "branch":
         return False
 
+    return state.is_current(key, repository, ref.sha)
+
+
+def _get_ref(
+    repository,
+    keys,
+    version,
+    depth=None,
+    offline=False,
+    remote_ttl=0,
+    sha=None,
+    debug=False,
+):
+    """Determine the commit to materialize the keys at and return a `Ref`.
+
+    The version is brought up to date unless every key is known to be at it
+    already.  A version locked to a commit sha is never resolved, only the
+    commit is fetched when the repository doesn't have it.
+
+    :param repository: A string containing the path to the repository.
+    :param keys: A list of strings identifying what is materialized.
+    :param version: A string containing the branch/tag/sha to be exported.
+    :param depth: An optional int containing the history depth to keep
+     when fetching into a shallow clone.
+    :param offline: An optional bool to never reach the origin.
+    :param remote_ttl: An optional float containing the seconds the tips
+     advertised by the origin are trusted for, once listed.
+    :param sha: An optional string containing the commit sha the version is
+     locked to.
+    :param debug: An optional bool to toggle debug output.
+    :return: Ref
+    """
+    if sha is not None:
+        ref = Ref("commit", sha)
+    else:
+        ref = _resolve_version(repository, version, debug)
+    if all(_is_current(key, repository, ref) for key in keys):
+        return ref
+    if sha is not None:
+        return _get_commit(repository, sha, depth, offline, debug)
+
+    return _get_version(repository, version, depth, offline, remote_ttl, debug)
+
+
+def _get_commit(repository, sha, depth=None, offline=False, debug=False):
+    """Make sure the repository has the commit and return a `Ref`.
+
+    A missing commit is fetched by its sha alone, nothing else is fetched
+    unless the origin refuses to serve it that way.
 
-def _has_branch(version, debug=False):
-    """Determine a version is a local git branch name or not.
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit sha.
+    :param depth: An optional int containing the history depth to keep
+     when fetching into a shallow clone.
+    :param offline: An optional bool to never reach the origin, the commit
+     must then be known locally.
+    :param debug: An optional bool to toggle debug output.
+    :return: Ref
+    """
+    if get_tree(repository, sha, debug) is None:
+        if offline:
+            msg = "Unable to find commit {} in {} while offline".format(
+                sha, repository
+            )
+            raise OfflineError(msg)
+        if not _is_shallow(repository):
+            depth = None
+        _fetch_commit(repository, sha, depth, debug)
+        if get_tree(repository, sha, debug) is None:
+            msg = "Unable to find commit {} in {}".format(sha, repository)
+            raise NotFoundError(msg)
+
+    return Ref("commit", sha)
+
+
+def get_tree(repository, sha, debug=False):
+    """Return the id of the root tree of the commit.
+
+    Commits never change, the ids are remembered once read.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit sha.
+    :param debug: An optional bool to toggle debug output.
+    :return: str, or None when the repository doesn't have the commit.
+    """
+    key = (repository, sha)
+    if key not in _tree_ids:
+        r = _get_reader(repository)
+        if r is not None and reader.is_sha(sha):
+            try:
+                tree = _read_tree_id(r, sha)
+            except reader.ERRORS:
+                tree = None
+            if tree is not None:
+                _tree_ids[key] = tree
+                return tree
+        cmd = sh.git.bake(
+            "rev-parse",
+            "--verify",
+            "--quiet",
+            "{}^{{tree}}".format(sha),
+            _cwd=repository,
+        )
+        try:
+            tree = str(util.run_command(cmd, debug=debug)).strip()
+        except sh.ErrorReturnCode:
+            return None
+        _tree_ids[key] = tree
 
-    :param version: A string containing the branch/tag/sha to be determined.
+    return _tree_ids[key]
+
+
+def _get_version(
+    repository, version, depth=None, offline=False, remote_ttl=0, debug=False
+):
+    """Bring the specified version up to date and return a `Ref`.
+
+    1. Fetch the origin when the version is unknown, or a branch; _not_ a
+       tag or commit id, whose tip advertised by the origin isn't the local
+       one.
+    2. Fetch the version itself when a shallow clone still doesn't know it.
+
+    The origin is fetched at most once per run, every entry sharing the
+    repository resolves its version from that single fetch.  Nothing is
+    checked out, branches are followed through their remote-tracking refs.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the branch/tag/sha to be exported.
+    :param depth: An optional int containing the history depth to keep
+     when fetching into a shallow clone.
+    :param offline: An optional bool to never reach the origin, the version
+     must then be known locally.
+    :param remote_ttl: An optional float containing the seconds the tips
+     advertised by the origin are trusted for, once listed.
+    :param debug: An optional bool to toggle debug output.
+    :return: Ref
+    """
+    if not _is_shallow(repository):
+        depth = None
+    ref = _resolve_version(repository, version, debug)
+    if ref is not None and ref.kind != "branch":
+        return ref
+    if offline:
+        if ref is None:
+            msg = "Unable to find version {} in {} while offline".format(
+                version, repository
+            )
+            raise OfflineError(msg)
+        return ref
+    if repository not in _fetched:
+        if ref is not None and _is_advertised(
+            repository, version, ref, remote_ttl, debug
+        ):
+            return ref
+        _fetch(repository, version, depth, debug)
+        _fetched.add(repository)
+        _invalidate_refs(repository)
+        ref = _resolve_version(repository, version, debug)
+    elif ref is None and depth:
+        _fetch_version(repository, version, depth, debug)
+        _invalidate_refs(repository)
+        ref = _resolve_version(repository, version, debug)
+    if ref is None:
+        msg = "Unable to find version {} in {}".format(version, repository)
+        raise NotFoundError(msg)
+
+    return ref
+
+
+def _is_advertised(repository, version, ref, ttl=0, debug=False):
+    """Determine whether the origin advertises the branch at the local tip
+    or not.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the branch.
+    :param ref: The local `Ref` of the branch.
+    :param ttl: An optional float containing the seconds the recorded tips
+     of the origin are trusted for.
     :param debug: An optional bool to toggle debug output.
     :return: bool
     """
-    cmd = sh.git.bake(
-        "show-ref", "--verify", "--quiet", "refs/heads/{}".format(version)
-    )
+    refs = remote.get(repository, ttl, debug).refs
+
+    return refs.get("refs/heads/{}".format(version)) == ref.sha
+
+
+def is_pinned(repository, version, sha=None, debug=False):
+    """Determine the version is a tag or commit sha the clone already has,
+    which is read without fetching or otherwise changing the clone.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the branch/tag/sha.
+    :param sha: An optional string containing the commit sha the version is
+     locked to, which is looked up instead of the version.
+    :param debug: An optional bool to toggle debug output.
+    :return: bool
+    """
+    if not os.path.exists(repository):
+        return False
+    if sha is not None:
+        return get_tree(repository, sha, debug) is not None
+    ref = _resolve_version(repository, version, debug)
+
+    return ref is not None and ref.kind != "branch"
+
+
+def forget_fetches(repository=None):
+    """Forget which repositories were fetched, so the next run fetches them
+    again, and return None.
+
+    :param repository: An optional string containing the path to the
+     repository, every repository is forgotten when omitted.
+    :return: None
+    """
+    if repository is None:
+        _fetched.clear()
+        _checked.clear()
+    else:
+        _fetched.discard(repository)
+        _checked.discard(repository)
+    remote.forget(repository)
+
+
+@trace.traced("fetch")
+def _fetch(repository, version, depth=None, debug=False):
+    """Fetch the origin so the version becomes known locally and return
+    None.
+
+    A full clone fetches everything.  A shallow clone only fetches the tips
+    of the branches, and then the version itself as a tag or a commit sha if
+    it is still unknown.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the branch/tag/sha to be fetched.
+    :param depth: An optional int containing the history depth to keep.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    if not depth:
+        mirror.run_origin(repository, ["fetch"], debug)
+        return
+
+    mirror.run_origin(repository, ["fetch", "--depth", str(depth)], debug)
+    _invalidate_refs(repository)
+    if _resolve_version(repository, version, debug) is None:
+        _fetch_version(repository, version, depth, debug)
+
+
+@trace.traced("fetch")
+def _fetch_version(repository, version, depth, debug=False):
+    """Fetch the version into a shallow clone as a tag, or else as a commit
+    sha, and return None.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the tag/sha to be fetched.
+    :param depth: An int containing the history depth to keep.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    tag = "+refs/tags/{0}:refs/tags/{0}".format(version)
+    for refspec in (tag, version):
+        args = ["fetch", "--depth", str(depth), "origin", refspec]
+        try:
+            mirror.run_origin(repository, args, debug)
+            return
+        except sh.ErrorReturnCode:
+            pass
+
+
+@trace.traced("fetch")
+def _fetch_commit(repository, sha, depth=None, debug=False):
+    """Fetch the commit by its sha and return None.
+
+    Falls back to fetching the origin when it doesn't serve commits which
+    aren't advertised.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the commit sha to be fetched.
+    :param depth: An optional int containing the history depth to keep.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    args = ["--depth", str(depth)] if depth else []
     try:
-        util.run_command(cmd, debug=debug)
-        return True
+        mirror.run_origin(repository, ["fetch", *args, "origin", sha], debug)
     except sh.ErrorReturnCode:
-        return False
+        if repository not in _fetched:
+            _fetch(repository, sha, depth, debug)
+            _fetched.add(repository)
+            _invalidate_refs(repository)
+
+
+def _is_shallow(repository):
+    """Determine whether the repository is a shallow clone or not.
+
+    :param repository: A string containing the path to the repository.
+    :return: bool
+    """
+    return os.path.exists(os.path.join(_get_git_dir(repository), "shallow"))
+
+
+def _get_git_dir(repository):
+    """Return the git directory of a bare or non-bare repository.
+
+    :param repository: A string containing the path to the repository.
+    :return: str
+    """
+    git_dir = os.path.join(repository, ".git")
+    if os.path.isdir(git_dir):
+        return git_dir
+
+    return repository
+
+
+def _resolve_version(repository, version, debug=False):
+    """Classify a version as branch, tag or commit and return a `Ref`.
+
+    Branches and tags are looked up in the memoized ref index of the
+    repository, anything else is asked of git once and remembered.  A
+    branch resolves to its remote-tracking ref when there is one, which is
+    what a fetch keeps up to date.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the branch/tag/sha to be resolved.
+    :param debug: An optional bool to toggle debug output.
+    :return: Ref, or None when the version is unknown locally.
+    """
+    refs = _get_refs(repository, debug)
+    for kind, prefix in (
+        ("branch", "refs/remotes/origin/"),
+        ("branch", "refs/heads/"),
+        ("tag", "refs/tags/"),
+    ):
+        sha = refs.get(prefix + version)
+        if sha and version != "HEAD":
+            return Ref(kind, sha)
+
+    commits = _commits.setdefault(repository, {})
+    if version not in commits:
+        sha = _read_commit(repository, version)
+        if sha is None:
+            cmd = sh.git.bake(
+                "rev-parse",
+                "--verify",
+                "--quiet",
+                "{}^{{commit}}".format(version),
+                _cwd=repository,
+            )
+            try:
+                sha = str(util.run_command(cmd, debug=debug)).strip()
+            except sh.ErrorReturnCode:
+                sha = None
+        commits[version] = sha
+    sha = commits[version]
+
+    return Ref("commit", sha) if sha else None
+
+
+def _read_commit(repository, version):
+    """Peel a full commit sha, or an annotated tag's, in process and return
+    the commit's sha.
+
+    :param repository: A string containing the path to the repository.
+    :param version: A string containing the version to be resolved.
+    :return: str, or None when git is needed to resolve the version.
+    """
+    r = _get_reader(repository)
+    if r is None or not reader.is_sha(version):
+        return None
+    try:
+        sha = r.peel(version)
+        if sha is not None and r.read_header(sha)[0] == "commit":
+            return sha
+    except reader.ERRORS:
+        pass
+
+    return None
+
+
+def _get_refs(repository, debug=False):
+    """Read every ref of the repository, in process or else with a single
+    git call, and return a dict.
+
+    The result is memoized until `_invalidate_refs` is called for the
+    repository, and checked once per run against the ref files of the
+    repository, so a long running process notices the refs other processes
+    updated.  Annotated tags are peeled to the commit they point at.
+
+    :param repository: A string containing the path to the repository.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict mapping ref names to commit shas.
+    """
+    refs = _refs.get(repository)
+    if refs is not None and repository not in _checked:
+        if _get_refs_stamp(repository) != _ref_stamps.get(repository):
+            _invalidate_refs(repository)
+            refs = None
+        _checked.add(repository)
+    if refs is None:
+        _ref_stamps[repository] = _get_refs_stamp(repository)
+        _checked.add(repository)
+        refs = _read_refs(repository)
+        if refs is None:
+            cmd = sh.git.bake(
+                "for-each-ref",
+                "--format=%(objectname) %(*objectname) %(refname)",
+                _cwd=repository,
+            )
+            refs = {}
+            for line in str(util.run_command(cmd, debug=debug)).splitlines():
+                sha, peeled, refname = line.split(" ", 2)
+                refs[refname] = peeled or sha
+        _refs[repository] = refs
+
+    return refs
+
+
+def _read_refs(repository):
+    """Read every ref of the repository in process and return a dict.
+
+    :param repository: A string containing the path to the repository.
+    :return: dict, or None when git is needed to read the refs.
+    """
+    r = _get_reader(repository)
+    if r is None:
+        return None
+    try:
+        return r.refs()
+    except reader.ERRORS:
+        return None
+
+
+def _invalidate_refs(repository):
+    """Forget what is known about the refs of the repository and return
+    None.
+
+    :param repository: A string containing the path to the repository.
+    :return: None
+    """
+    _refs.pop(repository, None)
+    _ref_stamps.pop(repository, None)
+    _commits.pop(repository, None)
+
+
+def _get_refs_stamp(repository):
+    """Identify the current state of the ref files of the repository and
+    return a frozenset.
+
+    Git replaces a ref file with a new one whenever it updates the ref, so
+    the inode and modification time of every ref file, and of
+    ``packed-refs``, change with any ref.
+
+    :param repository: A string containing the path to the repository.
+    :return: frozenset
+    """
+    git_dir = _get_git_dir(repository)
+    paths = [os.path.join(git_dir, "packed-refs")]
+    for root, _, files in os.walk(os.path.join(git_dir, "refs")):
+        paths.extend(os.path.join(root, name) for name in files)
+    stamp = set()
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stamp.add((path, st.st_ino, st.st_mtime_ns))
+
+    return frozenset(stamp)
@@ -0,0 +1,129 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import collections
+import os
+
+import yaml
+
+from gilt import config
+
+Pin = collections.namedtuple("Pin", ["git", "version", "sha", "tree"])
+
+HEADER = "# Generated by gilt overlay, do not edit.\n"
+
+
+class NotLockedError(Exception):
+    """Error raised when an entry isn't recorded in the lock file."""
+
+    pass
+
+
+def get_filename(filename):
+    """Construct the path of the lock file of a config and return a str.
+
+    :param filename: A string containing the path to the config.
+    :return: str
+    """
+    return os.path.splitext(filename)[0] + ".lock"
+
+
+def load(filename):
+    """Parse the lock file and return a dict.
+
+    :param filename: A string containing the path to the lock file.
+    :return: dict mapping (git, version) tuples to `Pin` objects.
+    """
+    with open(filename, "r") as stream:
+        try:
+            data = yaml.load(stream, Loader=config._Loader)
+        except yaml.YAMLError as e:
+            msg = "Error parsing gilt lock: {}".format(e)
+            raise config.ParseError(msg)
+
+    pins = {}
+    for d in data or []:
+        try:
+            pin = Pin(**d)
+        except TypeError:
+            msg = "Error parsing gilt lock: invalid entry {}".format(d)
+            raise config.ParseError(msg)
+        pins[(pin.git, pin.version)] = pin
+
+    return pins
+
+
+def dump(filename, pins):
+    """Write the pins to the lock file and return None.
+
+    Pins are sorted, so the file only changes when a pin does, and it is
+    left untouched when nothing changed.
+
+    :param filename: A string containing the path to the lock file.
+    :param pins: A list of `Pin` objects.
+    :return: None
+    """
+    data = [
+        dict(pin._asdict())
+        for pin in sorted(set(pins), key=lambda p: (p.git, str(p.version)))
+    ]
+    content = HEADER + yaml.safe_dump(data, default_flow_style=False)
+    try:
+        with open(filename, "r") as stream:
+            if stream.read() == content:
+                return
+    except OSError:
+        pass
+
+    tmp = config._get_temp_file(filename)
+    with open(tmp, "w") as stream:
+        stream.write(content)
+    os.replace(tmp, filename)
+
+
+def key(c):
+    """Construct the key of the pin of an entry and return a tuple.
+
+    Entries are keyed by their git URL as written in the config, so the
+    lock file holds neither the values nor the secrets of the environment
+    variables it references, and stays valid when they change.
+
+    :param c: A `Config` object.
+    :return: tuple
+    """
+    return (c.raw_git or c.git, c.version)
+
+
+def freeze(entries, pins):
+    """Lock each entry to the commit recorded for it and return a list.
+
+    :param entries: A list of `Config` objects.
+    :param pins: A dict mapping (git, version) tuples to `Pin` objects.
+    :return: list of `Config` objects.
+    """
+    frozen = []
+    for c in entries:
+        pin = pins.get(key(c))
+        if pin is None:
+            msg = "Unable to find {} ({}) in the lock file".format(*key(c))
+            raise NotLockedError(msg)
+        frozen.append(c._replace(sha=pin.sha))
+
+    return frozen
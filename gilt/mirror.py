@@ -0,0 +1,277 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import collections
+import concurrent.futures
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+
+import sh
+import yaml
+
+from gilt import config
+from gilt import util
+
+# `mirrors` lists the URLs replacing `prefix`, and `select` is "order" to
+# try them as listed, or "latency" to try the reachable ones fastest first.
+Rule = collections.namedtuple("Rule", ["prefix", "mirrors", "select"])
+
+SELECTIONS = ("order", "latency")
+# Seconds a latency probe is trusted for.
+PROBE_TTL = 600
+# Seconds a probe waits for a mirror to accept a connection.
+PROBE_TIMEOUT = 1.0
+
+_PORTS = {"http": 80, "https": 443, "ssh": 22, "git": 9418}
+
+_rules = {}
+_origins = {}
+_lock = threading.Lock()
+
+
+def load(filename=None):
+    """Load the rewrite rules and return a list of `Rule` objects.
+
+    Rules are read from ``mirrors.yml`` in gilt's cache, or the file
+    ``$GILT_MIRRORS`` names, and kept until the file changes.
+
+    :param filename: An optional string containing the path to the rules.
+    :return: list, empty when there are no rules.
+    """
+    filename = filename or config._get_mirrors_file()
+    try:
+        stamp = os.stat(filename).st_mtime_ns
+    except OSError:
+        return []
+    cached = _rules.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with open(filename, "r") as stream:
+        try:
+            data = yaml.load(stream, Loader=config._Loader)
+        except yaml.YAMLError as e:
+            msg = "Error parsing gilt mirrors: {}".format(e)
+            raise config.ParseError(msg)
+    rules = []
+    for d in data or []:
+        try:
+            rule = Rule(
+                d["prefix"], list(d["mirrors"]), d.get("select", "order")
+            )
+        except (KeyError, TypeError, AttributeError):
+            msg = "Error parsing gilt mirrors: invalid rule {}".format(d)
+            raise config.ParseError(msg)
+        if rule.select not in SELECTIONS:
+            msg = "Error parsing gilt mirrors: invalid select {}".format(
+                rule.select
+            )
+            raise config.ParseError(msg)
+        rules.append(rule)
+    # Longest prefixes first, like git's own url.<base>.insteadOf.
+    rules.sort(key=lambda r: len(r.prefix), reverse=True)
+    _rules[filename] = (stamp, rules)
+
+    return rules
+
+
+def canonical(url, rules=None):
+    """Map a mirror's URL back to the upstream URL it mirrors and return a
+    str.
+
+    Clones are keyed by the upstream URL, so a repository is cloned once
+    whether a config names it by its upstream or by a mirror.
+
+    :param url: A string containing a repository URL.
+    :param rules: An optional list of `Rule` objects, defaults to `load`.
+    :return: str
+    """
+    rules = load() if rules is None else rules
+    for rule in rules:
+        for m in rule.mirrors:
+            if url.startswith(m):
+                return rule.prefix + url[len(m) :]
+
+    return url
+
+
+def get_routes(url, rules=None):
+    """Return the mirrors a URL is reached through, in the order they are
+    tried, followed by the URL itself.
+
+    :param url: A string containing the upstream URL.
+    :param rules: An optional list of `Rule` objects, defaults to `load`.
+    :return: list of (mirror, prefix) tuples, where mirror is None for the
+     URL itself.
+    """
+    rules = load() if rules is None else rules
+    routes = []
+    for rule in rules:
+        if url.startswith(rule.prefix):
+            mirrors = rule.mirrors
+            if rule.select == "latency":
+                mirrors = _by_latency(mirrors)
+            routes = [(m, rule.prefix) for m in mirrors]
+            break
+
+    return routes + [(None, None)]
+
+
+def run(url, args, cwd=None, debug=False):
+    """Run git, reaching the URL through its mirrors, and return the result
+    of the first route which succeeds.
+
+    A route rewrites the URL with ``url.<mirror>.insteadOf`` for this
+    command only, so clones keep the upstream URL as their origin.
+
+    :param url: A string containing the upstream URL of the repository.
+    :param args: A list of the arguments of git.
+    :param cwd: An optional string containing the working directory.
+    :param debug: An optional bool to toggle debug output.
+    :return: `sh.RunningCommand`
+    """
+    routes = get_routes(url)
+    kwargs = {"_cwd": cwd} if cwd else {}
+    for i, (m, prefix) in enumerate(routes):
+        route = []
+        if m is not None:
+            route = ["-c", "url.{}.insteadOf={}".format(m, prefix)]
+        cmd = sh.git.bake(*route, *args, **kwargs)
+        try:
+            return util.run_command(cmd, debug=debug)
+        except sh.ErrorReturnCode:
+            if i == len(routes) - 1:
+                raise
+            nxt = routes[i + 1][0] or url
+            util.print_warn("  - {} failed, trying {}".format(m, nxt))
+
+
+def run_origin(repository, args, debug=False):
+    """Run git in a clone, reaching its origin through the mirrors, and
+    return the result of the first route which succeeds.
+
+    :param repository: A string containing the path to the repository.
+    :param args: A list of the arguments of git.
+    :param debug: An optional bool to toggle debug output.
+    :return: `sh.RunningCommand`
+    """
+    if not load():
+        cmd = sh.git.bake(*args, _cwd=repository)
+        return util.run_command(cmd, debug=debug)
+
+    return run(_get_origin(repository, debug), args, repository, debug)
+
+
+def _get_origin(repository, debug=False):
+    """Return the URL of the origin of a clone.
+
+    :param repository: A string containing the path to the repository.
+    :param debug: An optional bool to toggle debug output.
+    :return: str
+    """
+    if repository not in _origins:
+        cmd = sh.git.bake(
+            "config", "--get", "remote.origin.url", _cwd=repository
+        )
+        url = str(util.run_command(cmd, debug=debug)).strip()
+        _origins[repository] = canonical(url)
+
+    return _origins[repository]
+
+
+def _by_latency(mirrors):
+    """Order the reachable mirrors fastest first and return a list.
+
+    :param mirrors: A list of strings containing the URLs of mirrors.
+    :return: list
+    """
+    latencies = _get_latencies(mirrors)
+    reachable = [m for m in mirrors if latencies.get(m) is not None]
+
+    return sorted(reachable, key=lambda m: latencies[m])
+
+
+def _get_latencies(mirrors):
+    """Probe the mirrors whose latency isn't known or is out of date, and
+    return a dict of their latencies.
+
+    Probes are recorded in gilt's cache and reused for `PROBE_TTL` seconds.
+
+    :param mirrors: A list of strings containing the URLs of mirrors.
+    :return: dict mapping URLs to seconds, or None when unreachable.
+    """
+    # Clones of concurrent entries share the probes.
+    with _lock:
+        return _load_latencies(mirrors)
+
+
+def _load_latencies(mirrors):
+    filename = config._get_latency_file()
+    try:
+        with open(filename, "r") as stream:
+            recorded = json.load(stream)
+    except (OSError, ValueError):
+        recorded = {}
+    now = time.time()
+    stale = [m for m in mirrors if not _is_fresh(recorded.get(m), now)]
+    if stale:
+        with concurrent.futures.ThreadPoolExecutor(len(stale)) as executor:
+            for m, latency in zip(stale, executor.map(probe, stale)):
+                recorded[m] = [now, latency]
+        config._makedirs(filename)
+        tmp = config._get_temp_file(filename)
+        with open(tmp, "w") as stream:
+            json.dump(recorded, stream)
+        os.replace(tmp, filename)
+
+    return {m: recorded[m][1] for m in mirrors}
+
+
+def _is_fresh(probed, now):
+    return isinstance(probed, list) and now - probed[0] < PROBE_TTL
+
+
+def probe(url, timeout=PROBE_TIMEOUT):
+    """Measure the time a mirror takes to accept a connection and return a
+    float of seconds.
+
+    :param url: A string containing the URL of the mirror.
+    :param timeout: An optional float containing the seconds to wait.
+    :return: float, or None when the mirror is unreachable.
+    """
+    o = urllib.parse.urlparse(url)
+    if not o.hostname:
+        if o.scheme in ("", "file") and ":" not in o.path.split("/")[0]:
+            return 0.0 if os.path.exists(o.path) else None
+        # scp-style "URL", like user@host:path
+        o = urllib.parse.urlparse(
+            "ssh://" + url.replace(":/", "/").replace(":", "/", 1)
+        )
+    port = o.port or _PORTS.get(o.scheme, 22)
+    start = time.monotonic()
+    try:
+        with socket.create_connection((o.hostname, port), timeout):
+            return time.monotonic() - start
+    except (OSError, ValueError):
+        return None
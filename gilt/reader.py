@@ -0,0 +1,641 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import binascii
+import collections
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+# Kinds of objects by their type in a pack.
+KINDS = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+# Bytes of resolved delta bases kept in memory per pack.
+DELTA_CACHE_SIZE = 32 * 1024 * 1024
+
+_OFS_DELTA = 6
+_REF_DELTA = 7
+_IDX_MAGIC = b"\377tOc"
+_CHUNK = 64 * 1024
+
+
+class UnsupportedError(Exception):
+    """Error raised when a repository uses a format which can't be read."""
+
+    pass
+
+
+# Errors raised reading a repository git writes to concurrently, or which
+# is corrupt, for callers to fall back to running git.
+ERRORS = (
+    OSError,
+    ValueError,
+    IndexError,
+    KeyError,
+    struct.error,
+    zlib.error,
+    UnsupportedError,
+)
+
+
+class Repository(object):
+    """Read the refs and objects of a git repository without running git.
+
+    Loose refs and ``packed-refs`` are read from the git directory.  Objects
+    are read from loose object files and from version 2 packfiles, which
+    are mapped in memory and looked up through their index, following the
+    object directories listed in ``objects/info/alternates``.  Repositories
+    using SHA-256 object names or the reftable ref storage aren't supported.
+    """
+
+    def __init__(self, git_dir):
+        """Open the repository and return None.
+
+        :param git_dir: A string containing the path to the git directory.
+        :raises: UnsupportedError when the repository can't be read.
+        """
+        self.git_dir = git_dir
+        _check_format(git_dir)
+        self._object_dirs = _get_object_dirs(os.path.join(git_dir, "objects"))
+        self._packs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._scan_packs()
+
+    def refs(self):
+        """Read every ref of the repository and return a dict.
+
+        Symbolic refs resolve to the object of their target, and annotated
+        tags are peeled to the object they point at, like ``git
+        for-each-ref --format='%(*objectname)'``.
+
+        :return: dict mapping ref names to object ids.
+        """
+        refs, peeled = self._read_packed_refs()
+        symbolic = {}
+        refs_dir = os.path.join(self.git_dir, "refs")
+        for root, _, files in os.walk(refs_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                refname = os.path.relpath(path, self.git_dir)
+                refname = refname.replace(os.sep, "/")
+                try:
+                    with open(path, "r") as f:
+                        value = f.read().strip()
+                except OSError:
+                    continue
+                peeled.pop(refname, None)
+                if value.startswith("ref: "):
+                    symbolic[refname] = value[len("ref: ") :]
+                elif is_sha(value):
+                    refs[refname] = value
+        for refname, target in symbolic.items():
+            for _ in range(5):
+                if target not in symbolic:
+                    break
+                target = symbolic[target]
+            if target in refs:
+                refs[refname] = refs[target]
+                if target in peeled:
+                    peeled[refname] = peeled[target]
+
+        result = {}
+        for refname, sha in refs.items():
+            if refname in peeled:
+                result[refname] = peeled[refname] or sha
+            else:
+                result[refname] = self.peel(sha) or sha
+
+        return result
+
+    def _read_packed_refs(self):
+        """Read ``packed-refs`` and return a tuple of two dicts.
+
+        :return: tuple of the refs, and of the objects annotated tags peel
+         to, which is None for refs known not to be annotated tags.
+        """
+        refs = {}
+        peeled = {}
+        try:
+            with open(os.path.join(self.git_dir, "packed-refs"), "r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return refs, peeled
+
+        traits = set()
+        refname = None
+        for line in lines:
+            if line.startswith("#"):
+                if line.startswith("# pack-refs with:"):
+                    traits = set(line.split(":", 1)[1].split())
+            elif line.startswith("^"):
+                if refname is not None:
+                    peeled[refname] = line[1:].strip()
+            elif line:
+                sha, refname = line.split(" ", 1)
+                refs[refname] = sha
+                fully = "fully-peeled" in traits
+                if fully or (
+                    "peeled" in traits and refname.startswith("refs/tags/")
+                ):
+                    peeled[refname] = None
+
+        return refs, peeled
+
+    def peel(self, sha):
+        """Follow annotated tags to the object they point at and return its
+        id.
+
+        :param sha: A string containing an object id.
+        :return: str, or None when an object is missing.
+        """
+        for _ in range(16):
+            header = self.read_header(sha)
+            if header is None:
+                return None
+            if header[0] != "tag":
+                return sha
+            sha = _get_header(self.read(sha)[1], b"object")
+
+        return None
+
+    def read(self, sha):
+        """Read an object and return a (kind, data) tuple.
+
+        :param sha: A string containing the object id.
+        :return: tuple, or None when the repository doesn't have the object.
+        """
+        binsha = binascii.unhexlify(sha)
+        for rescan in (False, True):
+            if rescan and not self._scan_packs():
+                break
+            for pack in list(self._packs.values()):
+                offset = pack.find(binsha)
+                if offset is not None:
+                    return pack.read_at(offset, self.read)
+            if not rescan:
+                obj = self._read_loose(sha)
+                if obj is not None:
+                    return obj
+
+        return None
+
+    def read_header(self, sha):
+        """Read the kind and size of an object and return a tuple.
+
+        :param sha: A string containing the object id.
+        :return: tuple, or None when the repository doesn't have the object.
+        """
+        binsha = binascii.unhexlify(sha)
+        for rescan in (False, True):
+            if rescan and not self._scan_packs():
+                break
+            for pack in list(self._packs.values()):
+                offset = pack.find(binsha)
+                if offset is not None:
+                    return pack.header_at(offset, self.read_header)
+            if not rescan:
+                header = self._read_loose_header(sha)
+                if header is not None:
+                    return header
+
+        return None
+
+    def _read_loose(self, sha):
+        for objects_dir in self._object_dirs:
+            path = os.path.join(objects_dir, sha[:2], sha[2:])
+            try:
+                with open(path, "rb") as f:
+                    raw = zlib.decompress(f.read())
+            except FileNotFoundError:
+                continue
+            header, _, data = raw.partition(b"\0")
+            kind, size = header.decode().split(" ")
+            if int(size) != len(data):
+                raise ValueError("Corrupt object {}".format(sha))
+            return kind, data
+
+        return None
+
+    def _read_loose_header(self, sha):
+        for objects_dir in self._object_dirs:
+            path = os.path.join(objects_dir, sha[:2], sha[2:])
+            try:
+                with open(path, "rb") as f:
+                    d = zlib.decompressobj()
+                    raw = d.decompress(f.read(_CHUNK), 64)
+            except FileNotFoundError:
+                continue
+            kind, size = raw.partition(b"\0")[0].decode().split(" ")
+            return kind, int(size)
+
+        return None
+
+    def _scan_packs(self):
+        """Open the packs which appeared since the last scan, drop those
+        which were removed since, and return whether any appeared.
+
+        Dropped packs aren't closed, as another thread may still be reading
+        them; each is unmapped once nothing refers to it anymore.
+
+        :return: bool
+        """
+        with self._lock:
+            return self._scan_new_packs()
+
+    def _scan_new_packs(self):
+        found = False
+        present = set()
+        for objects_dir in self._object_dirs:
+            pack_dir = os.path.join(objects_dir, "pack")
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except FileNotFoundError:
+                continue
+            for name in names:
+                path = os.path.join(pack_dir, name)
+                if not name.endswith(".idx"):
+                    continue
+                if not os.path.exists(path[: -len(".idx")] + ".pack"):
+                    continue
+                present.add(path)
+                if path not in self._packs:
+                    self._packs[path] = Pack(path)
+                    found = True
+        for path in [p for p in self._packs if p not in present]:
+            del self._packs[path]
+
+        return found
+
+
+class Pack(object):
+    """A packfile and its version 2 index, both mapped in memory."""
+
+    def __init__(self, idx_path):
+        """Open the index of the pack and return None.
+
+        :param idx_path: A string containing the path to the ``.idx`` file.
+        :raises: UnsupportedError when the index isn't a version 2 index.
+        """
+        self.idx_path = idx_path
+        self._idx = _map(idx_path)
+        if self._idx[:8] != _IDX_MAGIC + struct.pack(">I", 2):
+            raise UnsupportedError("Unsupported pack index " + idx_path)
+        self._fanout = struct.unpack_from(">256I", self._idx, 8)
+        self._count = self._fanout[255]
+        self._shas = 8 + 256 * 4
+        self._offsets = self._shas + self._count * (20 + 4)
+        self._large_offsets = self._offsets + self._count * 4
+        self._pack = None
+        self._cache = collections.OrderedDict()
+        self._cached = 0
+        self._lock = threading.Lock()
+
+    def find(self, binsha):
+        """Look up the offset of an object in the pack and return an int.
+
+        :param binsha: A bytes object containing the binary object id.
+        :return: int, or None when the pack doesn't have the object.
+        """
+        first = binsha[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        idx = self._idx
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._shas + mid * 20
+            current = idx[start : start + 20]
+            if current < binsha:
+                lo = mid + 1
+            elif current > binsha:
+                hi = mid
+            else:
+                return self._get_offset(mid)
+
+        return None
+
+    def _get_offset(self, i):
+        (offset,) = struct.unpack_from(">I", self._idx, self._offsets + i * 4)
+        if offset & 0x80000000:
+            large = self._large_offsets + (offset & 0x7FFFFFFF) * 8
+            (offset,) = struct.unpack_from(">Q", self._idx, large)
+
+        return offset
+
+    def read_at(self, offset, read):
+        """Read the object at the offset and return a (kind, data) tuple.
+
+        Deltas are resolved iteratively, however long their chain, and the
+        bases they resolve to are kept in a bounded cache.
+
+        :param offset: An int containing the offset of the object.
+        :param read: A callable reading an object by id, for bases which
+         aren't in this pack.
+        :return: tuple
+        """
+        deltas = []
+        while True:
+            cached = self._recall(offset)
+            if cached is not None:
+                kind, data = cached
+                break
+            kind_num, size, pos = self._read_entry_header(offset)
+            if kind_num == _OFS_DELTA:
+                base, pos = self._read_base_offset(offset, pos)
+            elif kind_num == _REF_DELTA:
+                binsha = bytes(self._get_pack()[pos : pos + 20])
+                pos += 20
+                base = self.find(binsha)
+            elif kind_num in KINDS:
+                kind = KINDS[kind_num]
+                data = self._inflate(pos, size)
+                break
+            else:
+                raise ValueError("Unknown object type {}".format(kind_num))
+            deltas.append((offset, pos, size))
+            if base is None:
+                sha = binascii.hexlify(binsha).decode()
+                obj = read(sha)
+                if obj is None:
+                    raise ValueError("Missing delta base {}".format(sha))
+                kind, data = obj
+                break
+            offset = base
+
+        for delta_offset, pos, size in reversed(deltas):
+            data = apply_delta(data, self._inflate(pos, size))
+            self._remember(delta_offset, kind, data)
+
+        return kind, data
+
+    def header_at(self, offset, read_header):
+        """Read the kind and size of the object at the offset and return a
+        tuple, without inflating more than the head of its deltas.
+
+        :param offset: An int containing the offset of the object.
+        :param read_header: A callable reading the header of an object by
+         id, for bases which aren't in this pack.
+        :return: tuple
+        """
+        size = None
+        while True:
+            kind_num, entry_size, pos = self._read_entry_header(offset)
+            if kind_num in KINDS:
+                return KINDS[kind_num], entry_size if size is None else size
+            if kind_num == _OFS_DELTA:
+                base, pos = self._read_base_offset(offset, pos)
+            elif kind_num == _REF_DELTA:
+                binsha = bytes(self._get_pack()[pos : pos + 20])
+                pos += 20
+                base = self.find(binsha)
+            else:
+                raise ValueError("Unknown object type {}".format(kind_num))
+            if size is None:
+                head = zlib.decompressobj().decompress(
+                    self._get_pack()[pos : pos + 64], 32
+                )
+                _, i = _read_size(head, 0)
+                size, _ = _read_size(head, i)
+            if base is None:
+                sha = binascii.hexlify(binsha).decode()
+                header = read_header(sha)
+                if header is None:
+                    raise ValueError("Missing delta base {}".format(sha))
+                return header[0], size
+            offset = base
+
+    def _get_pack(self):
+        if self._pack is None:
+            self._pack = _map(self.idx_path[: -len(".idx")] + ".pack")
+            if self._pack[:4] != b"PACK":
+                raise ValueError("Corrupt pack " + self.idx_path)
+
+        return self._pack
+
+    def _read_entry_header(self, offset):
+        pack = self._get_pack()
+        c = pack[offset]
+        kind_num = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = offset + 1
+        while c & 0x80:
+            c = pack[pos]
+            pos += 1
+            size |= (c & 0x7F) << shift
+            shift += 7
+
+        return kind_num, size, pos
+
+    def _read_base_offset(self, offset, pos):
+        pack = self._get_pack()
+        c = pack[pos]
+        pos += 1
+        n = c & 0x7F
+        while c & 0x80:
+            c = pack[pos]
+            pos += 1
+            n = ((n + 1) << 7) | (c & 0x7F)
+
+        return offset - n, pos
+
+    def _inflate(self, pos, size):
+        pack = self._get_pack()
+        d = zlib.decompressobj()
+        chunks = []
+        while not d.eof:
+            chunk = pack[pos : pos + max(size + 64, _CHUNK)]
+            if not chunk:
+                raise ValueError("Truncated pack " + self.idx_path)
+            chunks.append(d.decompress(chunk))
+            pos += len(chunk)
+        data = b"".join(chunks)
+        if len(data) != size:
+            raise ValueError("Corrupt pack " + self.idx_path)
+
+        return data
+
+    def _recall(self, offset):
+        with self._lock:
+            if offset not in self._cache:
+                return None
+            self._cache.move_to_end(offset)
+            return self._cache[offset]
+
+    def _remember(self, offset, kind, data):
+        if len(data) > DELTA_CACHE_SIZE // 4:
+            return
+        with self._lock:
+            if offset in self._cache:
+                return
+            self._cache[offset] = (kind, data)
+            self._cached += len(data)
+            while self._cached > DELTA_CACHE_SIZE:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._cached -= len(evicted)
+
+
+def apply_delta(base, delta):
+    """Apply a git delta to its base and return a bytes object.
+
+    :param base: A bytes object containing the base object.
+    :param delta: A bytes object containing the delta.
+    :return: bytes
+    """
+    src_size, pos = _read_size(delta, 0)
+    dst_size, pos = _read_size(delta, pos)
+    if src_size != len(base):
+        raise ValueError("Delta doesn't apply to its base")
+    base = memoryview(base)
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset : offset + (size or 0x10000)]
+        elif op:
+            out += delta[pos : pos + op]
+            pos += op
+        else:
+            raise ValueError("Invalid delta instruction")
+    if len(out) != dst_size:
+        raise ValueError("Delta produced the wrong size")
+
+    return bytes(out)
+
+
+def parse_tree(data):
+    """Parse the entries of a tree object and return a list.
+
+    :param data: A bytes object containing the tree object.
+    :return: list of (mode, name, sha) tuples, modes padded to six digits
+     like ``git ls-tree`` prints them.
+    """
+    entries = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        space = data.index(b" ", pos)
+        nul = data.index(b"\0", space)
+        mode = data[pos:space].decode().zfill(6)
+        name = data[space + 1 : nul].decode("utf-8", "surrogateescape")
+        sha = binascii.hexlify(data[nul + 1 : nul + 21]).decode()
+        entries.append((mode, name, sha))
+        pos = nul + 21
+
+    return entries
+
+
+def get_header(data, name):
+    """Return the value of a header of a commit or tag object.
+
+    :param data: A bytes object containing the object.
+    :param name: A string containing the name of the header.
+    :return: str, or None when the object doesn't have the header.
+    """
+    return _get_header(data, name.encode())
+
+
+def _get_header(data, name):
+    for line in data.split(b"\n"):
+        if not line:
+            break
+        key, _, value = line.partition(b" ")
+        if key == name:
+            return value.decode()
+
+    return None
+
+
+def _read_size(data, pos):
+    size = shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        size |= (c & 0x7F) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def is_sha(value):
+    """Determine a string is a full, lowercase, SHA-1 object id or not."""
+    return len(value) == 40 and re.match(r"^[0-9a-f]{40}$", value) is not None
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _check_format(git_dir):
+    """Raise `UnsupportedError` unless the repository uses SHA-1 object names
+    and files for its refs."""
+    try:
+        with open(os.path.join(git_dir, "config"), "r") as f:
+            content = f.read()
+    except OSError:
+        content = ""
+    pattern = r"^\s*(objectformat|refstorage)\s*=\s*(\S+)"
+    for key, value in re.findall(pattern, content, re.M | re.I):
+        if value.lower() not in ("sha1", "files"):
+            msg = "Unsupported {} {} in {}".format(key, value, git_dir)
+            raise UnsupportedError(msg)
+    if os.path.isdir(os.path.join(git_dir, "reftable")):
+        raise UnsupportedError("Unsupported reftable in {}".format(git_dir))
+
+
+def _get_object_dirs(objects_dir, seen=None):
+    """Return a list of the object directory and of its alternates.
+
+    :param objects_dir: A string containing the path to the object
+     directory.
+    :return: list
+    """
+    seen = seen if seen is not None else set()
+    objects_dir = os.path.normpath(objects_dir)
+    if objects_dir in seen:
+        return []
+    seen.add(objects_dir)
+    dirs = [objects_dir]
+    alternates = os.path.join(objects_dir, "info", "alternates")
+    try:
+        with open(alternates, "r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return dirs
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            path = os.path.join(objects_dir, line)
+            dirs.extend(_get_object_dirs(path, seen))
+
+    return dirs
@@ -0,0 +1,118 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import collections
+import hashlib
+import json
+import os
+import time
+
+from gilt import config
+from gilt import mirror
+
+# `refs` maps each ref advertised by the origin to the id it points to.
+Remote = collections.namedtuple("Remote", ["time", "refs"])
+
+_remotes = {}
+
+
+def get(repository, ttl=0, debug=False):
+    """Return a `Remote` with the ref tips advertised by the repository's
+    origin.
+
+    The tips are listed with ``git ls-remote`` at most once per run, and
+    recorded in gilt's cache, where they are reused by later runs for `ttl`
+    seconds.
+
+    :param repository: A string containing the path to the repository.
+    :param ttl: An optional float containing the seconds the recorded tips
+     are trusted for.
+    :param debug: An optional bool to toggle debug output.
+    :return: Remote
+    """
+    if repository in _remotes:
+        return _remotes[repository]
+
+    remote = _load(repository)
+    if remote is None or time.time() - remote.time >= ttl:
+        remote = Remote(time.time(), _ls_remote(repository, debug))
+        _store(repository, remote)
+    _remotes[repository] = remote
+
+    return remote
+
+
+def forget(repository=None):
+    """Forget the tips listed during this run and return None.
+
+    :param repository: An optional string containing the path to the
+     repository, every repository is forgotten when omitted.
+    :return: None
+    """
+    if repository is None:
+        _remotes.clear()
+    else:
+        _remotes.pop(repository, None)
+
+
+def _ls_remote(repository, debug=False):
+    """List the refs of the repository's origin and return a dict.
+
+    :param repository: A string containing the path to the repository.
+    :param debug: An optional bool to toggle debug output.
+    :return: dict
+    """
+    refs = {}
+    output = mirror.run_origin(repository, ["ls-remote", "origin"], debug)
+    for line in str(output).splitlines():
+        if "\t" in line:
+            sha, name = line.split("\t", 1)
+            refs[name] = sha
+
+    return refs
+
+
+def _load(repository):
+    try:
+        with open(_get_remote_file(repository), "r") as stream:
+            return Remote(**json.load(stream))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _store(repository, remote):
+    filename = _get_remote_file(repository)
+    config._makedirs(filename)
+    tmp = config._get_temp_file(filename)
+    with open(tmp, "w") as stream:
+        json.dump(remote._asdict(), stream)
+    os.replace(tmp, filename)
+
+
+def _get_remote_file(repository):
+    """Construct the path recording the tips of the repository and return a
+    str.
+
+    :param repository: A string containing the path to the repository.
+    :return: str
+    """
+    digest = hashlib.sha1(repository.encode("utf-8")).hexdigest()
+
+    return os.path.join(config._get_remote_dir(), digest[:2], digest[2:])
@@ -18,22 +18,23 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 
+# Modules a command needs are imported by the command, so that starting
+# gilt, or asking for its version or help, stays cheap.
 import os
 
 import click
-import click_completion
-import fasteners
 
 import gilt
-from gilt import config
-from gilt import git
-from gilt import util
+from gilt import trace
 
-click_completion.init()
+if os.environ.get("_GILT_COMPLETE"):  # pragma: no cover
+    import click_completion
+
+    click_completion.init()
 
 
 class NotFoundError(Exception):
-    """Error raised when a config can not be found. """
+    """Error raised when a config can not be found."""
 
     pass
 
@@ -43,16 +44,36 @@ class NotFoundError(Exception):
     "--config",
     default="gilt.yml",
     help="Path to config file.  Default gilt.yml",
-    type=click.File("r"),
+    type=click.Path(dir_okay=False),
 )
 @click.option(
     "--debug/--no-debug",
     default=False,
     help="Enable or disable debug mode. Default is disabled.",
 )
-@click.version_option(version=gilt.__version__)
+@click.option(
+    "--trace",
+    "trace_file",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Record timed spans of each entry and phase to a Chrome trace "
+    "file, which Perfetto opens.",
+)
+@click.option(
+    "--trace-top",
+    default=10,
+    type=click.IntRange(min=0),
+    help="Number of the slowest spans to summarize with --trace.  Default 10",
+)
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=lambda ctx, param, value: _print_version(ctx, value),
+    help="Show the version and exit.",
+)
 @click.pass_context
-def main(ctx, config, debug):  # pragma: no cover
+def main(ctx, config, debug, trace_file, trace_top):  # pragma: no cover
     """
     \b
            o  o
@@ -72,41 +93,395 @@ def main(ctx, config, debug):  # pragma: no cover
     ctx.obj = {}
     ctx.obj["args"] = {}
     ctx.obj["args"]["debug"] = debug
-    ctx.obj["args"]["config"] = config.name
+    ctx.obj["args"]["config"] = config
+    if trace_file:
+        trace.enable()
+        ctx.call_on_close(lambda: _write_trace(trace_file, trace_top))
+
+
+def _print_version(ctx, value):
+    # Unlike `click.version_option`, the version is only looked up when
+    # asked for.
+    if not value or ctx.resilient_parsing:
+        return
+    click.echo("{}, version {}".format(ctx.info_name, gilt.__version__))
+    ctx.exit()
 
 
 @click.command()
+@click.option(
+    "--jobs",
+    "-j",
+    default=1,
+    type=click.IntRange(min=1),
+    help="Number of repositories to overlay entries from concurrently.  "
+    "Default 1",
+)
+@click.option(
+    "--shared-objects/--no-shared-objects",
+    default=False,
+    help="Borrow objects of new clones from a shared object store in "
+    "gilt's cache.  Default is disabled.",
+)
+@click.option(
+    "--depth",
+    type=click.IntRange(min=1),
+    help="Default history depth of new clones, unless an entry sets its "
+    "own.  Default is the full history.",
+)
+@click.option(
+    "--filter",
+    help="Default partial clone filter of new clones, such as blob:none or "
+    "tree:0, unless an entry sets its own.",
+)
+@click.option(
+    "--lock-timeout",
+    type=click.FloatRange(min=0),
+    help="Seconds to wait for a repository's lock before failing the "
+    "entry.  Default is to wait forever.",
+)
+@click.option(
+    "--post-jobs",
+    type=click.IntRange(min=1),
+    help="Number of post commands to run concurrently.  Default is the "
+    "number of CPUs.",
+)
+@click.option(
+    "--post-timeout",
+    type=click.FloatRange(min=0),
+    help="Seconds a post command may run before it is killed.  Default is "
+    "no limit.",
+)
+@click.option(
+    "--offline/--online",
+    default=False,
+    help="Never reach the remote repositories, and fail entries which "
+    "aren't available locally.  Default is online.",
+)
+@click.option(
+    "--remote-ttl",
+    default=0,
+    type=click.FloatRange(min=0),
+    help="Seconds the branch tips listed from a remote are trusted for, "
+    "before they are listed again.  Default 0",
+)
+@click.option(
+    "--frozen/--no-frozen",
+    default=False,
+    help="Overlay the commits recorded in the lock file without resolving "
+    "any version, and leave the lock file as is.  Default is disabled.",
+)
+@click.option(
+    "--cache-max-size",
+    envvar="GILT_CACHE_MAX_SIZE",
+    callback=lambda ctx, param, value: _parse(param, value, "parse_size"),
+    help="Prune gilt's cache to this size after overlaying, such as 10G.  "
+    "Default is no limit.",
+)
+@click.option(
+    "--cache-max-age",
+    envvar="GILT_CACHE_MAX_AGE",
+    callback=lambda ctx, param, value: _parse(param, value, "parse_age"),
+    help="Prune clones unused for this long from gilt's cache after "
+    "overlaying, in days or suffixed with s, m, h, d or w.  Default is no "
+    "limit.",
+)
+@click.argument("configs", nargs=-1)
 @click.pass_context
-def overlay(ctx):  # pragma: no cover
-    """Install gilt dependencies """
+def overlay(
+    ctx,
+    configs,
+    jobs,
+    shared_objects,
+    depth,
+    filter,
+    lock_timeout,
+    post_jobs,
+    post_timeout,
+    offline,
+    remote_ttl,
+    frozen,
+    cache_max_size,
+    cache_max_age,
+):  # pragma: no cover
+    """Install gilt dependencies
+
+    \b
+    Overlay the given configs, or those matching a glob such as
+    'roles/**/gilt.yml', as a single plan instead of --config.  The
+    destinations of each are relative to its directory.
+    """
+    from gilt import config
+    from gilt import engine
+    from gilt import lockfile
+    from gilt import util
+
+    args = ctx.obj.get("args")
+    debug = args.get("debug")
+    filenames = _get_config_files(configs) or [args.get("config")]
+
+    plans = []
+    with trace.span("config"):
+        for filename in filenames:
+            _setup(filename)
+            wd = None
+            if configs:
+                wd = os.path.dirname(os.path.abspath(filename))
+            entries = [
+                c._replace(depth=c.depth or depth, filter=c.filter or filter)
+                for c in config.config(filename, wd)
+            ]
+            lock_filename = lockfile.get_filename(filename)
+            if frozen:
+                pins = _load_lock_file(lock_filename)
+                entries = lockfile.freeze(entries, pins)
+            plans.append((lock_filename, entries))
+        entries = config.merge([e for _, e in plans])
+    pins = None if frozen else {}
+    errors = engine.run(
+        entries,
+        jobs=jobs,
+        shared=shared_objects,
+        lock_timeout=lock_timeout,
+        post_jobs=post_jobs,
+        post_timeout=post_timeout,
+        offline=offline,
+        remote_ttl=remote_ttl,
+        pins=pins,
+        debug=debug,
+    )
+    if errors:
+        util.print_error("Failed to overlay {} entries:".format(len(errors)))
+        for name, exc in errors:
+            util.print_error("  - {}: {}".format(name, exc))
+        ctx.exit(1)
+    if pins is not None:
+        for lock_filename, planned in plans:
+            keys = {lockfile.key(c) for c in planned}
+            lockfile.dump(lock_filename, [pins[key] for key in keys])
+    if cache_max_size is not None or cache_max_age is not None:
+        with trace.span("prune"):
+            _prune(
+                cache_max_size,
+                cache_max_age,
+                keep={c.src for c in entries},
+                summary=False,
+                debug=debug,
+            )
+
+
+@click.group("cache")
+def cache_():  # pragma: no cover
+    """Manage gilt's cache"""
+
+
+@cache_.command()
+@click.option(
+    "--max-size",
+    envvar="GILT_CACHE_MAX_SIZE",
+    callback=lambda ctx, param, value: _parse(param, value, "parse_size"),
+    help="Size the clones and shared objects may take on disk, such as 500M "
+    "or 10G.  Default is no limit.",
+)
+@click.option(
+    "--max-age",
+    envvar="GILT_CACHE_MAX_AGE",
+    callback=lambda ctx, param, value: _parse(param, value, "parse_age"),
+    help="Time a clone may go unused, in days or suffixed with s, m, h, d "
+    "or w.  Default is no limit.",
+)
+@click.pass_context
+def prune(ctx, max_size, max_age):  # pragma: no cover
+    """Evict the least recently used clones"""
+    debug = ctx.find_root().obj.get("args").get("debug")
+    if max_size is None and max_age is None:
+        raise click.UsageError("Missing --max-size or --max-age.")
+    _prune(max_size, max_age, debug=debug)
+
+
+def _parse(param, value, parser):
+    if value is None:
+        return None
+
+    from gilt import cache
+
+    try:
+        return getattr(cache, parser)(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param=param)
+
+
+def _prune(max_size, max_age, keep=(), summary=True, debug=False):
+    """Evict clones from gilt's cache, print what was evicted and return
+    None.
+
+    :param max_size: An int containing the bytes the clones may take, or
+     None.
+    :param max_age: A float containing the seconds a clone may go unused, or
+     None.
+    :param keep: An optional collection of paths of clones never evicted.
+    :param summary: An optional bool to print a summary even when nothing
+     was evicted.
+    :param debug: An optional bool to toggle debug output.
+    :return: None
+    """
+    from gilt import cache
+    from gilt import util
+
+    evicted = cache.prune(max_size, max_age, keep=keep, debug=debug)
+    for e in evicted:
+        msg = "  - evicted {} ({})".format(e.path, cache.format_size(e.size))
+        util.print_info(msg)
+    if evicted or summary:
+        freed = cache.format_size(sum(e.size for e in evicted))
+        msg = "Evicted {} clones, freed {}".format(len(evicted), freed)
+        util.print_info(msg)
+        shared = cache.shared_objects_size()
+        if shared:
+            msg = "Kept {} of shared objects".format(cache.format_size(shared))
+            util.print_info(msg)
+
+
+@click.command("status")
+@click.pass_context
+def status_(ctx):  # pragma: no cover
+    """Check the destinations still match the config"""
+    from gilt import config
+    from gilt import lockfile
+    from gilt import status
+    from gilt import util
+
     args = ctx.obj.get("args")
     filename = args.get("config")
     debug = args.get("debug")
     _setup(filename)
 
-    for c in config.config(filename):
-        with fasteners.InterProcessLock(c.lock_file):
-            util.print_info("{}:".format(c.name))
-            if not os.path.exists(c.src):
-                git.clone(c.name, c.git, c.src, debug=debug)
-            if c.dst:
-                git.extract(c.src, c.dst, c.version, debug=debug)
-                post_commands = {c.dst: c.post_commands}
+    with trace.span("config"):
+        entries = config.config(filename)
+    lock_filename = lockfile.get_filename(filename)
+    pins = None
+    if os.path.exists(lock_filename):
+        pins = lockfile.load(lock_filename)
+    results = status.check(entries, pins=pins, debug=debug)
+    if not _print_status(results):
+        util.print_error("Destinations drifted from {}".format(filename))
+        ctx.exit(1)
+
+
+def _print_status(results):
+    """Print what drifted from each entry and return whether nothing did.
+
+    :param results: A list of `status.Result` objects.
+    :return: bool
+    """
+    from gilt import status
+    from gilt import util
+
+    clean = True
+    for result in results:
+        if not result.drifts:
+            msg = "{}: up to date at {}".format(result.name, result.sha[:7])
+            util.print_info(msg)
+            continue
+        clean = False
+        util.print_warn("{}:".format(result.name))
+        for drift in result.drifts:
+            if drift.status == status.UNRESOLVED:
+                msg = "  - unable to find version {} in the clone".format(
+                    drift.path
+                )
             else:
-                git.overlay(c.src, c.files, c.version, debug=debug)
-                post_commands = {
-                    conf.dst: conf.post_commands for conf in c.files
-                }
-            # Run post commands if any.
-            for dst, commands in post_commands.items():
-                for command in commands:
-                    msg = "  - running `{}` in {}".format(command, dst)
-                    util.print_info(msg)
-                    cmd = util.build_sh_cmd(command, cwd=dst)
-                    util.run_command(cmd, debug=debug)
+                msg = "  - {} {}".format(drift.status, drift.path)
+            util.print_warn(msg)
+
+    return clean
+
+
+@click.command("daemon")
+@click.option(
+    "--socket",
+    "socket_file",
+    type=click.Path(dir_okay=False),
+    envvar="GILT_DAEMON_SOCKET",
+    help="Path of the socket to listen on, clients find it through "
+    "$GILT_DAEMON_SOCKET.  Default is daemon.sock in gilt's cache.",
+)
+def daemon_(socket_file):  # pragma: no cover
+    """Serve gilt commands, keeping what was learned warm"""
+    from gilt import config
+    from gilt import daemon
+    from gilt import util
+
+    socket_file = socket_file or config._get_socket_file()
+    util.print_info("Listening on {}".format(socket_file))
+    daemon.serve(main, socket_file)
+
+
+def _get_config_files(configs):
+    """Expand the given configs and globs and return a list of the config
+    files, each once.
+
+    :param configs: A list of strings containing paths to configs, or
+     globs, where ``**`` matches any number of directories.
+    :return: list
+    """
+    import glob
+
+    filenames = []
+    for pattern in configs:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                msg = "Unable to find a config matching {}. Exiting.".format(
+                    pattern
+                )
+                raise NotFoundError(msg)
+        else:
+            matches = [pattern]
+        for filename in matches:
+            filename = os.path.normpath(filename)
+            if filename not in filenames:
+                filenames.append(filename)
+
+    return filenames
+
+
+def _write_trace(filename, top=10):
+    """Write the recorded spans to the trace file, print a summary of the
+    slowest ones and return None.
+
+    :param filename: A string containing the path of the trace file.
+    :param top: An optional int containing the number of spans to summarize.
+    :return: None
+    """
+    from gilt import util
+
+    trace.disable()
+    trace.write(filename)
+    util.print_info("Trace written to {}".format(filename))
+    slowest = trace.slowest(top)
+    if slowest:
+        util.print_info("Slowest spans:")
+    for seconds, name, lane in slowest:
+        msg = "  {:8.3f}s  {}".format(seconds, name)
+        if lane:
+            msg += "  ({})".format(lane)
+        util.print_info(msg)
+
+
+def _load_lock_file(filename):
+    from gilt import lockfile
+
+    if not os.path.exists(filename):
+        msg = "Unable to find {}. Exiting.".format(filename)
+        raise NotFoundError(msg)
+
+    return lockfile.load(filename)
 
 
 def _setup(filename):
+    from gilt import config
+
     if not os.path.exists(filename):
         msg = "Unable to find {}. Exiting.".format(filename)
         raise NotFoundError(msg)
@@ -118,3 +493,6 @@ def _setup(filename):
 
 
 main.add_command(overlay)
+main.add_command(status_)
+main.add_command(cache_)
+main.add_command(daemon_)
@@ -0,0 +1,163 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import collections
+import hashlib
+import json
+import os
+
+from gilt import config
+
+# `files` maps each materialized path to the list returned by `stat`, which
+# `gilt status` extends with the git blob id of the file once it hashed it.
+State = collections.namedtuple("State", ["repository", "sha", "files"])
+
+
+def get(key):
+    """Load the state recorded for the given key and return a `State`.
+
+    :param key: A string identifying what was materialized, usually the
+     absolute destination path.
+    :return: State, or None when nothing was recorded or the manifest can't
+     be read.
+    """
+    try:
+        with open(_get_state_file(key), "r") as stream:
+            return State(**json.load(stream))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def put(key, state):
+    """Record the given state for the key and return None.
+
+    The manifest is written to a temporary file and moved into place, so a
+    reader never observes a partial manifest.
+
+    :param key: A string identifying what was materialized.
+    :param state: A `State` object.
+    :return: None
+    """
+    filename = _get_state_file(key)
+    config._makedirs(filename)
+    tmp = config._get_temp_file(filename)
+    with open(tmp, "w") as stream:
+        json.dump(state._asdict(), stream)
+    os.replace(tmp, filename)
+
+
+def delete(key):
+    """Forget the state recorded for the key and return None.
+
+    :param key: A string identifying what was materialized.
+    :return: None
+    """
+    try:
+        os.unlink(_get_state_file(key))
+    except FileNotFoundError:
+        pass
+
+
+def stat(paths):
+    """Record the size, modification time and inode of each path and return
+    a dict.
+
+    :param paths: A list of paths which were materialized.
+    :return: dict mapping paths to a list of their size, mtime in ns, inode
+     and blob id, which is None until the file is hashed.
+    """
+    files = {}
+    for path in paths:
+        st = os.lstat(path)
+        files[path] = [st.st_size, st.st_mtime_ns, st.st_ino, None]
+
+    return files
+
+
+def matches(st, recorded):
+    """Determine whether a file is still as recorded by `stat` or not.
+
+    Manifests written before inodes were recorded only compare the size and
+    modification time.
+
+    :param st: An `os.stat_result` of the file.
+    :param recorded: The list `stat` recorded for the file.
+    :return: bool
+    """
+    current = [st.st_size, st.st_mtime_ns, st.st_ino]
+    recorded = recorded[:3]
+
+    return current[: len(recorded)] == recorded
+
+
+def is_unmodified(s):
+    """Determine whether every recorded file is still as it was written or
+    not.
+
+    :param s: A `State` object.
+    :return: bool
+    """
+    if not isinstance(s.files, dict):
+        return False
+    for path, recorded in s.files.items():
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if not matches(st, recorded):
+            return False
+
+    return True
+
+
+def is_current(key, repository, sha):
+    """Determine whether the key is already materialized at sha or not.
+
+    Every recorded file must still be as it was written, so a destination
+    edited since is materialized again.  A current destination's manifest
+    is touched, so `cache.prune` keeps it.
+
+    :param key: A string identifying what was materialized.
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the resolved commit id.
+    :return: bool
+    """
+    s = get(key)
+    if s is None or s.repository != repository or s.sha != sha:
+        return False
+    if not is_unmodified(s):
+        return False
+    try:
+        os.utime(_get_state_file(key))
+    except OSError:
+        pass
+
+    return True
+
+
+def _get_state_file(key):
+    """Construct the manifest path of the key and return a str.
+
+    :param key: A string identifying what was materialized.
+    :return: str
+    """
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    return os.path.join(config._get_state_dir(), digest[:2], digest[2:])
@@ -0,0 +1,198 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import collections
+import hashlib
+import os
+import stat
+
+from gilt import git
+from gilt import lockfile
+from gilt import state
+from gilt import trace
+
+Result = collections.namedtuple("Result", ["name", "sha", "drifts"])
+Drift = collections.namedtuple("Drift", ["status", "path"])
+
+MISSING = "missing"
+MODIFIED = "modified"
+EXTRA = "extra"
+UNRESOLVED = "unresolved"
+
+_CHUNK = 1024 * 1024
+
+
+@trace.traced("status")
+def check(entries, pins=None, debug=False):
+    """Compare the destinations of the entries against the commits they are
+    expected at and return a list of `Result` objects, one per entry.
+
+    An entry is expected at the commit recorded for it in the lock file, or
+    else at the commit its version resolves to in the clone, as last
+    fetched; nothing is fetched.  Files are only hashed when their size,
+    modification time or inode differ from those recorded when gilt wrote
+    or last hashed them, and the hashes are recorded in turn.  Files which
+    post commands may have created aren't reported as extra, so the
+    destinations of an entry with post commands aren't checked for them.
+
+    :param entries: A list of `Config` objects.
+    :param pins: An optional dict mapping (git, version) tuples to
+     `lockfile.Pin` objects.
+    :param debug: An optional bool to toggle debug output.
+    :return: list
+    """
+    results = []
+    for c in entries:
+        sha = _get_sha(c, pins or {}, debug)
+        if sha is None:
+            drifts = [Drift(UNRESOLVED, c.version)]
+        else:
+            drifts = []
+            for target in git.get_targets(c.src, sha, c, debug):
+                drifts.extend(
+                    _check_target(c.src, sha, target, not c.post_commands)
+                )
+        results.append(Result(c.name, sha, drifts))
+
+    return results
+
+
+def _get_sha(c, pins, debug=False):
+    """Return the commit id the entry is expected at.
+
+    :param c: A `Config` object.
+    :param pins: A dict mapping (git, version) tuples to `lockfile.Pin`
+     objects.
+    :param debug: An optional bool to toggle debug output.
+    :return: str, or None when the clone doesn't have the commit.
+    """
+    if not os.path.exists(c.src):
+        return None
+    pin = pins.get(lockfile.key(c))
+    if pin is not None:
+        sha = pin.sha
+    else:
+        ref = git._resolve_version(c.src, c.version, debug)
+        if ref is None:
+            return None
+        sha = ref.sha
+    if git.get_tree(c.src, sha, debug) is None:
+        return None
+
+    return sha
+
+
+def _check_target(repository, sha, target, extra=True):
+    """Compare a destination against the files it is expected to hold and
+    return a list of `Drift` objects.
+
+    :param repository: A string containing the path to the repository.
+    :param sha: A string containing the expected commit id.
+    :param target: A `git.Target` object.
+    :param extra: An optional bool to report the files the destination
+     holds but isn't expected to.
+    :return: list
+    """
+    s = state.get(target.key)
+    if s is None or not isinstance(s.files, dict):
+        s = state.State(None, None, {})
+    current = s.repository == repository and s.sha == sha
+
+    drifts = []
+    files = {}
+    for path, entry in sorted(target.files.items()):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            drifts.append(Drift(MISSING, path))
+            continue
+        recorded = s.files.get(path)
+        blob = None
+        if recorded is not None and state.matches(st, recorded):
+            if len(recorded) > 3 and recorded[3]:
+                blob = recorded[3]
+            elif current:
+                blob = entry.sha
+        if blob is None:
+            blob = hash_file(path, st)
+        if blob != entry.sha or not _has_mode(st, entry.mode):
+            drifts.append(Drift(MODIFIED, path))
+            continue
+        files[path] = [st.st_size, st.st_mtime_ns, st.st_ino, blob]
+    if extra and target.root is not None:
+        for path in _walk(target.root):
+            if path not in target.files:
+                drifts.append(Drift(EXTRA, path))
+
+    if current:
+        files = dict(s.files, **files)
+    elif drifts:
+        return drifts
+    if files != s.files:
+        state.put(target.key, state.State(repository, sha, files))
+
+    return drifts
+
+
+def hash_file(path, st=None):
+    """Compute the git blob id of a file, or of the target of a symlink,
+    and return a str.
+
+    :param path: A string containing the path of the file.
+    :param st: An optional `os.stat_result` of the file, from `os.lstat`.
+    :return: str, or None when the path is neither a file nor a symlink.
+    """
+    st = st or os.lstat(path)
+    h = hashlib.sha1()
+    if stat.S_ISLNK(st.st_mode):
+        data = os.fsencode(os.readlink(path))
+        h.update("blob {}\0".format(len(data)).encode())
+        h.update(data)
+    elif stat.S_ISREG(st.st_mode):
+        with open(path, "rb") as f:
+            h.update("blob {}\0".format(st.st_size).encode())
+            for chunk in iter(lambda: f.read(_CHUNK), b""):
+                h.update(chunk)
+    else:
+        return None
+
+    return h.hexdigest()
+
+
+def _has_mode(st, mode):
+    if mode == "120000":
+        return stat.S_ISLNK(st.st_mode)
+    executable = bool(st.st_mode & stat.S_IXUSR)
+
+    return stat.S_ISREG(st.st_mode) and executable == (mode == "100755")
+
+
+def _walk(top):
+    """Return a sorted list of the files and symlinks below a directory. """
+    paths = []
+    for root, dirs, files in os.walk(top):
+        paths.extend(os.path.join(root, name) for name in files)
+        paths.extend(
+            os.path.join(root, name)
+            for name in dirs
+            if os.path.islink(os.path.join(root, name))
+        )
+
+    return sorted(paths)
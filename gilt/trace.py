@@ -0,0 +1,193 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+_events = []
+_events_lock = threading.Lock()
+_lanes = {}
+_local = threading.local()
+_enabled = False
+_origin = 0.0
+
+
+def enable():
+    """Start recording spans and return None.
+
+    Spans recorded before are discarded.
+    """
+    global _enabled, _origin
+    with _events_lock:
+        del _events[:]
+        _lanes.clear()
+        _origin = time.monotonic()
+        _enabled = True
+
+
+def disable():
+    """Stop recording spans and return None. """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def lane(name):
+    """Return the id of the lane, a track of the trace, with the given name.
+
+    Spans of an entry are recorded on the entry's lane, whichever thread
+    runs them.
+
+    :param name: A string containing the name of the lane.
+    :return: int, or None when not recording.
+    """
+    if not _enabled:
+        return None
+    with _events_lock:
+        if name not in _lanes:
+            _lanes[name] = len(_lanes) + 1
+            _events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": _lanes[name],
+                    "args": {"name": name},
+                }
+            )
+
+        return _lanes[name]
+
+
+def bind(lane_id, func):
+    """Return a function calling func with its spans recorded on the lane.
+
+    :param lane_id: An int containing the id of the lane, or None.
+    :param func: A callable.
+    :return: function
+    """
+    if lane_id is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "lane", None)
+        _local.lane = lane_id
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.lane = previous
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def span(name, cat="phase", lane_id=None, **args):
+    """Context manager to record the time spent in its block as a span.
+
+    :param name: A string containing the name of the span.
+    :param cat: An optional string containing the category of the span.
+    :param lane_id: An optional int containing the id of the lane, defaults
+     to the lane bound to the thread, or the thread itself.
+    :param args: Details of the span.
+    """
+    if not _enabled:
+        yield
+        return
+
+    if lane_id is None:
+        lane_id = getattr(_local, "lane", None) or threading.get_ident()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        end = time.monotonic()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round((start - _origin) * 1e6, 3),
+            "dur": round((end - start) * 1e6, 3),
+            "pid": os.getpid(),
+            "tid": lane_id,
+            "args": args,
+        }
+        with _events_lock:
+            _events.append(event)
+
+
+def traced(name, cat="phase"):
+    """Decorator to record each call of the function as a span.
+
+    :param name: A string containing the name of the span.
+    :param cat: An optional string containing the category of the span.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def events():
+    """Return a list of the recorded trace events. """
+    with _events_lock:
+        return list(_events)
+
+
+def write(filename):
+    """Write the recorded spans as a Chrome trace, which Perfetto and
+    chrome://tracing open, and return None.
+
+    :param filename: A string containing the path of the trace file.
+    :return: None
+    """
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events(), "displayTimeUnit": "ms"}, f)
+
+
+def slowest(count=10):
+    """Return a list of the slowest spans as (seconds, name, lane name)
+    tuples, slowest first.
+
+    :param count: An optional int containing the number of spans.
+    :return: list
+    """
+    recorded = events()
+    names = {e["tid"]: e["args"]["name"] for e in recorded if e["ph"] == "M"}
+    spans = [
+        (e["dur"] / 1e6, e["name"], names.get(e["tid"], ""))
+        for e in recorded
+        if e["ph"] == "X"
+    ]
+
+    return sorted(spans, key=lambda s: s[0], reverse=True)[:count]
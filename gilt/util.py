@@ -25,36 +25,101 @@ import errno
 import os
 import sh
 import shutil
+import threading
 
 import click
 import colorama
+import fasteners
 
-colorama.init(autoreset=True)
+from gilt import trace
+
+_output = threading.local()
+_output_lock = threading.Lock()
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
 
 
 def print_info(msg):
-    """Print the given message to STDOUT. """
-    click.echo(msg)
+    """Print the given message to STDOUT."""
+    _echo(msg)
 
 
 def print_warn(msg):
-    """Print the given message to STDOUT in YELLOW. """
-    click.echo("{}{}".format(colorama.Fore.YELLOW, msg))
+    """Print the given message to STDOUT in YELLOW."""
+    _echo(_colored(colorama.Fore.YELLOW, msg))
+
+
+def print_error(msg):
+    """Print the given message to STDOUT in RED."""
+    _echo(_colored(colorama.Fore.RED, msg))
+
+
+def _colored(color, msg):
+    # `click.echo` strips the colors when STDOUT isn't a terminal, and
+    # converts them on Windows, so colorama doesn't need to wrap STDOUT.
+    return "{}{}{}".format(color, msg, colorama.Style.RESET_ALL)
+
+
+@contextlib.contextmanager
+def captured_output():
+    """Context manager to capture the current thread's output into the list
+    it yields, instead of printing it."""
+    previous = getattr(_output, "buffer", None)
+    _output.buffer = buffer = []
+    try:
+        yield buffer
+    finally:
+        _output.buffer = previous
+
+
+def print_block(messages):
+    """Print the given messages to STDOUT without interleaving."""
+    with _output_lock:
+        for msg in messages:
+            click.echo(msg)
+
+
+def _echo(msg):
+    buffer = getattr(_output, "buffer", None)
+    if buffer is not None:
+        buffer.append(msg)
+    else:
+        click.echo(msg)
 
 
 def run_command(cmd, debug=False):
-    """Execute the given command and return None.
+    """Execute the given command and return its result.
 
     :param cmd: A `sh.Command` object to execute.
     :param debug: An optional bool to toggle debug output.
-    :return: None
+    :return: `sh.RunningCommand`
     """
     if debug:
-        msg = "  PWD: {}".format(os.getcwd())
+        cwd = cmd._partial_call_args.get("cwd") or os.getcwd()
+        msg = "  PWD: {}".format(cwd)
         print_warn(msg)
         msg = "  COMMAND: {}".format(cmd)
         print_warn(msg)
-    cmd()
+    if cmd._partial_call_args.get("bg"):
+        # Background commands are traced by their callers, which wait.
+        return cmd()
+    with trace.span(describe_command(cmd), cat="command", command=str(cmd)):
+        return cmd()
+
+
+def describe_command(cmd):
+    """Return a short name of the command, the program and its first
+    argument, such as ``git fetch``.
+
+    :param cmd: A `sh.Command` object.
+    :return: str
+    """
+    argv = str(cmd).split()
+    # Skip the configuration of the command, like ``-c url.<base>.insteadOf``.
+    while argv[1:2] == ["-c"]:
+        del argv[1:3]
+
+    return " ".join([os.path.basename(argv[0])] + argv[1:2])
 
 
 def build_sh_cmd(cmd, cwd=None):
@@ -70,7 +135,7 @@ def build_sh_cmd(cmd, cwd=None):
 
 @contextlib.contextmanager
 def saved_cwd():
-    """Context manager to restore previous working directory. """
+    """Context manager to restore previous working directory."""
     saved = os.getcwd()
     try:
         yield
@@ -78,6 +143,19 @@ def saved_cwd():
         os.chdir(saved)
 
 
+@contextlib.contextmanager
+def lock(lock_file):
+    """Context manager to hold a lock file across threads and processes.
+
+    `fasteners.InterProcessLock` is process wide, so workers of the same
+    process also serialize on a thread lock for the same file.
+    """
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(lock_file, threading.Lock())
+    with thread_lock, fasteners.InterProcessLock(lock_file):
+        yield
+
+
 def copy(src, dst):
     """Handle the copying of a file or directory.
 
@@ -24,6 +24,9 @@ import shutil
 import string
 
 import pytest
+import sh
+
+from gilt import git
 
 pytest_plugins = ["helpers_namespace"]
 
@@ -36,6 +39,21 @@ def random_string(len=5):
     return "".join(random.choice(string.ascii_uppercase) for _ in range(len))
 
 
+@pytest.fixture(autouse=True)
+def gilt_cache_dir(tmpdir, monkeypatch):
+    d = tmpdir.join(".gilt").strpath
+    monkeypatch.setattr("gilt.config.BASE_WORKING_DIR", d)
+
+    return d
+
+
+@pytest.fixture(autouse=True)
+def gilt_fetches():
+    yield
+
+    git.forget_fetches()
+
+
 @pytest.fixture()
 def temp_dir(tmpdir, request):
     _cwd = os.getcwd()
@@ -77,6 +95,58 @@ def gilt_data():
     ]
 
 
+@pytest.fixture()
+def git_repo(tmpdir):
+    """A local repository with a `master` and `feature` branch, a
+    lightweight `1.0` tag and an annotated `1.1` tag."""
+    d = tmpdir.mkdir(random_string()).strpath
+    git = sh.git.bake(
+        "-c",
+        "user.name=gilt",
+        "-c",
+        "user.email=gilt@example.com",
+        _cwd=d,
+    )
+    git("init", "--quiet")
+    git("checkout", "--quiet", "-b", "master")
+    for filename in ("foo", "bar"):
+        with open(os.path.join(d, filename), "w") as f:
+            f.write(filename)
+        git("add", filename)
+        git("commit", "--quiet", "-m", filename)
+    git("tag", "1.0")
+    git("tag", "-a", "-m", "1.1", "1.1")
+    git("checkout", "--quiet", "-b", "feature")
+    with open(os.path.join(d, "baz"), "w") as f:
+        f.write("baz")
+    git("add", "baz")
+    git("commit", "--quiet", "-m", "baz")
+    git("checkout", "--quiet", "master")
+
+    return d
+
+
+@pytest.helpers.register
+def git_commit(repository, message):
+    sh.git("add", "--all", _cwd=repository)
+    sh.git(
+        "-c",
+        "user.name=gilt",
+        "-c",
+        "user.email=gilt@example.com",
+        "commit",
+        "--quiet",
+        "-m",
+        message,
+        _cwd=repository,
+    )
+
+
+@pytest.helpers.register
+def git_rev_parse(repository, rev):
+    return str(sh.git("rev-parse", rev, _cwd=repository)).strip()
+
+
 @pytest.helpers.register
 def os_split(s):
     rest, tail = os.path.split(s)
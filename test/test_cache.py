@@ -0,0 +1,193 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from gilt import cache
+from gilt import config
+
+
+def _clone(name, size=0, last_used=None):
+    path = os.path.join(config._get_clone_dir(), "host", name)
+    os.makedirs(path)
+    with open(os.path.join(path, "data"), "wb") as f:
+        f.write(b"x" * size)
+    lock_file = os.path.join(config._get_lock_dir(), "host", name)
+    config._makedirs(lock_file)
+    open(lock_file, "a").close()
+    if last_used is not None:
+        os.utime(lock_file, (last_used, last_used))
+
+    return path
+
+
+def test_touch(temp_dir):
+    path = _clone("foo", last_used=1000)
+    cache.touch(os.path.join(config._get_lock_dir(), "host", "foo"))
+    cache.touch(os.path.join(temp_dir.strpath, "missing"))
+
+    assert cache._last_used(path) > 1000
+
+
+def test_entries():
+    old = _clone("old", 1000, last_used=1000)
+    new = _clone("new", last_used=2000)
+    entries = cache.entries()
+
+    assert [old, new] == [e.path for e in entries]
+    assert [1000, 2000] == [e.last_used for e in entries]
+    assert entries[0].size >= 1000
+
+
+def test_prune_by_age():
+    _clone("old", last_used=1000)
+    new = _clone("new", last_used=5000)
+    evicted = cache.prune(max_age=2000, now=6000)
+
+    assert ["old"] == [os.path.basename(e.path) for e in evicted]
+    assert [new] == [e.path for e in cache.entries()]
+
+
+def test_prune_by_size_evicts_least_recently_used():
+    _clone("a", 8192, last_used=3000)
+    _clone("b", 8192, last_used=1000)
+    _clone("c", 8192, last_used=2000)
+    total = sum(e.size for e in cache.entries())
+    evicted = cache.prune(max_size=total - 1)
+
+    assert ["b"] == [os.path.basename(e.path) for e in evicted]
+
+    evicted = cache.prune(max_size=0, keep={cache.entries()[-1].path})
+
+    assert ["c"] == [os.path.basename(e.path) for e in evicted]
+    assert ["a"] == [os.path.basename(e.path) for e in cache.entries()]
+
+
+def test_prune_keeps_clones_in_use():
+    path = _clone("foo", 8192, last_used=1000)
+    lock_file = os.path.join(config._get_lock_dir(), "host", "foo")
+    code = (
+        "import sys, time, fasteners\n"
+        "lock = fasteners.InterProcessReaderWriterLock(sys.argv[1])\n"
+        "lock.acquire_read_lock()\n"
+        "print('locked', flush=True)\n"
+        "time.sleep(30)\n"
+    )
+    args = [sys.executable, "-c", code, lock_file]
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    try:
+        assert b"locked\n" == proc.stdout.readline()
+
+        assert [] == cache.prune(max_size=0)
+        assert os.path.isdir(path)
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+    assert [path] == [e.path for e in cache.prune(max_size=0)]
+
+
+def test_prune_keeps_clones_used_since_listed(mocker):
+    path = _clone("foo", 8192, last_used=1000)
+    listed = cache.entries()
+    mocker.patch("gilt.cache.entries", return_value=listed)
+    cache.touch(listed[0].lock_file)
+
+    assert [] == cache.prune(max_size=0)
+    assert os.path.isdir(path)
+
+
+@pytest.mark.parametrize(
+    "get_dir",
+    [config._get_parse_dir, config._get_state_dir, config._get_remote_dir],
+)
+def test_prune_expires_records(get_dir):
+    old = os.path.join(get_dir(), "ab", "old")
+    new = os.path.join(get_dir(), "ab", "new")
+    for path in (old, new):
+        config._makedirs(path)
+        open(path, "w").close()
+    os.utime(old, (1000, 1000))
+    cache.prune()
+
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+
+    cache.prune(max_age=0, now=os.stat(new).st_mtime + 1)
+
+    assert not os.path.exists(new)
+
+
+def test_prune_counts_shared_objects():
+    _clone("foo", 8192, last_used=1000)
+    pack = os.path.join(config._get_objects_dir(), "objects", "pack", "p")
+    config._makedirs(pack)
+    with open(pack, "wb") as f:
+        f.write(b"\0" * 65536)
+    shared = cache.shared_objects_size()
+    clones = sum(e.size for e in cache.entries())
+
+    assert shared >= 65536
+    assert [] == cache.prune(max_size=shared + clones)
+    assert ["foo"] == [
+        os.path.basename(e.path)
+        for e in cache.prune(max_size=shared + clones - 1)
+    ]
+    assert os.path.exists(pack)
+
+
+def test_prune_empties_trash():
+    trash = os.path.join(config._get_trash_dir(), "left", "clone")
+    os.makedirs(trash)
+    cache.prune(max_size=0)
+
+    assert [] == os.listdir(config._get_trash_dir())
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("100", 100), ("1k", 1024), ("1.5M", 1572864), ("10GiB", 10 << 30)],
+)
+def test_parse_size(value, expected):
+    assert expected == cache.parse_size(value)
+
+
+@pytest.mark.parametrize(
+    "value, expected", [("2", 172800), ("30s", 30), ("1.5h", 5400)]
+)
+def test_parse_age(value, expected):
+    assert expected == cache.parse_age(value)
+
+
+@pytest.mark.parametrize("parse", [cache.parse_size, cache.parse_age])
+def test_parse_invalid(parse):
+    with pytest.raises(ValueError):
+        parse("ten")
+
+
+def test_format_size():
+    assert "512B" == cache.format_size(512)
+    assert "1.5K" == cache.format_size(1536)
+    assert "2.0G" == cache.format_size(2 << 30)
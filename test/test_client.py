@@ -0,0 +1,42 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+from gilt import client
+
+
+def test_run_without_daemon(tmpdir):
+    socket_file = tmpdir.join("daemon.sock").strpath
+
+    assert client.run(["overlay"], socket_file) is None
+
+
+def test_get_socket_file(monkeypatch, gilt_cache_dir):
+    monkeypatch.setenv("GILT_CACHE_DIRECTORY", gilt_cache_dir)
+    monkeypatch.delenv("GILT_DAEMON_SOCKET", raising=False)
+
+    assert os.path.join(gilt_cache_dir, "daemon.sock") == (
+        client.get_socket_file()
+    )
+
+    monkeypatch.setenv("GILT_DAEMON_SOCKET", "/tmp/gilt.sock")
+
+    assert "/tmp/gilt.sock" == client.get_socket_file()
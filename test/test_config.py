@@ -18,7 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import concurrent.futures
+import json
 import os
+import stat
+import threading
 
 import pytest
 
@@ -51,6 +55,8 @@ def test_config(gilt_config_file):
     ) == os_split(r.lock_file)[-4:]
     assert ("roles", "retr0h.ansible-etcd", "") == os_split(r.dst)[-3:]
     assert [] == r.files
+    assert r.depth is None
+    assert r.filter is None
 
     r = result[1]
     assert "https://github.com/lorin/openstack-ansible-modules.git" == r.git
@@ -336,6 +342,31 @@ def test_get_config_generator(gilt_config_file):
     assert isinstance(result[0], dict)
 
 
+@pytest.fixture()
+def numeric_version_gilt_data():
+    return """
+- git: https://github.com/retr0h/ansible-etcd.git
+  version: 1.10
+  dst: roles/retr0h.ansible-etcd/
+- git: https://github.com/retr0h/ansible-etcd.git
+  version: 2020-01-01
+  dst: roles/retr0h.ansible-etcd/
+"""
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file",
+    ["numeric_version_gilt_data"],
+    indirect=["gilt_config_file"],
+)
+def test_get_config_generator_numeric_version(gilt_config_file):
+    result = [
+        c["version"] for c in config._get_config_generator(gilt_config_file)
+    ]
+
+    assert ["1.10", "2020-01-01"] == result
+
+
 def test_get_files_generator(temp_dir):
     files_list = [{"src": "foo", "dst": "bar/"}]
     result = [i for i in config._get_files_generator("/tmp/dir", files_list)]
@@ -344,6 +375,20 @@ def test_get_files_generator(temp_dir):
     assert isinstance(result[0], dict)
 
 
+def test_get_files_generator_patterns(temp_dir):
+    files_list = [
+        {"src": ["roles/**/*.yml", "!roles/**/tests"], "dst": "bar/"}
+    ]
+    result = list(config._get_files_generator("/tmp/dir", files_list))
+
+    assert (
+        "/tmp/dir/roles/**/*.yml",
+        "!/tmp/dir/roles/**/tests",
+    ) == result[
+        0
+    ]["src"]
+
+
 @pytest.mark.parametrize(
     "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
 )
@@ -380,6 +425,21 @@ def test_get_clone_dir():
     assert (gilt_root, "clone") == parts[-2:]
 
 
+def test_get_temp_file_is_unique_per_thread():
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        barrier = threading.Barrier(2)
+
+        def get():
+            barrier.wait()
+            return config._get_temp_file("/tmp/foo")
+
+        futures = [executor.submit(get) for _ in range(2)]
+    first, second = [f.result() for f in futures]
+
+    assert first != second
+    assert first.startswith("/tmp/foo.")
+
+
 def test_makedirs(temp_dir):
     config._makedirs("foo/")
 
@@ -424,3 +484,193 @@ def test_makedirs_passes_if_exists(temp_dir):
 def test_makedirs_raises(temp_dir):
     with pytest.raises(OSError):
         config._makedirs("")
+
+
+def test_get_depth():
+    assert config._get_depth(None) is None
+    assert 1 == config._get_depth(1)
+
+
+@pytest.mark.parametrize("depth", [0, -1, "1", True])
+def test_get_depth_raises(depth):
+    with pytest.raises(config.ParseError):
+        config._get_depth(depth)
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_config_does_not_create_dst_dirs(gilt_config_file, temp_dir):
+    config.config(gilt_config_file)
+
+    assert not os.path.exists(os.path.join(temp_dir.strpath, "roles"))
+    assert not os.path.exists(os.path.join(temp_dir.strpath, "library"))
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_get_config_is_cached(mocker, gilt_config_file):
+    first = config._get_config(gilt_config_file)
+    spy = mocker.spy(config.yaml, "load")
+    second = config._get_config(gilt_config_file)
+
+    assert first == second
+    assert not spy.called
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_get_config_is_kept_in_memory(mocker, gilt_config_file):
+    first = config._get_config(gilt_config_file)
+    spy = mocker.spy(config.json, "load")
+    second = config._get_config(gilt_config_file)
+
+    assert first is second
+    assert not spy.called
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_get_config_is_cached_as_json(mocker, gilt_config_file):
+    first = config._get_config(gilt_config_file)
+    mocker.patch.dict(config._parsed, clear=True)
+    spy = mocker.spy(config.yaml, "load")
+    second = config._get_config(gilt_config_file)
+    with open(gilt_config_file) as f:
+        cache_file = config._get_parse_cache_file(f.read())
+    with open(cache_file) as f:
+        recorded = json.load(f)
+
+    assert first == second == recorded
+    assert not spy.called
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_get_config_cache_is_private(gilt_config_file):
+    umask = os.umask(0o022)
+    try:
+        config._get_config(gilt_config_file)
+    finally:
+        os.umask(umask)
+    with open(gilt_config_file) as f:
+        cache_file = config._get_parse_cache_file(f.read())
+
+    assert 0o600 == stat.S_IMODE(os.stat(cache_file).st_mode)
+
+
+@pytest.fixture()
+def dated_gilt_data():
+    return """
+- git: https://github.com/retr0h/ansible-etcd.git
+  version: master
+  dst: roles/retr0h.ansible-etcd/
+  released: 2020-01-01
+"""
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["dated_gilt_data"], indirect=["gilt_config_file"]
+)
+def test_get_config_skips_caching_values_json_cannot_hold(gilt_config_file):
+    result = next(config._get_config_generator(gilt_config_file))
+
+    assert "master" == result["version"]
+    assert not os.path.exists(config._get_parse_dir())
+
+
+@pytest.fixture()
+def interpolated_gilt_data():
+    return """
+- git: https://github.com/retr0h/ansible-etcd.git
+  version: ${GILT_TEST_VERSION:-master}
+  dst: roles/retr0h.ansible-etcd/
+"""
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file",
+    ["interpolated_gilt_data"],
+    indirect=["gilt_config_file"],
+)
+def test_get_config_cache_tracks_environment(monkeypatch, gilt_config_file):
+    monkeypatch.delenv("GILT_TEST_VERSION", raising=False)
+    assert "master" == config._get_config(gilt_config_file)[0]["version"]
+
+    monkeypatch.setenv("GILT_TEST_VERSION", "v1.1")
+    assert "v1.1" == config._get_config(gilt_config_file)[0]["version"]
+
+    monkeypatch.delenv("GILT_TEST_VERSION")
+    assert "master" == config._get_config(gilt_config_file)[0]["version"]
+
+
+@pytest.fixture()
+def secret_gilt_data():
+    return """
+- git: https://${GILT_TEST_TOKEN}@github.com/retr0h/ansible-etcd.git
+  version: master
+  dst: roles/retr0h.ansible-etcd/
+"""
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["secret_gilt_data"], indirect=["gilt_config_file"]
+)
+def test_config_keeps_git_as_written(monkeypatch, gilt_config_file):
+    monkeypatch.setenv("GILT_TEST_TOKEN", "secret")
+    (c,) = config.config(gilt_config_file)
+
+    assert "https://secret@github.com/retr0h/ansible-etcd.git" == c.git
+    x = "https://${GILT_TEST_TOKEN}@github.com/retr0h/ansible-etcd.git"
+    assert x == c.raw_git
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_config_raw_git_without_variables(gilt_config_file):
+    c = config.config(gilt_config_file)[0]
+
+    assert c.git == c.raw_git
+
+
+def test_get_variables():
+    content = "$FOO ${BAR} ${BAZ:-default} ${QUX-default} $$NOT"
+
+    assert {"FOO", "BAR", "BAZ", "QUX"} == config._get_variables(content)
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_config_relative_to_wd(gilt_config_file):
+    r = config.config(gilt_config_file, wd="/work")[0]
+
+    assert "/work/roles/retr0h.ansible-etcd/" == r.dst
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_merge(gilt_config_file):
+    first = config.config(gilt_config_file, wd="/a")
+    second = config.config(gilt_config_file, wd="/b")
+    merged = config.merge([first, second, first])
+
+    assert first + second == merged
+    assert first[0].lock_file == second[0].lock_file
+
+
+@pytest.mark.parametrize(
+    "gilt_config_file", ["gilt_data"], indirect=["gilt_config_file"]
+)
+def test_merge_conflicting_dst(gilt_config_file):
+    entries = config.config(gilt_config_file)
+    other = [entries[0]._replace(version="other")]
+
+    with pytest.raises(config.ParseError):
+        config.merge([entries, other])
@@ -0,0 +1,116 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from gilt import client
+from gilt import daemon
+
+# The daemon redirects the output of its whole process, so it is run apart
+# from the client.
+DAEMON = """
+import os, sys, click
+from gilt import daemon
+
+@click.command()
+@click.argument("name")
+def hello(name):
+    click.echo("hello {} from {}".format(name, os.getcwd()))
+    click.echo(os.environ.get("GILT_TEST_GREETING"), err=True)
+    if name == "fail":
+        sys.exit(3)
+    if name == "boom":
+        raise ValueError("boom")
+
+daemon.serve(hello, sys.argv[1])
+"""
+
+
+@pytest.fixture()
+def socket_file(tmpdir):
+    return tmpdir.join("daemon.sock").strpath
+
+
+@pytest.fixture()
+def server(socket_file):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(daemon.__file__))
+    args = [sys.executable, "-c", DAEMON, socket_file]
+    proc = subprocess.Popen(args, env=env)
+    while not daemon._is_listening(socket_file):
+        assert proc.poll() is None
+        time.sleep(0.05)
+
+    yield proc
+
+    proc.terminate()
+    proc.wait()
+
+
+def test_invocation(capsys, monkeypatch, temp_dir, server, socket_file):
+    monkeypatch.setenv("GILT_TEST_GREETING", "hi")
+    result = client.run(["gilt"], socket_file)
+    out, err = capsys.readouterr()
+
+    assert 0 == result
+    assert "hello gilt from {}\n".format(temp_dir.strpath) == out
+    assert "hi\n" == err
+
+
+def test_invocation_exit_code(capsys, server, socket_file):
+    assert 3 == client.run(["fail"], socket_file)
+
+
+def test_invocation_error(capsys, server, socket_file):
+    result = client.run(["boom"], socket_file)
+    _, err = capsys.readouterr()
+
+    assert 1 == result
+    assert "ValueError: boom" in err
+
+
+def test_environment(monkeypatch, temp_dir):
+    cwd = os.getcwd()
+    monkeypatch.setenv("GILT_TEST_GREETING", "hi")
+    with daemon._environment("/", {"GILT_TEST_OTHER": "1"}):
+        assert "/" == os.getcwd()
+        assert {"GILT_TEST_OTHER": "1"} == dict(os.environ)
+
+    assert cwd == os.getcwd()
+    assert "hi" == os.environ["GILT_TEST_GREETING"]
+    assert "GILT_TEST_OTHER" not in os.environ
+
+
+def test_make_server_raises_when_listening(server, socket_file):
+    with pytest.raises(daemon.DaemonError):
+        daemon._make_server(None, socket_file)
+
+
+def test_make_server_replaces_stale_socket(socket_file):
+    open(socket_file, "w").close()
+    server = daemon._make_server(None, socket_file)
+    server.server_close()
+
+    assert 0o600 == os.stat(socket_file).st_mode & 0o777
@@ -0,0 +1,432 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from gilt import config
+from gilt import engine
+
+
+@pytest.fixture()
+def entries(mocker, temp_dir):
+    return [
+        mocker.Mock(
+            lock_file=os.path.join(temp_dir.strpath, name + ".lock"),
+            src=temp_dir.strpath,
+            dst=os.path.join(temp_dir.strpath, name),
+            files=[],
+            post_commands=[],
+        )
+        for name in ("foo", "bar", "baz")
+    ]
+
+
+@pytest.fixture()
+def hold_lock():
+    """Hold a lock file from another process until the test ends."""
+    code = (
+        "import sys, time, fasteners\n"
+        "lock = fasteners.InterProcessReaderWriterLock(sys.argv[1])\n"
+        "if sys.argv[2] == 'write':\n"
+        "    lock.acquire_write_lock()\n"
+        "else:\n"
+        "    lock.acquire_read_lock()\n"
+        "print('locked', flush=True)\n"
+        "time.sleep(float(sys.argv[3]))\n"
+    )
+    procs = []
+
+    def hold(lock_file, mode, seconds=30):
+        args = [sys.executable, "-c", code, lock_file, mode, str(seconds)]
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        procs.append(proc)
+        proc.stdout.readline()
+
+    yield hold
+
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+
+@pytest.fixture(autouse=True)
+def patched_is_pinned(mocker):
+    return mocker.patch("gilt.git.is_pinned", return_value=False)
+
+
+@pytest.fixture(autouse=True)
+def names(entries):
+    for c, name in zip(entries, ("foo", "bar", "baz")):
+        c.name = name
+
+
+def test_run(mocker, entries):
+    patched_extract = mocker.patch("gilt.git.extract")
+    errors = engine.run(entries, jobs=2)
+
+    assert [] == errors
+    assert 3 == patched_extract.call_count
+
+
+def test_run_fails_fast(mocker, entries):
+    mocker.patch("gilt.git.extract").side_effect = [
+        Exception("boom"),
+        None,
+        None,
+    ]
+    errors = engine.run(entries, jobs=1)
+
+    assert 1 == len(errors)
+    name, exc = errors[0]
+    assert "foo" == name
+    assert "boom" == str(exc)
+    assert 1 == engine.git.extract.call_count
+
+
+def test_run_buffers_output(mocker, capsys, entries):
+    def extract(src, dst, version, **kwargs):
+        engine.util.print_info("  - extracting {}".format(dst))
+
+    mocker.patch("gilt.git.extract", side_effect=extract)
+    engine.run(entries, jobs=3)
+
+    result, _ = capsys.readouterr()
+    lines = result.splitlines()
+    for c in entries:
+        i = lines.index("{}:".format(c.name))
+        assert "  - extracting {}".format(c.dst) == lines[i + 1]
+
+
+def test_run_post_commands(mocker, entries):
+    mocker.patch("gilt.git.extract")
+    for c in entries:
+        os.mkdir(c.dst)
+        c.post_commands = ["touch done"]
+    errors = engine.run(entries, jobs=3)
+
+    assert [] == errors
+    for c in entries:
+        assert os.path.exists(os.path.join(c.dst, "done"))
+
+
+def test_run_post_command_fails(mocker, entries):
+    mocker.patch("gilt.git.extract")
+    c = entries[0]
+    os.mkdir(c.dst)
+    c.post_commands = ["ls missing"]
+    errors = engine.run(entries[:1])
+
+    assert 1 == len(errors)
+    _, exc = errors[0]
+    assert isinstance(exc, engine.CommandError)
+    assert "`ls missing`" in str(exc)
+
+
+def test_run_serializes_same_lock(mocker, entries):
+    running = []
+
+    def extract(src, dst, version, **kwargs):
+        running.append(dst)
+        time.sleep(0.05)
+        assert 1 == len(running)
+        running.remove(dst)
+
+    mocker.patch("gilt.git.extract", side_effect=extract)
+    for c in entries:
+        c.lock_file = entries[0].lock_file
+    errors = engine.run(entries, jobs=3)
+
+    assert [] == errors
+
+
+def test_run_groups_entries_by_repository(mocker, entries):
+    extracted = []
+
+    def extract(src, dst, version, **kwargs):
+        extracted.append(dst)
+
+    mocker.patch("gilt.git.extract", side_effect=extract)
+    patched_forget = mocker.patch("gilt.git.forget_fetches")
+    for c in entries:
+        c.lock_file = entries[0].lock_file
+    errors = engine.run(entries, jobs=3)
+
+    assert [] == errors
+    assert [c.dst for c in entries] == extracted
+    patched_forget.assert_called_once_with()
+
+
+def test_run_reports_errors_in_entry_order(mocker, entries):
+    def extract(src, dst, version, **kwargs):
+        if dst != entries[1].dst:
+            time.sleep(0.05)
+        raise Exception(dst)
+
+    mocker.patch("gilt.git.extract", side_effect=extract)
+    errors = engine.run(entries, jobs=3)
+
+    assert ["foo", "bar", "baz"] == [name for name, _ in errors]
+
+
+def test_run_pinned_shares_lock(mocker, entries, hold_lock, patched_is_pinned):
+    mocker.patch("gilt.git.extract")
+    patched_is_pinned.return_value = True
+    c = entries[0]
+    hold_lock(c.lock_file, "read")
+    errors = engine.run([c], lock_timeout=5)
+
+    assert [] == errors
+
+
+def test_run_unpinned_times_out(mocker, entries, hold_lock):
+    mocker.patch("gilt.git.extract")
+    c = entries[0]
+    hold_lock(c.lock_file, "read")
+    errors = engine.run([c], lock_timeout=0.2)
+
+    assert 1 == len(errors)
+    _, exc = errors[0]
+    assert isinstance(exc, engine.LockTimeoutError)
+    assert not engine.git.extract.called
+
+
+@pytest.mark.parametrize("acquired", [False, OSError("failed")])
+def test_acquire_releases_only_what_it_holds(mocker, temp_dir, acquired):
+    patched_lock = mocker.patch("fasteners.InterProcessReaderWriterLock")
+    process_lock = patched_lock.return_value
+    process_lock.acquire_write_lock.side_effect = [acquired]
+    process_lock.release_write_lock.side_effect = TypeError
+    locks = {}
+    lock_file = os.path.join(temp_dir.strpath, "lock")
+    coro = engine._acquire(locks, lock_file, timeout=1)
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises((engine.LockTimeoutError, OSError)):
+            loop.run_until_complete(coro)
+    finally:
+        loop.close()
+    assert not process_lock.release_write_lock.called
+    assert not locks[lock_file].locked()
+
+
+def test_acquire_releases_when_cancelled(mocker, temp_dir):
+    patched_lock = mocker.patch("fasteners.InterProcessReaderWriterLock")
+    process_lock = patched_lock.return_value
+    process_lock.acquire_write_lock.side_effect = lambda: not time.sleep(0.2)
+    locks = {}
+    lock_file = os.path.join(temp_dir.strpath, "lock")
+
+    async def cancel():
+        task = asyncio.ensure_future(engine._acquire(locks, lock_file))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(cancel())
+    finally:
+        loop.close()
+
+    process_lock.release_write_lock.assert_called_once_with()
+    assert not locks[lock_file].locked()
+
+
+def test_run_reports_lock_wait(mocker, capsys, entries, hold_lock):
+    mocker.patch("gilt.git.extract")
+    c = entries[0]
+    hold_lock(c.lock_file, "write", seconds=0.5)
+    errors = engine.run([c])
+    result, _ = capsys.readouterr()
+
+    assert [] == errors
+    assert "  - waited" in result
+    assert "s for the lock" in result
+
+
+def test_run_releases_lock_before_post_commands(mocker, entries):
+    events = []
+    mocker.patch("gilt.git.extract")
+    release = engine._release
+
+    def patched_release(*held):
+        events.append("release")
+        release(*held)
+
+    async def patched_run_command(command, cwd, *args):
+        events.append(command)
+
+    mocker.patch("gilt.engine._release", side_effect=patched_release)
+    mocker.patch("gilt.engine._run_command", side_effect=patched_run_command)
+    c = entries[0]
+    c.post_commands = ["make"]
+    errors = engine.run([c])
+
+    assert [] == errors
+    assert "release" == events[-2]
+    assert "make" == events[-1]
+
+
+def test_run_post_commands_per_dst(mocker, entries):
+    events = []
+
+    async def patched_run_command(command, cwd, *args):
+        events.append(("start", command))
+        await asyncio.sleep(0.1)
+        events.append(("end", command))
+
+    mocker.patch("gilt.git.extract")
+    mocker.patch("gilt.engine._run_command", side_effect=patched_run_command)
+    foo, bar, baz = entries
+    foo.post_commands = ["foo1", "foo2"]
+    bar.dst = foo.dst
+    bar.post_commands = ["bar1"]
+    baz.post_commands = ["baz1"]
+    errors = engine.run(entries, jobs=3)
+
+    assert [] == errors
+    same_dst = [e for e in events if e[1] != "baz1"]
+    for i in range(0, len(same_dst), 2):
+        assert "start" == same_dst[i][0]
+        assert ("end", same_dst[i][1]) == same_dst[i + 1]
+    assert same_dst.index(("end", "foo1")) < same_dst.index(("start", "foo2"))
+
+
+def test_run_post_commands_concurrently(mocker, entries):
+    events = []
+
+    async def patched_run_command(command, cwd, *args):
+        events.append(("start", command))
+        await asyncio.sleep(0.1)
+        events.append(("end", command))
+
+    mocker.patch("gilt.git.overlay")
+    mocker.patch("gilt.engine._run_command", side_effect=patched_run_command)
+    c = entries[0]
+    c.dst = None
+    c.files = [
+        config.FilesConfig(src="foo", dst=entries[1].dst, post_commands=["a"]),
+        config.FilesConfig(src="bar", dst=entries[2].dst, post_commands=["b"]),
+    ]
+    errors = engine.run([c], post_jobs=2)
+
+    assert [] == errors
+    assert {"start"} == {event for event, _ in events[:2]}
+
+
+def test_run_post_commands_timeout(mocker, entries):
+    mocker.patch("gilt.git.extract")
+    c = entries[0]
+    os.mkdir(c.dst)
+    c.post_commands = ["sleep 30"]
+    start = time.time()
+    errors = engine.run([c], post_timeout=0.2)
+
+    assert time.time() - start < 10
+    assert 1 == len(errors)
+    _, exc = errors[0]
+    assert isinstance(exc, engine.CommandError)
+    assert "timed out" in str(exc)
+
+
+def test_run_command_captures_output(temp_dir):
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(
+            engine._run_command("echo hello", temp_dir.strpath)
+        )
+    finally:
+        loop.close()
+
+    assert "echo hello" == result.command
+    assert temp_dir.strpath == result.cwd
+    assert 0 == result.returncode
+    assert "hello\n" == result.stdout
+    assert "" == result.stderr
+    assert 0 <= result.duration
+
+
+def test_overlay_cancel_kills_post_commands(mocker, entries):
+    mocker.patch("gilt.git.extract")
+    c = entries[0]
+    os.mkdir(c.dst)
+    c.post_commands = ["sleep 30"]
+
+    async def cancel():
+        task = asyncio.ensure_future(engine.overlay([c]))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(cancel())
+    finally:
+        loop.close()
+
+    assert time.time() - start < 10
+    lock = engine.fasteners.InterProcessLock(c.lock_file)
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_run_offline_without_clone(mocker, entries):
+    patched_clone = mocker.patch("gilt.git.clone")
+    c = entries[0]
+    c.src = os.path.join(os.path.dirname(c.src), "missing")
+    errors = engine.run([c], offline=True)
+
+    assert 1 == len(errors)
+    _, exc = errors[0]
+    assert isinstance(exc, engine.git.OfflineError)
+    assert not patched_clone.called
+
+
+def test_run_records_pins(mocker, entries):
+    mocker.patch("gilt.git.extract", return_value="sha")
+    mocker.patch("gilt.git.get_tree", return_value="tree")
+    c = entries[0]
+    pins = {}
+    errors = engine.run([c], pins=pins)
+
+    assert [] == errors
+    pin = engine.lockfile.Pin(c.raw_git, c.version, "sha", "tree")
+    assert {(c.raw_git, c.version): pin} == pins
+
+
+def test_run_records_last_use(mocker, entries):
+    mocker.patch("gilt.git.extract", return_value="sha")
+    c = entries[0]
+    open(c.lock_file, "a").close()
+    os.utime(c.lock_file, (1000, 1000))
+    engine.run([c])
+
+    assert os.stat(c.lock_file).st_mtime > 1000
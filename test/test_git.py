@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import concurrent.futures
 import glob
 import os
 
@@ -25,6 +26,9 @@ import pytest
 import sh
 
 from gilt import git
+from gilt import reader
+from gilt import remote
+from gilt import state
 
 
 @pytest.mark.slow
@@ -123,77 +127,199 @@ def patched_run_command(mocker):
     return mocker.patch("gilt.util.run_command")
 
 
-def test_get_version_has_branch(mocker, patched_run_command):
-    mocker.patch("gilt.git._has_branch").return_value = True
-    mocker.patch("gilt.git._has_tag").return_value = False
-    mocker.patch("gilt.git._has_commit").return_value = False
-    git._get_version("branch")
-    expected = [
-        mocker.call(sh.git.bake("checkout", "branch"), debug=False),
-        mocker.call(sh.git.bake("clean", "-d", "-x", "-f"), debug=False),
-        mocker.call(
-            sh.git.bake("pull", rebase=True, ff_only=True), debug=False
-        ),
-    ]
+@pytest.fixture()
+def patched_resolve_version(mocker):
+    return mocker.patch("gilt.git._resolve_version")
 
-    assert expected == patched_run_command.mock_calls
+
+@pytest.fixture()
+def patched_remote(mocker):
+    return mocker.patch("gilt.remote.get", return_value=remote.Remote(0, {}))
 
 
-def test_get_version_has_tag(mocker, patched_run_command):
-    mocker.patch("gilt.git._has_branch").return_value = False
-    mocker.patch("gilt.git._has_tag").return_value = True
-    mocker.patch("gilt.git._has_commit").return_value = False
-    git._get_version("tag_name")
-    expected = [
-        mocker.call(sh.git.bake("checkout", "tag_name"), debug=False),
-        mocker.call(sh.git.bake("clean", "-d", "-x", "-f"), debug=False),
+def test_get_version_has_branch(
+    mocker, patched_run_command, patched_resolve_version, patched_remote
+):
+    patched_resolve_version.side_effect = [
+        git.Ref("branch", "old"),
+        git.Ref("branch", "new"),
     ]
+    result = git._get_version("/repo", "branch")
+    expected = [mocker.call(sh.git.bake("fetch"), debug=False)]
 
     assert expected == patched_run_command.mock_calls
+    assert git.Ref("branch", "new") == result
+
+
+def test_is_pinned(cloned_repo):
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "master")
+
+    assert git.is_pinned(cloned_repo, "1.0")
+    assert git.is_pinned(cloned_repo, sha)
+    assert not git.is_pinned(cloned_repo, "master")
+    assert not git.is_pinned(cloned_repo, "missing")
+
+
+def test_is_pinned_without_clone(temp_dir):
+    repository = os.path.join(temp_dir.strpath, "missing")
 
+    assert not git.is_pinned(repository, "1.0")
 
-def test_get_version_has_commit(mocker, patched_run_command):
-    mocker.patch("gilt.git._has_branch").return_value = False
-    mocker.patch("gilt.git._has_tag").return_value = False
-    mocker.patch("gilt.git._has_commit").return_value = True
-    git._get_version("commit_sha")
-    expected = [
-        mocker.call(sh.git.bake("checkout", "commit_sha"), debug=False),
-        mocker.call(sh.git.bake("clean", "-d", "-x", "-f"), debug=False),
+
+def test_get_version_fetches_once_per_run(
+    mocker, patched_run_command, patched_resolve_version, patched_remote
+):
+    patched_resolve_version.side_effect = [
+        git.Ref("branch", "old"),
+        git.Ref("branch", "new"),
+        git.Ref("branch", "new"),
+        git.Ref("tag", "sha"),
     ]
+    git._get_version("/repo", "branch")
+    git._get_version("/repo", "branch")
+    git._get_version("/repo", "tag")
+    expected = [mocker.call(sh.git.bake("fetch"), debug=False)]
 
     assert expected == patched_run_command.mock_calls
 
 
-def test_get_version_needs_fetch(mocker, patched_run_command):
-    mocker.patch("gilt.git._has_branch").return_value = False
-    mocker.patch("gilt.git._has_tag").return_value = False
-    mocker.patch("gilt.git._has_commit").return_value = False
-    git._get_version("remote_tag")
-    expected = [
-        mocker.call(sh.git.bake("fetch"), debug=False),
-        mocker.call(sh.git.bake("checkout", "remote_tag"), debug=False),
-        mocker.call(sh.git.bake("clean", "-d", "-x", "-f"), debug=False),
-    ]
+def test_get_version_fetches_again_once_forgotten(
+    mocker, patched_run_command, patched_resolve_version, patched_remote
+):
+    patched_resolve_version.return_value = git.Ref("branch", "sha")
+    git._get_version("/repo", "branch")
+    git.forget_fetches("/repo")
+    git._get_version("/repo", "branch")
+    expected = [mocker.call(sh.git.bake("fetch"), debug=False)] * 2
 
     assert expected == patched_run_command.mock_calls
 
 
-def test_get_version_needs_pull(mocker, patched_run_command):
-    mocker.patch("gilt.git._has_branch").side_effect = [False, True]
-    mocker.patch("gilt.git._has_tag").return_value = False
-    mocker.patch("gilt.git._has_commit").return_value = False
-    git._get_version("remote_branch")
-    expected = [
-        mocker.call(sh.git.bake("fetch"), debug=False),
-        mocker.call(sh.git.bake("checkout", "remote_branch"), debug=False),
-        mocker.call(sh.git.bake("clean", "-d", "-x", "-f"), debug=False),
-        mocker.call(
-            sh.git.bake("pull", rebase=True, ff_only=True), debug=False
-        ),
-    ]
+def test_get_version_branch_advertised(
+    patched_run_command, patched_resolve_version, patched_remote
+):
+    patched_resolve_version.return_value = git.Ref("branch", "sha")
+    patched_remote.return_value = remote.Remote(
+        0, {"refs/heads/branch": "sha"}
+    )
+    result = git._get_version("/repo", "branch", remote_ttl=60)
+
+    assert git.Ref("branch", "sha") == result
+    patched_remote.assert_called_once_with("/repo", 60, False)
+    assert not patched_run_command.called
+
+
+def test_get_version_offline(
+    patched_run_command, patched_resolve_version, patched_remote
+):
+    patched_resolve_version.return_value = git.Ref("branch", "sha")
+    result = git._get_version("/repo", "branch", offline=True)
+
+    assert git.Ref("branch", "sha") == result
+    assert not patched_remote.called
+    assert not patched_run_command.called
+
+
+def test_get_version_offline_raises(
+    patched_run_command, patched_resolve_version, patched_remote
+):
+    patched_resolve_version.return_value = None
+
+    with pytest.raises(git.OfflineError):
+        git._get_version("/repo", "missing", offline=True)
+    assert not patched_remote.called
+    assert not patched_run_command.called
+
+
+def test_get_version_unknown_after_fetch_raises(
+    patched_run_command, patched_resolve_version
+):
+    patched_resolve_version.return_value = None
+    git._fetched.add("/repo")
+
+    with pytest.raises(git.NotFoundError):
+        git._get_version("/repo", "missing")
+    assert not patched_run_command.called
+
+
+def test_get_version_has_tag(patched_run_command, patched_resolve_version):
+    patched_resolve_version.return_value = git.Ref("tag", "sha")
+    result = git._get_version("/repo", "tag_name")
+
+    assert [] == patched_run_command.mock_calls
+    assert git.Ref("tag", "sha") == result
+
+
+def test_get_version_has_commit(patched_run_command, patched_resolve_version):
+    patched_resolve_version.return_value = git.Ref("commit", "sha")
+    result = git._get_version("/repo", "commit_sha")
+
+    assert [] == patched_run_command.mock_calls
+    assert git.Ref("commit", "sha") == result
+
+
+def test_get_version_needs_fetch(
+    mocker, patched_run_command, patched_resolve_version
+):
+    patched_resolve_version.side_effect = [None, git.Ref("tag", "sha")]
+    result = git._get_version("/repo", "remote_tag")
+    expected = [mocker.call(sh.git.bake("fetch"), debug=False)]
 
     assert expected == patched_run_command.mock_calls
+    assert git.Ref("tag", "sha") == result
+
+
+def test_get_version_raises(patched_run_command, patched_resolve_version):
+    patched_resolve_version.return_value = None
+    with pytest.raises(git.NotFoundError):
+        git._get_version("/repo", "missing")
+
+
+def test_resolve_version(git_repo):
+    rev_parse = pytest.helpers.git_rev_parse
+    master = rev_parse(git_repo, "master")
+    feature = rev_parse(git_repo, "feature")
+
+    assert git.Ref("branch", master) == git._resolve_version(
+        git_repo, "master"
+    )
+    assert git.Ref("branch", feature) == git._resolve_version(
+        git_repo, "feature"
+    )
+    assert git.Ref("tag", master) == git._resolve_version(git_repo, "1.0")
+    assert git.Ref("tag", master) == git._resolve_version(git_repo, "1.1")
+    assert git.Ref("commit", feature) == git._resolve_version(
+        git_repo, feature[:7]
+    )
+    assert git._resolve_version(git_repo, "missing") is None
+
+
+def test_resolve_version_is_memoized(mocker, git_repo):
+    mocker.patch("gilt.git._get_reader", return_value=None)
+    git._resolve_version(git_repo, "master")
+    spy = mocker.spy(git.util, "run_command")
+    git._resolve_version(git_repo, "1.0")
+    git._resolve_version(git_repo, "feature")
+
+    assert 0 == spy.call_count
+
+    git._invalidate_refs(git_repo)
+    git._resolve_version(git_repo, "master")
+
+    assert 1 == spy.call_count
+
+
+def test_get_refs_notices_updates_once_per_run(git_repo):
+    master = pytest.helpers.git_rev_parse(git_repo, "master")
+    git._resolve_version(git_repo, "master")
+    sh.git("update-ref", "refs/heads/master", "feature", _cwd=git_repo)
+
+    assert master == git._resolve_version(git_repo, "master").sha
+
+    git.forget_fetches()
+    feature = pytest.helpers.git_rev_parse(git_repo, "feature")
+
+    assert feature == git._resolve_version(git_repo, "master").sha
 
 
 @pytest.mark.slow
@@ -202,18 +328,604 @@ def test_has_version(temp_dir):
     repo = "https://github.com/retr0h/ansible-etcd.git"
     destination = os.path.join(temp_dir.strpath, name)
     git.clone(name, repo, destination)
-    os.chdir(destination)
-    # _has_branch tests
-    assert git._has_branch("master")
-    assert not git._has_branch("1.1")
-    assert not git._has_branch("888ef7b")
-
-    # _has_tag tests
-    assert not git._has_tag("master")
-    assert git._has_tag("1.1")
-    assert not git._has_tag("888ef7b")
-
-    # _has_commit tests
-    assert not git._has_commit("master")
-    assert not git._has_commit("1.1")
-    assert git._has_commit("888ef7b")
+
+    assert "branch" == git._resolve_version(destination, "master").kind
+    assert "tag" == git._resolve_version(destination, "1.1").kind
+    assert "commit" == git._resolve_version(destination, "888ef7b").kind
+
+
+@pytest.fixture()
+def cloned_repo(temp_dir, git_repo):
+    destination = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, destination)
+
+    return destination
+
+
+def test_extract_skips_when_current(mocker, temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.1")
+
+    assert os.path.exists(os.path.join(destination, "bar"))
+
+    spy = mocker.spy(git.util, "run_command")
+    git.extract(cloned_repo, destination, "1.1")
+
+    assert 0 == spy.call_count
+
+
+def test_extract_when_file_removed(temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.1")
+    os.unlink(os.path.join(destination, "bar"))
+    git.extract(cloned_repo, destination, "1.1")
+
+    assert os.path.exists(os.path.join(destination, "bar"))
+
+
+def test_extract_restores_edited_file(temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.1")
+    filename = os.path.join(destination, "bar")
+    with open(filename, "w") as f:
+        f.write("edited")
+    git.extract(cloned_repo, destination, "1.1")
+
+    with open(filename) as f:
+        assert "bar" == f.read()
+
+
+def test_overlay_restores_edited_file(mocker, temp_dir, cloned_repo):
+    dst_dir = os.path.join(temp_dir.strpath, "dst", "")
+    os.mkdir(dst_dir)
+    files = [mocker.Mock(src=os.path.join(cloned_repo, "fo*"), dst=dst_dir)]
+    git.overlay(cloned_repo, files, "1.0")
+    filename = os.path.join(dst_dir, "foo")
+    with open(filename, "w") as f:
+        f.write("edited")
+    git.overlay(cloned_repo, files, "1.0")
+
+    with open(filename) as f:
+        assert "foo" == f.read()
+
+
+def test_extract_when_version_changes(temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "master")
+
+    assert not os.path.exists(os.path.join(destination, "baz"))
+
+    git.extract(cloned_repo, destination, "feature")
+
+    assert os.path.exists(os.path.join(destination, "baz"))
+
+
+def test_overlay_skips_when_current(mocker, temp_dir, cloned_repo):
+    dst_dir = os.path.join(temp_dir.strpath, "dst", "")
+    os.mkdir(dst_dir)
+    files = [
+        mocker.Mock(src=os.path.join(cloned_repo, "fo*"), dst=dst_dir),
+        mocker.Mock(
+            src=os.path.join(cloned_repo, "bar"),
+            dst=os.path.join(dst_dir, "bar.txt"),
+        ),
+    ]
+    git.overlay(cloned_repo, files, "1.0")
+
+    assert os.path.exists(os.path.join(dst_dir, "foo"))
+    assert os.path.exists(os.path.join(dst_dir, "bar.txt"))
+
+    patched_copy = mocker.patch("gilt.util.copy")
+    git.overlay(cloned_repo, files, "1.0")
+
+    assert not patched_copy.called
+
+
+def test_clone_with_shared_objects(temp_dir, gilt_cache_dir, git_repo):
+    destination = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, destination, shared=True)
+
+    alternates = os.path.join(destination, "objects", "info", "alternates")
+    with open(alternates) as f:
+        assert os.path.join(gilt_cache_dir, "objects") in f.read()
+
+    extract_dir = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(destination, extract_dir, "feature")
+
+    assert os.path.exists(os.path.join(extract_dir, "baz"))
+
+
+def test_update_shared_objects_keeps_refs(gilt_cache_dir, git_repo):
+    objects_dir = git._update_shared_objects(git_repo)
+    git._update_shared_objects(git_repo)
+    refs = str(sh.git("for-each-ref", "refs/gilt/", _cwd=objects_dir))
+
+    assert "/heads/master" in refs
+    assert "/heads/feature" in refs
+    assert "/tags/1.1" in refs
+    gc_auto = sh.git("config", "gc.auto", _cwd=objects_dir)
+    assert "0" == str(gc_auto).strip()
+
+
+@pytest.fixture()
+def shallow_repo(temp_dir, git_repo):
+    destination = os.path.join(temp_dir.strpath, "shallow")
+    git.clone("repo", "file://" + git_repo, destination, depth=1)
+
+    return destination
+
+
+def test_clone_with_depth(shallow_repo):
+    assert git._is_shallow(shallow_repo)
+    count = sh.git("rev-list", "--count", "HEAD", _cwd=shallow_repo)
+    assert "1" == str(count).strip()
+
+
+def test_clone_with_filter(temp_dir, git_repo):
+    destination = os.path.join(temp_dir.strpath, "partial")
+    git.clone("repo", "file://" + git_repo, destination, filter="blob:none")
+    result = sh.git(
+        "config", "remote.origin.partialclonefilter", _cwd=destination
+    )
+
+    assert "blob:none" == str(result).strip()
+
+
+@pytest.mark.parametrize("version", ["master", "feature", "1.0", "1.1"])
+def test_extract_shallow(temp_dir, git_repo, shallow_repo, version):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(shallow_repo, destination, version, depth=1)
+
+    sha = pytest.helpers.git_rev_parse(git_repo, version + "^{commit}")
+    assert sha == state.get(destination).sha
+    assert git._is_shallow(shallow_repo)
+
+
+def test_extract_shallow_commit(temp_dir, git_repo, shallow_repo):
+    sha = pytest.helpers.git_rev_parse(git_repo, "feature")
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(shallow_repo, destination, sha, depth=1)
+
+    assert os.path.exists(os.path.join(destination, "baz"))
+
+
+def test_extract_shallow_branch_advanced(temp_dir, git_repo, shallow_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(shallow_repo, destination, "master", depth=1)
+    with open(os.path.join(git_repo, "qux"), "w") as f:
+        f.write("qux")
+    pytest.helpers.git_commit(git_repo, "qux")
+    git.forget_fetches()
+    git.extract(shallow_repo, destination, "master", depth=1)
+
+    assert os.path.exists(os.path.join(destination, "qux"))
+
+
+def test_clone_is_bare(cloned_repo):
+    assert not os.path.exists(os.path.join(cloned_repo, ".git"))
+    assert os.path.exists(os.path.join(cloned_repo, "HEAD"))
+
+
+def test_extract_from_non_bare_clone(temp_dir, git_repo):
+    clone_dir = os.path.join(temp_dir.strpath, "legacy")
+    sh.git("clone", "--quiet", git_repo, clone_dir)
+    head = pytest.helpers.git_rev_parse(clone_dir, "HEAD")
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(clone_dir, destination, "feature")
+
+    assert os.path.exists(os.path.join(destination, "baz"))
+    assert head == pytest.helpers.git_rev_parse(clone_dir, "HEAD")
+    assert not os.path.exists(os.path.join(clone_dir, "baz"))
+
+
+def test_extract_preserves_modes(temp_dir, git_repo):
+    os.mkdir(os.path.join(git_repo, "bin"))
+    script = os.path.join(git_repo, "bin", "run")
+    with open(script, "w") as f:
+        f.write("#!/bin/sh")
+    os.chmod(script, 0o755)
+    os.symlink("run", os.path.join(git_repo, "bin", "link"))
+    pytest.helpers.git_commit(git_repo, "bin")
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(clone_dir, destination, "master")
+
+    assert os.access(os.path.join(destination, "bin", "run"), os.X_OK)
+    assert not os.access(os.path.join(destination, "foo"), os.X_OK)
+    assert "run" == os.readlink(os.path.join(destination, "bin", "link"))
+
+
+def test_overlay_directory(mocker, temp_dir, git_repo):
+    os.mkdir(os.path.join(git_repo, "dir"))
+    for filename in ("a", ".b"):
+        open(os.path.join(git_repo, "dir", filename), "a").close()
+    pytest.helpers.git_commit(git_repo, "dir")
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+    dst_dir = os.path.join(temp_dir.strpath, "dst", "")
+    os.makedirs(os.path.join(dst_dir, "dir", "stale"))
+    files = [
+        mocker.Mock(
+            src=os.path.join(clone_dir, "dir"),
+            dst=os.path.join(dst_dir, "dir"),
+        ),
+        mocker.Mock(src=os.path.join(clone_dir, "dir", "*"), dst=dst_dir),
+    ]
+    git.overlay(clone_dir, files, "master")
+
+    assert ["dir", "a"] == sorted(os.listdir(dst_dir), reverse=True)
+    assert [".b", "a"] == sorted(os.listdir(os.path.join(dst_dir, "dir")))
+
+
+def test_overlay_raises_on_missing_path(mocker, temp_dir, cloned_repo):
+    files = [
+        mocker.Mock(
+            src=os.path.join(cloned_repo, "missing"), dst=temp_dir.strpath
+        )
+    ]
+    with pytest.raises(FileNotFoundError):
+        git.overlay(cloned_repo, files, "1.0")
+
+
+@pytest.fixture()
+def tree():
+    paths = {
+        "foo_manage": "blob",
+        "bar_manage": "blob",
+        ".hidden_manage": "blob",
+        "dir": "tree",
+        "dir/baz_manage": "blob",
+        "dir/sub": "tree",
+        "dir/sub/qux_manage": "blob",
+        "dir/sub/tests": "tree",
+        "dir/sub/tests/test_manage": "blob",
+        "dir/.hidden": "tree",
+        "dir/.hidden/secret_manage": "blob",
+        "sub_manage": "commit",
+    }
+
+    return {
+        path: git.TreeEntry(
+            "040000" if kind == "tree" else "100644", kind, path
+        )
+        for path, kind in paths.items()
+    }
+
+
+def test_glob(tree):
+    assert ["bar_manage", "foo_manage"] == git._glob(tree, "*_manage")
+    assert [".hidden_manage"] == git._glob(tree, ".*_manage")
+    assert ["dir/baz_manage"] == git._glob(tree, "d*/*_manage")
+    assert [] == git._glob(tree, "missing*")
+
+
+def test_glob_recursive(tree):
+    assert [
+        "bar_manage",
+        "dir/baz_manage",
+        "dir/sub/qux_manage",
+        "dir/sub/tests/test_manage",
+        "foo_manage",
+    ] == git._glob(tree, "**/*_manage")
+    assert ["dir/sub/qux_manage", "dir/sub/tests/test_manage"] == git._glob(
+        tree, "dir/**/sub/**/*_manage"
+    )
+    assert [
+        "dir/baz_manage",
+        "dir/sub",
+        "dir/sub/qux_manage",
+        "dir/sub/tests",
+        "dir/sub/tests/test_manage",
+    ] == git._glob(tree, "dir/**")
+
+
+def test_select(tree):
+    result = git._select(tree, ["dir/*"])
+
+    assert [
+        ("baz_manage", "dir/baz_manage"),
+        ("sub/qux_manage", "dir/sub/qux_manage"),
+        ("sub/tests/test_manage", "dir/sub/tests/test_manage"),
+    ] == list(result.items())
+
+
+def test_select_negated(tree):
+    result = git._select(
+        tree,
+        ["dir/**/*_manage", "!dir/**/tests", "dir/sub/tests/test_*"],
+    )
+
+    assert [
+        ("baz_manage", "dir/baz_manage"),
+        ("sub/qux_manage", "dir/sub/qux_manage"),
+        ("sub/tests/test_manage", "dir/sub/tests/test_manage"),
+    ] == list(result.items())
+    assert ["dir/baz_manage"] == list(
+        git._select(tree, ["dir/**/*_manage", "!dir/sub"]).values()
+    )
+
+
+def test_ls_tree_is_cached(mocker, cloned_repo):
+    mocker.patch("gilt.git._get_reader", return_value=None)
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "master")
+    spy = mocker.spy(git.util, "run_command")
+    tree = git._ls_tree(cloned_repo, sha)
+
+    assert tree is git._ls_tree(cloned_repo, sha)
+    assert 1 == spy.call_count
+    assert "blob" == tree["foo"].kind
+    assert pytest.helpers.git_rev_parse(cloned_repo, "master:foo") == (
+        tree["foo"].sha
+    )
+
+
+def test_ls_tree_concurrently(mocker):
+    mocker.patch("gilt.git._read_tree", return_value={})
+    mocker.patch("gilt.git.TREE_CACHE_SIZE", 2)
+    mocker.patch.dict(git._trees, clear=True)
+    keys = [("repo", str(i % 4)) for i in range(2000)]
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda k: git._ls_tree(*k), keys))
+
+    assert [{}] * len(keys) == results
+    assert 2 >= len(git._trees)
+
+
+def test_overlay_patterns(mocker, temp_dir, git_repo):
+    os.makedirs(os.path.join(git_repo, "roles", "a", "tests"))
+    os.makedirs(os.path.join(git_repo, "roles", "b"))
+    for path in ("a/main.yml", "a/tests/test.yml", "b/main.yml", "b/x.txt"):
+        with open(os.path.join(git_repo, "roles", path), "w") as f:
+            f.write(path)
+    pytest.helpers.git_commit(git_repo, "roles")
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+    dst_dir = os.path.join(temp_dir.strpath, "dst", "")
+    files = [
+        mocker.Mock(
+            src=[
+                os.path.join(clone_dir, "roles", "**", "*.yml"),
+                "!" + os.path.join(clone_dir, "roles", "**", "tests"),
+            ],
+            dst=dst_dir,
+        )
+    ]
+    spy = mocker.spy(git, "_archive")
+    git.overlay(clone_dir, files, "master")
+
+    assert not spy.called
+    assert ["a", "b"] == sorted(os.listdir(dst_dir))
+    assert ["main.yml"] == os.listdir(os.path.join(dst_dir, "a"))
+    with open(os.path.join(dst_dir, "b", "main.yml")) as f:
+        assert "b/main.yml" == f.read()
+
+
+def test_overlay_single_pattern_list(mocker, temp_dir, cloned_repo):
+    dst_dir = os.path.join(temp_dir.strpath, "dst", "")
+    os.makedirs(dst_dir)
+    files = [mocker.Mock(src=[os.path.join(cloned_repo, "foo")], dst=dst_dir)]
+    git.overlay(cloned_repo, files, "master")
+    c = mocker.Mock(dst=None, files=files)
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "master")
+    targets = git.get_targets(cloned_repo, sha, c)
+
+    assert ["foo"] == os.listdir(dst_dir)
+    assert [os.path.join(dst_dir, "foo")] == list(targets[0].files)
+
+
+def test_overlay_lone_negation(mocker, temp_dir, cloned_repo):
+    dst_dir = os.path.join(temp_dir.strpath, "dst", "")
+    files = [
+        mocker.Mock(src=["!" + os.path.join(cloned_repo, "foo")], dst=dst_dir)
+    ]
+    git.overlay(cloned_repo, files, "master")
+    c = mocker.Mock(dst=None, files=files)
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "master")
+    targets = git.get_targets(cloned_repo, sha, c)
+
+    assert [] == os.listdir(dst_dir)
+    assert {} == targets[0].files
+
+
+@pytest.fixture()
+def advanced_repo(git_repo):
+    """Advance `master` of the fixture repository by a commit which adds,
+    modifies, deletes and renames files."""
+    os.mkdir(os.path.join(git_repo, "dir"))
+    with open(os.path.join(git_repo, "dir", "new"), "w") as f:
+        f.write("new")
+    with open(os.path.join(git_repo, "bar"), "w") as f:
+        f.write("modified")
+    os.rename(os.path.join(git_repo, "foo"), os.path.join(git_repo, "moved"))
+    pytest.helpers.git_commit(git_repo, "advance")
+    # Start a new run, which fetches again.
+    git.forget_fetches()
+
+    return git_repo
+
+
+def test_extract_updates_incrementally(mocker, temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.0")
+    patched_archive = mocker.patch("gilt.git._archive")
+    git.extract(cloned_repo, destination, "feature")
+
+    assert not patched_archive.called
+    assert ["bar", "baz", "foo"] == sorted(os.listdir(destination))
+    assert state.is_current(
+        destination,
+        cloned_repo,
+        pytest.helpers.git_rev_parse(cloned_repo, "origin/feature"),
+    )
+
+
+def test_extract_updates_changes(mocker, temp_dir, cloned_repo, advanced_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.0")
+    spy = mocker.spy(git, "_archive")
+    git.extract(cloned_repo, destination, "master")
+
+    assert not spy.called
+    assert ["bar", "dir", "moved"] == sorted(os.listdir(destination))
+    with open(os.path.join(destination, "bar")) as f:
+        assert "modified" == f.read()
+    assert os.path.exists(os.path.join(destination, "dir", "new"))
+
+
+def test_extract_falls_back_when_modified(mocker, temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.0")
+    with open(os.path.join(destination, "foo"), "a") as f:
+        f.write("local change")
+    spy = mocker.spy(git, "_archive")
+    git.extract(cloned_repo, destination, "feature")
+
+    assert spy.called
+    with open(os.path.join(destination, "foo")) as f:
+        assert "foo" == f.read()
+
+
+def test_extract_falls_back_when_file_added(mocker, temp_dir, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, destination, "1.0")
+    open(os.path.join(destination, "extra"), "a").close()
+    spy = mocker.spy(git, "_archive")
+    git.extract(cloned_repo, destination, "feature")
+
+    assert spy.called
+    assert not os.path.exists(os.path.join(destination, "extra"))
+
+
+def test_extract_locked_sha(mocker, temp_dir, cloned_repo):
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "feature")
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    spy = mocker.spy(git, "_resolve_version")
+    result = git.extract(cloned_repo, destination, "master", sha=sha)
+
+    assert sha == result
+    assert os.path.exists(os.path.join(destination, "baz"))
+    assert not spy.called
+
+    spy = mocker.spy(git.util, "run_command")
+    git.extract(cloned_repo, destination, "master", sha=sha)
+
+    assert 0 == spy.call_count
+
+
+def test_extract_locked_sha_fetches_commit(
+    mocker, temp_dir, git_repo, shallow_repo
+):
+    with open(os.path.join(git_repo, "qux"), "w") as f:
+        f.write("qux")
+    pytest.helpers.git_commit(git_repo, "qux")
+    sha = pytest.helpers.git_rev_parse(git_repo, "master")
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+    spy = mocker.spy(git, "_fetch")
+    git.extract(shallow_repo, destination, "master", depth=1, sha=sha)
+
+    assert os.path.exists(os.path.join(destination, "qux"))
+    assert not spy.called
+
+
+def test_extract_locked_sha_offline_raises(temp_dir, git_repo, cloned_repo):
+    destination = os.path.join(temp_dir.strpath, "dst", "")
+
+    with pytest.raises(git.OfflineError):
+        git.extract(
+            cloned_repo, destination, "master", offline=True, sha="0" * 40
+        )
+
+
+def test_overlay_returns_sha(mocker, temp_dir, cloned_repo):
+    dst = os.path.join(temp_dir.strpath, "foo")
+    files = [mocker.Mock(src=os.path.join(cloned_repo, "foo"), dst=dst)]
+    result = git.overlay(cloned_repo, files, "1.0")
+
+    assert pytest.helpers.git_rev_parse(cloned_repo, "1.0") == result
+
+
+def test_get_tree(cloned_repo):
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "master")
+    tree = pytest.helpers.git_rev_parse(cloned_repo, "master^{tree}")
+
+    assert tree == git.get_tree(cloned_repo, sha)
+    assert git.get_tree(cloned_repo, "0" * 40) is None
+
+
+def test_is_pinned_locked_sha(cloned_repo):
+    sha = pytest.helpers.git_rev_parse(cloned_repo, "master")
+
+    assert git.is_pinned(cloned_repo, "master", sha)
+    assert not git.is_pinned(cloned_repo, "master", "0" * 40)
+
+
+@pytest.fixture()
+def rich_repo(git_repo):
+    os.makedirs(os.path.join(git_repo, "dir", "sub"))
+    with open(os.path.join(git_repo, "dir", "sub", "run.sh"), "w") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(os.path.join(git_repo, "dir", "sub", "run.sh"), 0o755)
+    os.symlink("../foo", os.path.join(git_repo, "dir", "link"))
+    with open(os.path.join(git_repo, "foo"), "w") as f:
+        f.write("changed")
+    sh.git("rm", "--quiet", "bar", _cwd=git_repo)
+    pytest.helpers.git_commit(git_repo, "dir")
+
+    return git_repo
+
+
+def test_reads_in_process(mocker, temp_dir, rich_repo):
+    sha = pytest.helpers.git_rev_parse(rich_repo, "master")
+    spy = mocker.spy(git.util, "run_command")
+    tree = git._ls_tree(rich_repo, sha)
+    destination = os.path.join(temp_dir.strpath, "dst")
+    git._archive(rich_repo, sha, "dir", destination)
+
+    assert 0 == spy.call_count
+    assert "tree" == tree["dir/sub"].kind
+    assert "100755" == tree["dir/sub/run.sh"].mode
+    assert "120000" == tree["dir/link"].mode
+    assert os.access(os.path.join(destination, "sub", "run.sh"), os.X_OK)
+    assert "../foo" == os.readlink(os.path.join(destination, "link"))
+    assert sha == git._resolve_version(rich_repo, sha).sha
+    assert 0 == spy.call_count
+
+
+def test_reads_fall_back_to_git(mocker, temp_dir, rich_repo):
+    sha = pytest.helpers.git_rev_parse(rich_repo, "master")
+    previous = pytest.helpers.git_rev_parse(rich_repo, "master~1")
+    expected = git._ls_tree(rich_repo, sha)
+    changes = git._diff(rich_repo, previous, sha)
+    git._trees.clear()
+    mocker.patch("gilt.git._get_reader", return_value=None)
+    destination = os.path.join(temp_dir.strpath, "dst")
+    git._archive(rich_repo, sha, "dir", destination)
+
+    assert expected == git._ls_tree(rich_repo, sha)
+    assert changes == git._diff(rich_repo, previous, sha)
+    assert os.access(os.path.join(destination, "sub", "run.sh"), os.X_OK)
+    assert "../foo" == os.readlink(os.path.join(destination, "link"))
+
+
+def test_write_blobs_streams_large_blobs(mocker, temp_dir, rich_repo):
+    mocker.patch("gilt.git.INLINE_BLOB_SIZE", 0)
+    spy = mocker.spy(git, "_cat_blobs")
+    sha = pytest.helpers.git_rev_parse(rich_repo, "master")
+    destination = os.path.join(temp_dir.strpath, "dst")
+    git._archive(rich_repo, sha, "dir", destination)
+
+    assert 2 == len(spy.call_args[0][1])
+    assert os.access(os.path.join(destination, "sub", "run.sh"), os.X_OK)
+    assert "../foo" == os.readlink(os.path.join(destination, "link"))
+
+
+def test_get_reader_unsupported(mocker, git_repo):
+    mocker.patch(
+        "gilt.reader.Repository", side_effect=reader.UnsupportedError()
+    )
+
+    assert git._get_reader(git_repo) is None
+    assert "foo" in git._ls_tree(
+        git_repo, pytest.helpers.git_rev_parse(git_repo, "master")
+    )
@@ -0,0 +1,98 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+import pytest
+
+from gilt import config
+from gilt import lockfile
+
+
+@pytest.fixture()
+def pins():
+    return [
+        lockfile.Pin(
+            "https://example.com/b.git", "master", "b" * 40, "1" * 40
+        ),
+        lockfile.Pin("https://example.com/a.git", "1.0", "a" * 40, "2" * 40),
+    ]
+
+
+def test_get_filename():
+    assert "/path/gilt.lock" == lockfile.get_filename("/path/gilt.yml")
+
+
+def test_dump_and_load(temp_dir, pins):
+    filename = os.path.join(temp_dir.strpath, "gilt.lock")
+    lockfile.dump(filename, pins)
+    result = lockfile.load(filename)
+
+    assert {(p.git, p.version): p for p in pins} == result
+    with open(filename) as f:
+        content = f.read()
+    assert content.index("a.git") < content.index("b.git")
+
+
+def test_dump_leaves_unchanged_file(temp_dir, pins):
+    filename = os.path.join(temp_dir.strpath, "gilt.lock")
+    lockfile.dump(filename, pins)
+    os.utime(filename, ns=(0, 0))
+    lockfile.dump(filename, reversed(pins))
+
+    assert 0 == os.stat(filename).st_mtime_ns
+
+
+def test_load_raises_on_invalid_entry(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "gilt.lock")
+    with open(filename, "w") as f:
+        f.write("- git: https://example.com/a.git\n")
+
+    with pytest.raises(config.ParseError):
+        lockfile.load(filename)
+
+
+def test_freeze(pins):
+    fields = dict.fromkeys(config.Config._fields)
+    entries = [
+        config.Config(**dict(fields, git=p.git, version=p.version))
+        for p in pins
+    ]
+    result = lockfile.freeze(entries, {(p.git, p.version): p for p in pins})
+
+    assert [p.sha for p in pins] == [c.sha for c in result]
+
+
+def test_key_uses_git_as_written(mocker):
+    c = mocker.Mock(git="https://secret@example.com/a.git", version="1.0")
+    c.raw_git = "https://${TOKEN}@example.com/a.git"
+
+    assert ("https://${TOKEN}@example.com/a.git", "1.0") == lockfile.key(c)
+
+
+def test_freeze_raises_when_not_locked(mocker):
+    entries = [
+        mocker.Mock(
+            git="https://example.com/c.git", raw_git=None, version="1.0"
+        )
+    ]
+
+    with pytest.raises(lockfile.NotLockedError):
+        lockfile.freeze(entries, {})
@@ -0,0 +1,211 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import concurrent.futures
+import json
+import os
+
+import pytest
+import sh
+
+from gilt import config
+from gilt import git
+from gilt import mirror
+
+
+@pytest.fixture()
+def mirrors_file(gilt_cache_dir):
+    def write(rules):
+        filename = config._get_mirrors_file()
+        config._makedirs(filename)
+        with open(filename, "w") as f:
+            json.dump(rules, f)
+
+        return filename
+
+    return write
+
+
+def test_load_without_file():
+    assert [] == mirror.load()
+
+
+def test_load(mirrors_file):
+    mirrors_file(
+        [
+            {"prefix": "https://github.com/", "mirrors": ["a"]},
+            {
+                "prefix": "https://github.com/retr0h/",
+                "mirrors": ["b", "c"],
+                "select": "latency",
+            },
+        ]
+    )
+    result = mirror.load()
+
+    assert "https://github.com/retr0h/" == result[0].prefix
+    assert ["b", "c"] == result[0].mirrors
+    assert "latency" == result[0].select
+    assert "order" == result[1].select
+
+
+@pytest.mark.parametrize(
+    "rules",
+    [
+        [{"mirrors": ["a"]}],
+        [{"prefix": "https://github.com/"}],
+        [{"prefix": "https://github.com/", "mirrors": [], "select": "x"}],
+    ],
+)
+def test_load_raises_on_invalid_rule(mirrors_file, rules):
+    mirrors_file(rules)
+
+    with pytest.raises(config.ParseError):
+        mirror.load()
+
+
+def test_canonical():
+    rules = [
+        mirror.Rule(
+            "https://github.com/", ["https://mirror.local/gh/"], "order"
+        )
+    ]
+    url = "https://mirror.local/gh/retr0h/gilt.git"
+
+    assert "https://github.com/retr0h/gilt.git" == mirror.canonical(url, rules)
+    assert "https://gitlab.com/x.git" == mirror.canonical(
+        "https://gitlab.com/x.git", rules
+    )
+
+
+def test_get_routes():
+    rules = [mirror.Rule("https://github.com/", ["a", "b"], "order")]
+
+    x = [
+        ("a", "https://github.com/"),
+        ("b", "https://github.com/"),
+        (None, None),
+    ]
+    assert x == mirror.get_routes("https://github.com/x.git", rules)
+    assert [(None, None)] == mirror.get_routes("https://x.org/x", rules)
+
+
+def test_get_routes_by_latency(mocker):
+    latencies = {"a": 0.2, "b": None, "c": 0.1}
+    mocker.patch("gilt.mirror.probe", side_effect=latencies.get)
+    rules = [mirror.Rule("https://github.com/", ["a", "b", "c"], "latency")]
+    result = mirror.get_routes("https://github.com/x.git", rules)
+
+    assert ["c", "a", None] == [m for m, _ in result]
+
+
+def test_get_latencies_are_cached(mocker):
+    patched_probe = mocker.patch("gilt.mirror.probe", return_value=0.1)
+    mirror._get_latencies(["a"])
+    result = mirror._get_latencies(["a"])
+
+    assert {"a": 0.1} == result
+    assert 1 == patched_probe.call_count
+
+
+def test_get_latencies_probes_again_when_stale(mocker):
+    patched_probe = mocker.patch("gilt.mirror.probe", return_value=0.1)
+    mirror._get_latencies(["a"])
+    mocker.patch("gilt.mirror.PROBE_TTL", 0)
+    mirror._get_latencies(["a"])
+
+    assert 2 == patched_probe.call_count
+
+
+def test_get_latencies_concurrently(mocker):
+    mocker.patch("gilt.mirror.probe", return_value=0.1)
+    mocker.patch("gilt.mirror.PROBE_TTL", 0)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        futures = [
+            executor.submit(mirror._get_latencies, ["a"]) for _ in range(32)
+        ]
+
+    assert all({"a": 0.1} == f.result() for f in futures)
+
+
+def test_probe_local_path(tmpdir):
+    assert 0.0 == mirror.probe(tmpdir.strpath)
+    assert 0.0 == mirror.probe("file://" + tmpdir.strpath)
+    assert mirror.probe(tmpdir.join("missing").strpath) is None
+
+
+def test_probe_unreachable_host():
+    assert mirror.probe("https://invalid.invalid/x.git", 0.1) is None
+
+
+def test_clone_through_mirror(mirrors_file, temp_dir, git_repo):
+    upstream = "https://git.invalid/repo"
+    mirrors_file([{"prefix": upstream, "mirrors": [git_repo]}])
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+    origin = sh.git("config", "remote.origin.url", _cwd=clone_dir)
+
+    assert upstream == str(origin).strip()
+    git._fetch(clone_dir, "master")
+
+
+def test_run_falls_back_to_upstream(mocker, mirrors_file, temp_dir, git_repo):
+    missing = os.path.join(temp_dir.strpath, "missing")
+    mirrors_file([{"prefix": git_repo, "mirrors": [missing]}])
+    patched_print_warn = mocker.patch("gilt.util.print_warn")
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+
+    assert os.path.isdir(clone_dir)
+    msg = "  - {} failed, trying {}".format(missing, git_repo)
+    patched_print_warn.assert_called_once_with(msg)
+
+
+def test_run_raises_when_every_route_fails(mirrors_file, temp_dir):
+    missing = os.path.join(temp_dir.strpath, "missing")
+    mirrors_file([{"prefix": missing, "mirrors": [missing + ".mirror"]}])
+
+    with pytest.raises(sh.ErrorReturnCode):
+        mirror.run(missing, ["ls-remote", missing])
+
+
+def test_config_keys_mirrors_by_upstream(mirrors_file, temp_dir):
+    mirrors_file(
+        [
+            {
+                "prefix": "https://github.com/",
+                "mirrors": ["https://mirror.local/gh/"],
+            }
+        ]
+    )
+    filename = temp_dir.join("gilt.yml").strpath
+    with open(filename, "w") as f:
+        f.write(
+            "- git: https://mirror.local/gh/retr0h/gilt.git\n"
+            "  version: master\n"
+            "  dst: a/\n"
+            "- git: https://github.com/retr0h/gilt.git\n"
+            "  version: master\n"
+            "  dst: b/\n"
+        )
+    first, second = config.config(filename)
+
+    assert first.src == second.src
+    assert first.lock_file == second.lock_file
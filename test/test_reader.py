@@ -0,0 +1,207 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import os
+
+import pytest
+import sh
+
+from gilt import reader
+
+
+def _objects(repository):
+    out = sh.git(
+        "cat-file",
+        "--batch-all-objects",
+        "--batch-check=%(objectname) %(objecttype) %(objectsize)",
+        _cwd=repository,
+    )
+    for line in str(out).splitlines():
+        sha, kind, size = line.split(" ")
+        yield sha, kind, int(size)
+
+
+def _git_dir(repository):
+    out = sh.git("rev-parse", "--absolute-git-dir", _cwd=repository)
+
+    return str(out).strip()
+
+
+def _for_each_ref(repository):
+    out = sh.git(
+        "for-each-ref",
+        "--format=%(objectname) %(*objectname) %(refname)",
+        _cwd=repository,
+    )
+    refs = {}
+    for line in str(out).splitlines():
+        sha, peeled, refname = line.split(" ", 2)
+        refs[refname] = peeled or sha
+
+    return refs
+
+
+@pytest.fixture()
+def packed_repo(temp_dir, git_repo):
+    for i in range(20):
+        with open(os.path.join(git_repo, "foo"), "a") as f:
+            f.write("line {}\n".format(i) * 50)
+        pytest.helpers.git_commit(git_repo, str(i))
+    destination = os.path.join(temp_dir.strpath, "packed")
+    sh.git("clone", "--quiet", "--mirror", git_repo, destination)
+    sh.git("gc", "--quiet", "--aggressive", _cwd=destination)
+
+    return destination
+
+
+def test_read_ref_deltas(packed_repo):
+    sh.git(
+        "-c",
+        "repack.useDeltaBaseOffset=false",
+        "repack",
+        "-a",
+        "-d",
+        "-f",
+        "--quiet",
+        _cwd=packed_repo,
+    )
+    r = reader.Repository(packed_repo)
+
+    for _ in range(2):
+        for sha, kind, size in _objects(packed_repo):
+            assert (kind, size) == r.read_header(sha)
+            assert size == len(r.read(sha)[1])
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_read(git_repo, packed_repo, packed):
+    repository = packed_repo if packed else git_repo
+    r = reader.Repository(_git_dir(repository))
+    objects = list(_objects(repository))
+
+    assert objects
+    for sha, kind, size in objects:
+        data = bytes(sh.git("cat-file", kind, sha, _cwd=repository).stdout)
+
+        assert (kind, size) == r.read_header(sha)
+        assert (kind, data) == r.read(sha)
+    assert r.read("0" * 40) is None
+    assert r.read_header("0" * 40) is None
+
+
+def test_refs(git_repo, packed_repo):
+    for repository in (git_repo, packed_repo):
+        git_dir = _git_dir(repository)
+        refs = reader.Repository(git_dir).refs()
+
+        assert _for_each_ref(repository) == refs
+
+
+def test_refs_symbolic(git_repo):
+    git_dir = os.path.join(git_repo, ".git")
+    sh.git(
+        "symbolic-ref", "refs/heads/alias", "refs/heads/feature", _cwd=git_repo
+    )
+    refs = reader.Repository(git_dir).refs()
+
+    assert refs["refs/heads/feature"] == refs["refs/heads/alias"]
+
+
+def test_read_notices_new_packs(git_repo):
+    r = reader.Repository(os.path.join(git_repo, ".git"))
+    sha = pytest.helpers.git_rev_parse(git_repo, "master")
+    sh.git("repack", "-a", "-d", "--quiet", _cwd=git_repo)
+    sh.git("prune-packed", _cwd=git_repo)
+
+    assert "commit" == r.read(sha)[0]
+
+
+def test_read_drops_removed_packs(git_repo):
+    sh.git("repack", "-a", "-d", "--quiet", _cwd=git_repo)
+    r = reader.Repository(os.path.join(git_repo, ".git"))
+    old = set(r._packs)
+    with open(os.path.join(git_repo, "new"), "w") as f:
+        f.write("new\n")
+    pytest.helpers.git_commit(git_repo, "new")
+    sha = pytest.helpers.git_rev_parse(git_repo, "master")
+    sh.git("repack", "-a", "-d", "--quiet", _cwd=git_repo)
+    sh.git("prune-packed", _cwd=git_repo)
+
+    assert old
+    assert "commit" == r.read(sha)[0]
+    assert not old & set(r._packs)
+    assert 1 == len(r._packs)
+
+
+def test_read_alternates(temp_dir, packed_repo):
+    destination = os.path.join(temp_dir.strpath, "shared")
+    sh.git("clone", "--quiet", "--bare", "--shared", packed_repo, destination)
+    r = reader.Repository(destination)
+    sha = pytest.helpers.git_rev_parse(packed_repo, "master")
+
+    assert 1 == len(os.listdir(os.path.join(destination, "objects", "info")))
+    assert "commit" == r.read(sha)[0]
+
+
+@pytest.mark.parametrize(
+    "config", ["objectformat = sha256", "refStorage = reftable"]
+)
+def test_unsupported(git_repo, config):
+    git_dir = os.path.join(git_repo, ".git")
+    with open(os.path.join(git_dir, "config"), "a") as f:
+        f.write("[extensions]\n\t{}\n".format(config))
+
+    with pytest.raises(reader.UnsupportedError):
+        reader.Repository(git_dir)
+
+
+def test_apply_delta():
+    base = b"hello world"
+    # Sizes 11 and 14, copy 6 bytes at offset 0, then insert "there!!!".
+    delta = b"\x0b\x0e" + b"\x91\x00\x06" + b"\x08" + b"there!!!"
+
+    assert b"hello there!!!" == reader.apply_delta(base, delta)
+
+    with pytest.raises(ValueError):
+        reader.apply_delta(b"short", delta)
+
+
+def test_parse_tree():
+    data = (
+        b"40000 dir\0" + b"\x01" * 20 + b"100644 file\0" + b"\xab" * 20
+    )
+
+    assert [
+        ("040000", "dir", "01" * 20),
+        ("100644", "file", "ab" * 20),
+    ] == reader.parse_tree(data)
+
+
+def test_get_header():
+    data = b"tree abc\nparent def\n\ntree not a header\n"
+
+    assert "abc" == reader.get_header(data, "tree")
+    assert reader.get_header(data, "author") is None
+
+
+def test_is_sha():
+    assert reader.is_sha("a" * 40)
+    assert not reader.is_sha("A" * 40)
+    assert not reader.is_sha("master")
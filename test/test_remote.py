@@ -0,0 +1,77 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+import pytest
+
+from gilt import git
+from gilt import remote
+
+
+@pytest.fixture()
+def cloned_repo(temp_dir, git_repo):
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+
+    return clone_dir
+
+
+def test_get(cloned_repo, git_repo):
+    result = remote.get(cloned_repo)
+    sha = pytest.helpers.git_rev_parse(git_repo, "master")
+
+    assert sha == result.refs["refs/heads/master"]
+    assert "refs/tags/1.0" in result.refs
+
+
+def test_get_lists_once_per_run(mocker, cloned_repo):
+    spy = mocker.spy(remote, "_ls_remote")
+    remote.get(cloned_repo)
+    remote.get(cloned_repo)
+
+    assert 1 == spy.call_count
+
+
+def test_get_reuses_recorded_tips(mocker, cloned_repo):
+    recorded = remote.get(cloned_repo)
+    remote.forget()
+    spy = mocker.spy(remote, "_ls_remote")
+    result = remote.get(cloned_repo, ttl=60)
+
+    assert recorded == result
+    assert not spy.called
+
+
+def test_get_lists_expired_tips(mocker, cloned_repo):
+    remote.get(cloned_repo)
+    remote.forget(cloned_repo)
+    spy = mocker.spy(remote, "_ls_remote")
+    remote.get(cloned_repo, ttl=0)
+
+    assert 1 == spy.call_count
+
+
+def test_get_remote_file():
+    result = remote._get_remote_file("/repo")
+    parts = pytest.helpers.os_split(result)
+
+    assert "remote" == parts[-3]
+    assert 2 == len(parts[-2])
@@ -18,11 +18,165 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import json
+import os
+import subprocess
+import sys
+
+import click.testing
 import pytest
+import sh
 
+from gilt import lockfile
 from gilt import shell
+from gilt import status
+from gilt import trace
 
 
 def test_cli():
     with pytest.raises(SystemExit):
         shell.main()
+
+
+def test_write_trace(capsys, temp_dir):
+    filename = os.path.join(temp_dir.strpath, "trace.json")
+    trace.enable()
+    with trace.span("foo"):
+        pass
+    shell._write_trace(filename, top=1)
+    result, _ = capsys.readouterr()
+
+    assert not trace.is_enabled()
+    with open(filename) as f:
+        assert "foo" == json.load(f)["traceEvents"][0]["name"]
+    assert "Slowest spans:" in result
+    assert "s  foo" in result
+
+
+def test_load_lock_file_raises_when_missing(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "gilt.lock")
+
+    with pytest.raises(shell.NotFoundError):
+        shell._load_lock_file(filename)
+
+
+def test_get_config_files(temp_dir):
+    for d in ("a", os.path.join("b", "c")):
+        os.makedirs(d)
+        open(os.path.join(d, "gilt.yml"), "w").close()
+    result = shell._get_config_files(["**/gilt.yml", "./a/gilt.yml", "x.yml"])
+
+    assert [
+        os.path.join("a", "gilt.yml"),
+        os.path.join("b", "c", "gilt.yml"),
+        "x.yml",
+    ] == result
+
+    with pytest.raises(shell.NotFoundError):
+        shell._get_config_files(["missing/**/gilt.yml"])
+
+
+def test_overlay_configs(temp_dir, git_repo):
+    for d in ("a", "b"):
+        os.makedirs(d)
+        with open(os.path.join(d, "gilt.yml"), "w") as f:
+            f.write("- git: file://{}\n".format(git_repo))
+            f.write("  version: master\n")
+            f.write("  dst: vendor/\n")
+    runner = click.testing.CliRunner()
+    result = runner.invoke(shell.main, ["overlay", "*/gilt.yml"])
+
+    assert 0 == result.exit_code, result.output
+    assert 1 == result.output.count("cloning")
+    assert 2 == result.output.count("extracting")
+    for d in ("a", "b"):
+        assert os.path.exists(os.path.join(d, "vendor", "foo"))
+        assert os.path.exists(os.path.join(d, "gilt.lock"))
+
+
+def test_overlay_numeric_tag(temp_dir, git_repo):
+    # Read as a float, 1.10 would be the tag 1.1.
+    sh.git("tag", "1.10", "master~1", _cwd=git_repo)
+    with open("gilt.yml", "w") as f:
+        f.write("- git: file://{}\n".format(git_repo))
+        f.write("  version: 1.10\n")
+        f.write("  dst: vendor/\n")
+    runner = click.testing.CliRunner()
+    result = runner.invoke(shell.main, ["overlay"])
+
+    assert 0 == result.exit_code, result.output
+    assert os.path.exists(os.path.join("vendor", "foo"))
+    assert not os.path.exists(os.path.join("vendor", "bar"))
+    (pin,) = lockfile.load("gilt.lock").values()
+    assert "1.10" == pin.version
+
+
+def test_overlay_locks_url_as_written(temp_dir, git_repo):
+    with open("gilt.yml", "w") as f:
+        f.write("- git: file://${GILT_TEST_REPO}\n")
+        f.write("  version: master\n")
+        f.write("  dst: vendor/\n")
+    runner = click.testing.CliRunner()
+    env = {"GILT_TEST_REPO": git_repo}
+    result = runner.invoke(shell.main, ["overlay"], env=env)
+
+    assert 0 == result.exit_code, result.output
+    (pin,) = lockfile.load("gilt.lock").values()
+    assert "file://${GILT_TEST_REPO}" == pin.git
+    with open("gilt.lock") as f:
+        assert git_repo not in f.read()
+
+    moved = os.path.join(temp_dir.strpath, "moved")
+    sh.git("clone", "-q", git_repo, moved)
+    env = {"GILT_TEST_REPO": moved}
+    result = runner.invoke(shell.main, ["overlay", "--frozen"], env=env)
+
+    assert 0 == result.exit_code, result.output
+
+
+def test_print_status(capsys):
+    results = [
+        status.Result("clean", "a" * 40, []),
+        status.Result("drifted", "b" * 40, [status.Drift("missing", "/foo")]),
+        status.Result(
+            "unknown", None, [status.Drift(status.UNRESOLVED, "1.0")]
+        ),
+    ]
+
+    assert not shell._print_status(results)
+    assert shell._print_status(results[:1])
+
+    result, _ = capsys.readouterr()
+
+    assert "clean: up to date at aaaaaaa" in result
+    assert "  - missing /foo" in result
+    assert "  - unable to find version 1.0 in the clone" in result
+
+
+def test_version():
+    result = click.testing.CliRunner().invoke(shell.main, ["--version"])
+
+    assert 0 == result.exit_code
+    assert ", version " in result.output
+
+
+def test_import_is_lazy():
+    heavy = [
+        "asyncio",
+        "click_completion",
+        "colorama",
+        "fasteners",
+        "pkg_resources",
+        "sh",
+        "yaml",
+    ]
+    if sys.version_info < (3, 7):
+        # Modules can't compute their attributes lazily, see gilt/__init__.
+        heavy.remove("pkg_resources")
+    code = "import sys, gilt.shell; print(' '.join(sorted(sys.modules)))"
+    env = dict(os.environ)
+    env.pop("_GILT_COMPLETE", None)
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(shell.__file__))
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+
+    assert [] == [m for m in heavy if m in output.decode().split()]
@@ -0,0 +1,112 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+from gilt import state
+
+
+def test_put_and_get(temp_dir):
+    s = state.State("/repo", "sha", ["/dst/foo"])
+    state.put("/dst/", s)
+
+    assert s == state.get("/dst/")
+
+
+def test_get_missing():
+    assert state.get("/missing/") is None
+
+
+def test_get_invalid_manifest():
+    filename = state._get_state_file("/dst/")
+    os.makedirs(os.path.dirname(filename))
+    with open(filename, "w") as f:
+        f.write("{")
+
+    assert state.get("/dst/") is None
+
+
+def test_delete():
+    state.put("/dst/", state.State("/repo", "sha", []))
+    state.delete("/dst/")
+    state.delete("/dst/")
+
+    assert state.get("/dst/") is None
+
+
+def test_is_current(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "foo")
+    open(filename, "a").close()
+    s = state.State("/repo", "sha", state.stat([filename]))
+    state.put("/dst/", s)
+
+    assert state.is_current("/dst/", "/repo", "sha")
+    assert not state.is_current("/dst/", "/repo", "other")
+    assert not state.is_current("/dst/", "/other", "sha")
+
+    with open(filename, "w") as f:
+        f.write("changed")
+
+    assert not state.is_current("/dst/", "/repo", "sha")
+
+    state.put("/dst/", s._replace(files=state.stat([filename])))
+    os.unlink(filename)
+
+    assert not state.is_current("/dst/", "/repo", "sha")
+
+
+def test_is_current_touches_manifest(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "foo")
+    open(filename, "a").close()
+    state.put("/dst/", state.State("/repo", "sha", state.stat([filename])))
+    manifest = state._get_state_file("/dst/")
+    os.utime(manifest, (1000, 1000))
+
+    assert not state.is_current("/dst/", "/repo", "other")
+    assert 1000 == os.stat(manifest).st_mtime
+    assert state.is_current("/dst/", "/repo", "sha")
+    assert os.stat(manifest).st_mtime > 1000
+
+
+def test_is_unmodified(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "foo")
+    open(filename, "a").close()
+    s = state.State("/repo", "sha", state.stat([filename]))
+
+    assert state.is_unmodified(s)
+
+    with open(filename, "w") as f:
+        f.write("changed")
+
+    assert not state.is_unmodified(s)
+
+    os.unlink(filename)
+
+    assert not state.is_unmodified(s)
+
+
+def test_matches_legacy_manifest(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "foo")
+    open(filename, "a").close()
+    st = os.lstat(filename)
+
+    assert state.matches(st, [st.st_size, st.st_mtime_ns])
+    assert state.matches(st, [st.st_size, st.st_mtime_ns, st.st_ino, "sha"])
+    assert not state.matches(st, [st.st_size, st.st_mtime_ns, -1, None])
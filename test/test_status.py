@@ -0,0 +1,181 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+
+import os
+
+import pytest
+
+from gilt import config
+from gilt import git
+from gilt import lockfile
+from gilt import state
+from gilt import status
+
+
+@pytest.fixture()
+def cloned_repo(temp_dir, git_repo):
+    clone_dir = os.path.join(temp_dir.strpath, "clone")
+    git.clone("repo", git_repo, clone_dir)
+
+    return clone_dir
+
+
+def _entry(cloned_repo, **kwargs):
+    fields = dict.fromkeys(config.Config._fields)
+    fields.update(git="git_repo", name="repo", src=cloned_repo, files=[])
+    fields.update(kwargs)
+
+    return config.Config(**fields)
+
+
+@pytest.fixture()
+def extracted(temp_dir, cloned_repo):
+    dst = os.path.join(temp_dir.strpath, "dst", "")
+    git.extract(cloned_repo, dst, "master")
+
+    return _entry(cloned_repo, version="master", dst=dst)
+
+
+def test_check(extracted):
+    results = status.check([extracted])
+    sha = pytest.helpers.git_rev_parse(extracted.src, "master")
+
+    assert [status.Result("repo", sha, [])] == results
+
+
+def test_check_drift(extracted):
+    with open(os.path.join(extracted.dst, "foo"), "w") as f:
+        f.write("changed")
+    os.unlink(os.path.join(extracted.dst, "bar"))
+    open(os.path.join(extracted.dst, "extra"), "w").close()
+    drifts = status.check([extracted])[0].drifts
+
+    assert [
+        status.Drift(status.MISSING, os.path.join(extracted.dst, "bar")),
+        status.Drift(status.MODIFIED, os.path.join(extracted.dst, "foo")),
+        status.Drift(status.EXTRA, os.path.join(extracted.dst, "extra")),
+    ] == drifts
+
+
+def test_check_ignores_extra_with_post_commands(extracted):
+    entry = extracted._replace(post_commands=["touch p"])
+    open(os.path.join(entry.dst, "p"), "w").close()
+    os.unlink(os.path.join(entry.dst, "bar"))
+    drifts = status.check([entry])[0].drifts
+
+    assert [
+        status.Drift(status.MISSING, os.path.join(entry.dst, "bar"))
+    ] == drifts
+
+
+def test_check_mode_drift(extracted):
+    os.chmod(os.path.join(extracted.dst, "foo"), 0o755)
+    drifts = status.check([extracted])[0].drifts
+
+    assert [
+        status.Drift(status.MODIFIED, os.path.join(extracted.dst, "foo"))
+    ] == drifts
+
+
+def test_check_hashes_only_changed_files(mocker, extracted):
+    spy = mocker.spy(status, "hash_file")
+    status.check([extracted])
+
+    assert 0 == spy.call_count
+
+    filename = os.path.join(extracted.dst, "foo")
+    os.utime(filename, ns=(0, 0))
+    status.check([extracted])
+
+    assert [filename] == [c[0][0] for c in spy.call_args_list]
+
+    status.check([extracted])
+
+    assert 1 == spy.call_count
+    assert state.is_unmodified(state.get(extracted.dst))
+
+
+def test_check_records_state_when_clean(mocker, extracted):
+    state.delete(extracted.dst)
+    spy = mocker.spy(status, "hash_file")
+
+    assert [] == status.check([extracted])[0].drifts
+    assert 2 == spy.call_count
+
+    status.check([extracted])
+
+    assert 2 == spy.call_count
+    assert state.is_current(
+        extracted.dst,
+        extracted.src,
+        pytest.helpers.git_rev_parse(extracted.src, "master"),
+    )
+
+
+def test_check_against_lock(extracted):
+    sha = pytest.helpers.git_rev_parse(extracted.src, "master~1")
+    pin = lockfile.Pin("git_repo", "master", sha, "")
+    pins = {("git_repo", "master"): pin}
+    result = status.check([extracted], pins)[0]
+
+    assert sha == result.sha
+    assert [
+        status.Drift(status.EXTRA, os.path.join(extracted.dst, "bar"))
+    ] == result.drifts
+
+
+def test_check_unresolved(cloned_repo):
+    entry = _entry(cloned_repo, version="missing", dst="/dst/")
+
+    assert [status.Drift(status.UNRESOLVED, "missing")] == status.check(
+        [entry]
+    )[0].drifts
+
+
+def test_check_files(temp_dir, cloned_repo):
+    dst = os.path.join(temp_dir.strpath, "files")
+    files = [
+        config.FilesConfig(os.path.join(cloned_repo, "fo*"), dst + "/", []),
+        config.FilesConfig(os.path.join(cloned_repo, "bar"), dst, []),
+    ]
+    git.overlay(cloned_repo, files, "master")
+    entry = _entry(cloned_repo, version="master", files=files)
+    open(os.path.join(dst, "other"), "w").close()
+
+    assert [] == status.check([entry])[0].drifts
+
+    os.unlink(os.path.join(dst, "foo"))
+
+    assert [
+        status.Drift(status.MISSING, os.path.join(dst, "foo"))
+    ] == status.check([entry])[0].drifts
+
+
+def test_hash_file(temp_dir, git_repo):
+    filename = os.path.join(temp_dir.strpath, "file")
+    with open(filename, "w") as f:
+        f.write("foo")
+    link = os.path.join(temp_dir.strpath, "link")
+    os.symlink("foo", link)
+    blob = pytest.helpers.git_rev_parse(git_repo, "master:foo")
+
+    assert blob == status.hash_file(filename)
+    assert blob == status.hash_file(link)
+    assert status.hash_file(temp_dir.strpath) is None
@@ -0,0 +1,129 @@
+# Copyright (c) 2016 Cisco Systems, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import os
+import threading
+
+import pytest
+
+from gilt import trace
+
+
+@pytest.fixture(autouse=True)
+def disable_trace():
+    yield
+
+    trace.disable()
+
+
+def _spans():
+    return [e for e in trace.events() if e["ph"] == "X"]
+
+
+def test_span_disabled():
+    events = trace.events()
+    with trace.span("foo"):
+        pass
+
+    assert events == trace.events()
+    assert trace.lane("foo") is None
+
+
+def test_span():
+    trace.enable()
+    with trace.span("foo", cat="bar", key="value"):
+        pass
+    span = _spans()[0]
+
+    assert "foo" == span["name"]
+    assert "bar" == span["cat"]
+    assert {"key": "value"} == span["args"]
+    assert threading.get_ident() == span["tid"]
+    assert 0 <= span["ts"]
+    assert 0 <= span["dur"]
+
+
+def test_enable_discards_spans():
+    trace.enable()
+    with trace.span("foo"):
+        pass
+    trace.enable()
+
+    assert [] == trace.events()
+
+
+def test_lane():
+    trace.enable()
+    lane = trace.lane("foo")
+
+    assert lane == trace.lane("foo")
+    assert lane != trace.lane("bar")
+    metadata = [e for e in trace.events() if e["ph"] == "M"]
+    assert ["foo", "bar"] == [e["args"]["name"] for e in metadata]
+
+
+def test_bind():
+    trace.enable()
+    lane = trace.lane("foo")
+
+    def work():
+        with trace.span("work"):
+            pass
+
+    thread = threading.Thread(target=trace.bind(lane, work))
+    thread.start()
+    thread.join()
+
+    assert lane == _spans()[0]["tid"]
+
+
+def test_traced():
+    @trace.traced("foo")
+    def func(value):
+        return value
+
+    trace.enable()
+
+    assert "value" == func("value")
+    assert ["foo"] == [e["name"] for e in _spans()]
+
+
+def test_write(temp_dir):
+    filename = os.path.join(temp_dir.strpath, "trace.json")
+    trace.enable()
+    with trace.span("foo"):
+        pass
+    trace.write(filename)
+    with open(filename) as f:
+        result = json.load(f)
+
+    assert trace.events() == result["traceEvents"]
+
+
+def test_slowest(mocker):
+    trace.enable()
+    lane = trace.lane("entry")
+    for name, duration in (("fast", 1), ("slow", 3), ("medium", 2)):
+        mocker.patch("time.monotonic", side_effect=[0, duration])
+        with trace.span(name, lane_id=lane):
+            pass
+
+    assert [(3, "slow", "entry"), (2, "medium", "entry")] == trace.slowest(2)
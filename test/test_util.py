@@ -103,6 +103,28 @@ def test_copy_raises(temp_dir):
         util.copy("invalid-src", "invalid-dst")
 
 
+def test_describe_command():
+    cmd = sh.git.bake("fetch", "--depth", "1", _cwd="/tmp")
+
+    assert "git fetch" == util.describe_command(cmd)
+
+
+def test_describe_command_skips_configuration():
+    cmd = sh.git.bake("-c", "url.a.insteadOf=b", "fetch", _cwd="/tmp")
+
+    assert "git fetch" == util.describe_command(cmd)
+
+
+def test_run_command_traced(mocker):
+    patched_span = mocker.patch("gilt.trace.span")
+    cmd = sh.git.bake("--version")
+    util.run_command(cmd)
+
+    patched_span.assert_called_once_with(
+        "git --version", cat="command", command=str(cmd)
+    )
+
+
 def test_build_sh_cmd_simple_command():
     ls = sh.ls.bake()
     cmd = util.build_sh_cmd("ls")
@@ -121,3 +143,19 @@ def test_build_sh_cmd_command_with_cwd(temp_dir):
     cmd = util.build_sh_cmd("ls", cwd=temp_dir)
     assert ls == cmd._path.decode()
     assert temp_dir == cmd._partial_call_args["cwd"]
+
+
+def test_print_error(capsys):
+    util.print_error("foo")
+
+    result, _ = capsys.readouterr()
+    assert "foo" in result
+
+
+def test_lock(temp_dir):
+    lock_file = os.path.join(temp_dir.strpath, "foo.lock")
+    with util.lock(lock_file):
+        assert os.path.exists(lock_file)
+        assert util._thread_locks[lock_file].locked()
+
+    assert not util._thread_locks[lock_file].locked()